@@ -6,11 +6,14 @@ MEMBER_TYPE_NORMAL = "normal"
 MEMBER_TYPE_STANDARD = "standard"
 MEMBER_TYPE_PRO = "pro"
 
+# Số lượt mặc định của module1 khi action_log chưa cấu hình countCallAPIConfig
+DEFAULT_COUNT_CALL_API_CONFIG = 3
+
 class DataModule1Config:
     def __init__(self, memberType: str, jsonConfig: str):
         self.memberType = memberType
         self.countCallAPI = jsonConfig.get("countCallAPI", 0)
-        self.countCallAPIConfig = jsonConfig.get("countCallAPIConfig", 3)
+        self.countCallAPIConfig = jsonConfig.get("countCallAPIConfig", DEFAULT_COUNT_CALL_API_CONFIG)
 
     def allowSearchAPI(self):
         if self.memberType == MEMBER_TYPE_NORMAL:
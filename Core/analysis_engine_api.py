@@ -1,20 +1,113 @@
 # Core/analysis_engine.py
 import logging
 import math
-import re
+import time
 from datetime import datetime, timedelta
 from collections import Counter
 from isodate import parse_duration
+from Core.entity_cache import TTLCache
+from Core.api_key_pool import QUOTA_COSTS
+from Core.keyword_scorer import KeywordScorer
+from timing import timed, span
+
+class PageBudget:
+    """
+    Giới hạn của một lần quét nhiều trang search.list: số trang, thời gian (giây) và quota ước tính (unit).
+    Khi pool key sắp cạn quota thì cũng dừng, để phần quota còn lại dành cho các request khác.
+    """
+    def __init__(self, max_pages, time_budget=None, quota_budget=None, key_pool=None):
+        self.max_pages = max_pages
+        self.started = time.monotonic()
+        self.deadline = self.started + time_budget if time_budget else None
+        self.quota_budget, self.key_pool = quota_budget, key_pool
+        self.pages_requested, self.pages_done, self.units = 0, 0, 0
+        self.stop_reason = None
+
+    def request_page(self):
+        self.pages_requested += 1
+        self.units += QUOTA_COSTS["search"]
+
+    def page_done(self, video_count):
+        # videos.list tốn 1 unit cho mỗi lô 50 ID (ước tính trên, chưa trừ phần lấy từ cache)
+        self.pages_done += 1
+        self.units += -(-video_count // 50) * QUOTA_COSTS["videos"]
+
+    def remaining_time(self):
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def allows_next_page(self):
+        if self.pages_requested >= self.max_pages: self.stop_reason = "max_pages"
+        elif self.quota_budget is not None and self.units + QUOTA_COSTS["search"] + QUOTA_COSTS["videos"] > self.quota_budget: self.stop_reason = "quota_budget"
+        elif self.deadline is not None and time.monotonic() >= self.deadline: self.stop_reason = "time_budget"
+        elif self.key_pool is not None and self.key_pool.low_budget(): self.stop_reason = "low_quota"
+        else: return True
+        return False
+
+    def progress(self, scorer, done):
+        return {
+            "page": self.pages_done, "videos": scorer.video_count, "quota_units": self.units,
+            "elapsed": round(time.monotonic() - self.started, 3), "done": done, "stop_reason": self.stop_reason if done else None,
+        }
 
 class AnalysisEngineAPI:
-    def __init__(self, api_manager, db_manager):
+    def __init__(self, api_manager, db_manager, top_video_cache: TTLCache = None):
         self.api = api_manager
         self.db = db_manager
-        self.channel_cache = {}
+        # Chi tiết kênh/video được cache ở tầng api (EntityCache); ở đây chỉ nhớ video nổi bật của từng kênh
+        self.top_video_cache = top_video_cache or TTLCache(max_entries=5000, ttl=24 * 3600)
         self.VIETNAMESE_STOP_WORDS = set(['và', 'của', 'là', 'cho', 'có', 'không', 'được', 'để', 'một', 'trong', 'với', 'khi', 'thì', 'từ', 'đã', 'sẽ', 'cũng', 'như', 'tại', 'ra', 'vào', 'đến', 'làm', 'cách', 'video', 'hướng', 'dẫn', 'review', 'top', 'mới', 'nhất'])
 
     # Sửa đổi để xử lý regionCode rỗng
+    @timed("discover")
     def discover_keywords(self, seed_keyword, region_code, mode):
+        params = self._build_discover_params(seed_keyword, region_code, mode)
+        
+        # if stop_event.is_set(): return []
+        search_results = self.api.search(**params)
+        if not search_results: return []
+
+        video_ids = self._video_ids(search_results)
+        video_details = self.api.get_video_details(video_ids)
+        return self._score_keywords(video_details)
+
+    @timed("discover")
+    def discover_keywords_deep(self, seed_keyword, region_code, mode, max_pages, time_budget=None, quota_budget=None):
+        """
+        Như discover_keywords nhưng theo nextPageToken qua tối đa max_pages trang search.list,
+        trong giới hạn thời gian (giây) và quota (unit) của request.
+        """
+        scorer = self.keyword_scorer()
+        for _ in self.collect_discover_pages(scorer, seed_keyword, region_code, mode, max_pages, time_budget, quota_budget): pass
+        return scorer.result()
+
+    def collect_discover_pages(self, scorer, seed_keyword, region_code, mode, max_pages, time_budget=None, quota_budget=None):
+        """
+        Lấy lần lượt từng trang kết quả và cộng vào scorer; sau mỗi trang trả ra tiến độ (PageBudget.progress).
+        Bản đồng bộ lấy tuần tự; AsyncAnalysisEngineAPI gọi trang kế tiếp song song với lấy chi tiết video.
+        """
+        budget = PageBudget(max_pages, time_budget, quota_budget, getattr(self.api, 'key_pool', None))
+        params = self._build_discover_params(seed_keyword, region_code, mode)
+        seen, page_token = set(), None
+        while True:
+            budget.request_page()
+            items, page_token = self.api.search_page(**params, **({'pageToken': page_token} if page_token else {}))
+            video_ids = self._new_video_ids(items, seen)
+            details = self.api.get_video_details(video_ids) if video_ids else []
+            with span("score"):
+                scorer.add(details)
+            budget.page_done(len(video_ids))
+            if not page_token: budget.stop_reason = "last_page"
+            done = not page_token or not budget.allows_next_page()
+            yield budget.progress(scorer, done)
+            if done: return
+
+    def _new_video_ids(self, search_results, seen):
+        # Các trang có thể trả lại video đã gặp ở trang trước
+        video_ids = [video_id for video_id in dict.fromkeys(self._video_ids(search_results)) if video_id not in seen]
+        seen.update(video_ids)
+        return video_ids
+
+    def _build_discover_params(self, seed_keyword, region_code, mode):
         params = {
             'part': "id,snippet", 'q': seed_keyword, 'type': "video", 'maxResults': 50
         }
@@ -29,35 +122,21 @@ class AnalysisEngineAPI:
             params['order'] = 'relevance'
             params['videoDuration'] = 'long'
             params['videoDefinition'] = 'high'
-        
-        # if stop_event.is_set(): return []
-        search_results = self.api.search(**params)
-        if not search_results: return []
+        return params
 
-        video_ids = [item['id']['videoId'] for item in search_results if item['id'].get('kind') == 'youtube#video']
-        video_details = self.api.get_video_details(video_ids)
-        all_tags, all_titles_phrases = [], []
+    def _video_ids(self, search_results):
+        return [item['id']['videoId'] for item in search_results if item['id'].get('kind') == 'youtube#video']
 
-        for video in video_details:
-            # if stop_event.is_set(): return []
-            snippet = video.get('snippet', {}); tags = snippet.get('tags', []); title = video.get('title', '').lower()
-            if tags: all_tags.extend([tag.lower() for tag in tags])
-            clean_title = re.sub(r'[^\w\s]', '', title)
-            title_words = [word for word in clean_title.split() if word not in self.VIETNAMESE_STOP_WORDS]
-            all_titles_phrases.extend([' '.join(title_words[i:i+n]) for n in [2, 3, 4] for i in range(len(title_words)-n+1)])
-
-        tag_counts, phrase_counts = Counter(all_tags), Counter(all_titles_phrases)
-        combined_scores = Counter()
-        for keyword, count in tag_counts.items(): combined_scores[keyword] += count * 1.5 
-        for keyword, count in phrase_counts.items(): combined_scores[keyword] += count
-
-        final_keywords = []
-        for keyword, score in combined_scores.most_common(300): 
-            word_count = len(keyword.split())
-            if 1 < word_count < 7 and len(keyword) > 5 and not any(char in keyword for char in '|\\/#*[]"'):
-                final_keywords.append({"keyword": keyword, "word_count": word_count, "char_count": len(keyword), "score": score})
-                if len(final_keywords) >= 150: break
-        return sorted(final_keywords, key=lambda k: k['score'], reverse=True)
+    def keyword_scorer(self):
+        return KeywordScorer(self.VIETNAMESE_STOP_WORDS)
+
+    def _score_keywords(self, video_details):
+        """
+        Phần tính toán thuần (không gọi API) của discover_keywords: tách n-gram và chấm điểm từ khóa (KeywordScorer).
+        """
+        scorer = self.keyword_scorer()
+        scorer.add(video_details)
+        return scorer.result()
 
     def full_analysis_for_keyword(self, keyword, region_code):
         logging.info(f'full_analysis_for_keyword keyword: {keyword}, region_code: {region_code}')
@@ -79,14 +158,25 @@ class AnalysisEngineAPI:
         supply_30d = self._calculate_supply(keyword, region_code, 30)
         competition_metrics = self._calculate_advanced_competition(demand_30d['video_details'])
         
-        word_count = len(keyword.split())
-        niche_factor = 1 + max(0, word_count - 2) * 0.1
-        opportunity_score = (math.log10(demand_30d['score'] + 1) / competition_metrics['score']) * niche_factor if competition_metrics['score'] > 0 else 0
-        
         # === THAY ĐỔI: Chỉ tìm 5 đối thủ ===
         competitors = self.find_competitors(keyword, region_code, limit=5)
         
-        result = {
+        result = self._build_full_analysis_result(keyword, demand_30d, supply_30d, competition_metrics, competitors)
+        
+        # Lưu kết quả mới vào DB
+        # self.db.save_analysis_result(result)
+        # self.db.save_competitors(keyword, competitors)
+        return result
+
+    def _opportunity_score(self, keyword, demand_30d, competition_metrics):
+        word_count = len(keyword.split())
+        niche_factor = 1 + max(0, word_count - 2) * 0.1
+        return (math.log10(demand_30d['score'] + 1) / competition_metrics['score']) * niche_factor if competition_metrics['score'] > 0 else 0
+
+    def _build_full_analysis_result(self, keyword, demand_30d, supply_30d, competition_metrics, competitors):
+        opportunity_score = self._opportunity_score(keyword, demand_30d, competition_metrics)
+        
+        return {
             "keyword": keyword, 
             "demand_score": demand_30d['score'], 
             "total_views": demand_30d['total_views'], 
@@ -97,42 +187,18 @@ class AnalysisEngineAPI:
             "opportunity_score": opportunity_score, 
             "competitors": competitors
         }
-        
-        # Lưu kết quả mới vào DB
-        # self.db.save_analysis_result(result)
-        # self.db.save_competitors(keyword, competitors)
-        return result
-
-    def find_competitors(self, keyword, region_code, limit=5):
-        """
-        Tối ưu triệt để: Bỏ hoàn toàn chức năng tìm video nổi bật.
-        """
-        logging.info(f'find_competitors keyword: {keyword}, region_code: {region_code}')
-        params = {'part': "snippet", 'q': keyword, 'type': "video", 'maxResults': 50, 'order': 'relevance'}
-        if region_code: params['regionCode'] = region_code
-            
-        videos = self.api.search(**params)
-        if not videos: return []
-        
-        channel_ids = [v['snippet']['channelId'] for v in videos]
-        channel_counts = Counter(channel_ids)
-        top_channel_ids = [cid for cid, count in channel_counts.most_common(limit)]
-        
-        if not top_channel_ids: return []
-        
-        # Sử dụng cache để tránh gọi API thừa
-        channels_to_fetch = [cid for cid in top_channel_ids if cid not in self.channel_cache]
-        if channels_to_fetch:
-            logging.info(f"Fetching details for {len(channels_to_fetch)} new channels.")
-            new_channel_details = self.api.get_channel_details(channels_to_fetch)
-            for channel in new_channel_details:
-                self.channel_cache[channel['id']] = channel
-        
-        channel_details = [self.channel_cache[cid] for cid in top_channel_ids if cid in self.channel_cache]
-        return sorted(channel_details, key=lambda x: int(x.get('statistics', {}).get('subscriberCount', 0)), reverse=True)
 
     # Sửa đổi để xử lý regionCode rỗng
+    @timed("demand")
     def _calculate_demand(self, keyword, region_code, timeframe_days, limit=50):
+        params = self._build_demand_params(keyword, region_code, timeframe_days, limit)
+        videos = self.api.search(**params)
+        if not videos: return {'score': 0, 'total_views': 0, 'video_details': []}
+        video_ids = self._video_ids(videos)
+        video_details = self.api.get_video_details(video_ids)
+        return self._demand_from_details(video_details)
+
+    def _build_demand_params(self, keyword, region_code, timeframe_days, limit=50):
         params = {
             'part': "id,snippet", 'q': keyword, 'type': "video", 
             'maxResults': limit, 'order': 'viewCount', 
@@ -140,11 +206,9 @@ class AnalysisEngineAPI:
         }
         if region_code: # CHỈ THÊM NẾU CÓ GIÁ TRỊ
             params['regionCode'] = region_code
-            
-        videos = self.api.search(**params)
-        if not videos: return {'score': 0, 'total_views': 0, 'video_details': []}
-        video_ids = [item['id']['videoId'] for item in videos if item['id'].get('kind') == 'youtube#video']
-        video_details = self.api.get_video_details(video_ids)
+        return params
+
+    def _demand_from_details(self, video_details):
         total_views, total_likes, total_comments = 0, 0, 0
         for video in video_details:
             stats = video.get('statistics', {})
@@ -154,23 +218,32 @@ class AnalysisEngineAPI:
         return {'score': (total_views * 1) + (total_likes * 2) + (total_comments * 3), 'total_views': total_views, 'video_details': video_details}
 
     # Sửa đổi để xử lý regionCode rỗng
+    @timed("supply")
     def _calculate_supply(self, keyword, region_code, timeframe_days, limit=50):
+        params = self._build_supply_params(keyword, region_code, timeframe_days, limit)
+        videos = self.api.search(**params)
+        return {'score': len(videos)}
+
+    def _build_supply_params(self, keyword, region_code, timeframe_days, limit=50):
         params = {
             'part': "id", 'q': keyword, 'type': "video", 'maxResults': limit, 'order': 'date',
             'publishedAfter': (datetime.utcnow() - timedelta(days=timeframe_days)).isoformat("T") + "Z"
         }
         if region_code: # CHỈ THÊM NẾU CÓ GIÁ TRỊ
             params['regionCode'] = region_code
+        return params
         
-        videos = self.api.search(**params)
-        return {'score': len(videos)}
-        
+    @timed("competition")
     def _calculate_advanced_competition(self, video_details_list):
         if not video_details_list:
             return {'score': 1, 'avg_views': 0, 'avg_engagement_rate': 0}
 
+        unique_channel_ids = list(set(v['snippet']['channelId'] for v in video_details_list))
+        channel_details = self.api.get_channel_details(unique_channel_ids)
+        return self._competition_from_details(video_details_list, unique_channel_ids, channel_details)
+
+    def _competition_from_details(self, video_details_list, unique_channel_ids, channel_details):
         total_views, total_engagement_rate, engaged_videos_count = 0, 0, 0
-        channel_ids = [v['snippet']['channelId'] for v in video_details_list]
         for v in video_details_list:
             stats = v.get('statistics', {}); views = int(stats.get('viewCount', 0)); likes = int(stats.get('likeCount', 0)); comments = int(stats.get('commentCount', 0))
             total_views += views
@@ -182,9 +255,6 @@ class AnalysisEngineAPI:
         avg_engagement_rate = total_engagement_rate / engaged_videos_count if engaged_videos_count > 0 else 0
         content_competition_score = math.log10(avg_views + 1) * (1 + avg_engagement_rate) + 1
 
-        unique_channel_ids = list(set(channel_ids))
-        channel_details = self.api.get_channel_details(unique_channel_ids)
-        
         total_subs, valid_sub_channels = 0, 0
         for ch in channel_details:
             subs = int(ch.get('statistics', {}).get('subscriberCount', 0))
@@ -199,52 +269,71 @@ class AnalysisEngineAPI:
         return {'score': final_competition_score, 'avg_views': avg_views, 'avg_engagement_rate': avg_engagement_rate}
 
     # Sửa đổi để xử lý regionCode rỗng
+    @timed("competitors")
     def find_competitors(self, keyword, region_code, limit=20):
         logging.info(f'find_competitors keyword limit 20: {keyword}, region_code: {region_code}')
-        params = {
-            'part': "snippet", 'q': keyword, 'type': "video", 'maxResults': 50, 'order': 'relevance'
-        }
-        if region_code:
-            params['regionCode'] = region_code
-            
+        params = self._build_competitor_params(keyword, region_code)
         videos = self.api.search(**params)
         if not videos: return []
         
-        channel_ids = [v['snippet']['channelId'] for v in videos]
-        channel_counts = Counter(channel_ids)
-        top_channel_ids = [cid for cid, count in channel_counts.most_common(limit)]
-        
+        top_channel_ids = self._top_channel_ids(videos, limit)
         if not top_channel_ids: return []
         
-        # Chỉ lấy thông tin của các kênh chưa có trong cache
-        channels_to_fetch = [cid for cid in top_channel_ids if cid not in self.channel_cache]
-        if channels_to_fetch:
-            logging.info(f"Fetching details for {len(channels_to_fetch)} new channels.")
-            new_channel_details = self.api.get_channel_details(channels_to_fetch)
-            for channel in new_channel_details:
-                self.channel_cache[channel['id']] = channel # Lưu vào cache
-        
-        # Lấy thông tin chi tiết từ cache
-        channel_details = [self.channel_cache[cid] for cid in top_channel_ids if cid in self.channel_cache]
+        # Chi tiết kênh lấy qua api (đã có EntityCache), giữ thứ tự theo top_channel_ids
+        channel_details = self._order_channels(self.api.get_channel_details(top_channel_ids), top_channel_ids)
 
+        competitors = []
         for channel in channel_details:
             # Chỉ tìm video nổi bật nếu kênh chưa có thông tin này trong cache
-            if 'top_video' not in channel:
+            top_video = self.top_video_cache.get(channel['id'])
+            if top_video is None:
                 logging.info(f"Finding top video for new channel: {channel['snippet']['title']}")
-                top_video_search = self.api.search(part="snippet", q="", channelId=channel['id'], order='viewCount', type='video', maxResults=1)
-                # logging.info(f"Top video search result: {top_video_search}")
-                if top_video_search:
-                    top_video_details = self.api.get_video_details([top_video_search[0]['id']['videoId']])
-                    # logging.info(f"Top video details: {top_video_details}")
-                    if top_video_details:
-                        channel['top_video'] = top_video_details[0]
-                else:
-                    channel['top_video'] = {} # Đánh dấu đã tìm để không tìm lại
+                with span("top_video"):
+                    top_video_search = self.api.search(**self._build_top_video_params(channel['id']))
+                    top_video_details = self.api.get_video_details([top_video_search[0]['id']['videoId']]) if top_video_search else []
+                top_video = self._remember_top_video(channel['id'], top_video_search, top_video_details)
+            competitors.append(self._with_top_video(channel, top_video))
+        channel_details = competitors
         
         # return sorted(channel_details, key=lambda x: int(x.get('statistics', {}).get('subscriberCount', 0)), reverse=True)
         logging.info(f"Finish find_competitors 20 channels for keyword: {keyword}")
         return channel_details
 
+    def _build_competitor_params(self, keyword, region_code):
+        params = {
+            'part': "snippet", 'q': keyword, 'type': "video", 'maxResults': 50, 'order': 'relevance'
+        }
+        if region_code:
+            params['regionCode'] = region_code
+        return params
+
+    def _build_top_video_params(self, channel_id):
+        return {'part': "snippet", 'q': "", 'channelId': channel_id, 'order': 'viewCount', 'type': 'video', 'maxResults': 1}
+
+    def _order_channels(self, channels, channel_ids):
+        channels_by_id = {channel['id']: channel for channel in channels}
+        return [channels_by_id[cid] for cid in channel_ids if cid in channels_by_id]
+
+    def _remember_top_video(self, channel_id, top_video_search, top_video_details):
+        if not top_video_search:
+            top_video = {} # Đánh dấu đã tìm để không tìm lại
+        elif top_video_details:
+            top_video = top_video_details[0]
+        else:
+            return None # Lỗi khi lấy chi tiết: lần sau tìm lại
+        self.top_video_cache.set(channel_id, top_video)
+        return top_video
+
+    def _with_top_video(self, channel, top_video):
+        # Bản ghi kênh được dùng chung trong EntityCache nên không sửa trực tiếp
+        return dict(channel, top_video=top_video) if top_video is not None else channel
+
+    def _top_channel_ids(self, videos, limit):
+        channel_ids = [v['snippet']['channelId'] for v in videos]
+        channel_counts = Counter(channel_ids)
+        return [cid for cid, count in channel_counts.most_common(limit)]
+
+    @timed("competitor_m4")
     def analyze_competitor_for_m4(self, channel_id, market_keywords):
         """
         Phiên bản tối ưu quota: Content Gap được ƯỚC TÍNH, không dùng API.
@@ -258,27 +347,39 @@ class AnalysisEngineAPI:
             return {"error": "Không thể lấy thông tin kênh."}
         
         channel_info = channel_details_list[0]
-        stats = channel_info.get('statistics', {})
-        snippet = channel_info.get('snippet', {})
-        analysis_result.update({
-            'channel_title': snippet.get('title'),
-            'subs_count': int(stats.get('subscriberCount', 0)),
-            'video_count': int(stats.get('videoCount', 0)),
-            'total_views': int(stats.get('viewCount', 0)),
-            'published_at': snippet.get('publishedAt', 'N/A')[:10],
-        })
+        analysis_result.update(self._build_channel_summary(channel_info))
 
         # 2. Lấy 50 video gần nhất để phân tích
-        search_params = {'part': 'snippet', 'channelId': channel_id, 'order': 'date', 'maxResults': 50, 'type': 'video'}
+        search_params = self._build_recent_videos_params(channel_id)
         recent_videos_search = self.api.search(**search_params)
         if not recent_videos_search:
             return {"error": "Kênh không có video nào gần đây để phân tích."}
         
-        video_ids = [v['id']['videoId'] for v in recent_videos_search if v['id'].get('kind') == 'youtube#video']
+        video_ids = self._video_ids(recent_videos_search)
         video_details_list = self.api.get_video_details(video_ids)
         if not video_details_list:
             return {"error": "Không thể lấy chi tiết các video của kênh."}
 
+        return self._build_competitor_analysis(analysis_result, video_details_list, market_keywords)
+
+    def _build_recent_videos_params(self, channel_id):
+        return {'part': 'snippet', 'channelId': channel_id, 'order': 'date', 'maxResults': 50, 'type': 'video'}
+
+    def _build_channel_summary(self, channel_info):
+        stats = channel_info.get('statistics', {})
+        snippet = channel_info.get('snippet', {})
+        return {
+            'channel_title': snippet.get('title'),
+            'subs_count': int(stats.get('subscriberCount', 0)),
+            'video_count': int(stats.get('videoCount', 0)),
+            'total_views': int(stats.get('viewCount', 0)),
+            'published_at': snippet.get('publishedAt', 'N/A')[:10],
+        }
+
+    def _build_competitor_analysis(self, analysis_result, video_details_list, market_keywords):
+        """
+        Phần tính toán thuần (không gọi API) của analyze_competitor_for_m4: chỉ số, content gap và đánh giá.
+        """
         # 3. Tính toán các chỉ số
         # Tần suất đăng bài
         publish_dates = sorted([datetime.fromisoformat(v['snippet']['publishedAt'].replace('Z', '+00:00')) for v in video_details_list], reverse=True)
@@ -0,0 +1,222 @@
+# Core/analysis_engine_api_async.py
+import asyncio
+import logging
+from Core.analysis_engine_api import AnalysisEngineAPI, PageBudget
+from timing import timed, span
+from sse import drain_queue
+
+class AsyncAnalysisEngineAPI(AnalysisEngineAPI):
+    """
+    Phiên bản bất đồng bộ của AnalysisEngineAPI, dùng với AsyncYoutubeClient.
+    Phần tính toán thuần được dùng lại từ AnalysisEngineAPI, chỉ các bước gọi API được await.
+    """
+
+    @timed("discover")
+    async def discover_keywords(self, seed_keyword, region_code, mode):
+        params = self._build_discover_params(seed_keyword, region_code, mode)
+        search_results = await self.api.search(**params)
+        if not search_results: return []
+
+        video_ids = self._video_ids(search_results)
+        video_details = await self.api.get_video_details(video_ids)
+        return self._score_keywords(video_details)
+
+    @timed("discover")
+    async def discover_keywords_deep(self, seed_keyword, region_code, mode, max_pages, time_budget=None, quota_budget=None):
+        scorer = self.keyword_scorer()
+        async for _ in self.collect_discover_pages(scorer, seed_keyword, region_code, mode, max_pages, time_budget, quota_budget): pass
+        return scorer.result()
+
+    async def collect_discover_pages(self, scorer, seed_keyword, region_code, mode, max_pages, time_budget=None, quota_budget=None):
+        """
+        Trang kế tiếp của search.list được gọi ngay khi có nextPageToken, song song với lấy chi tiết video của trang hiện tại.
+        Trang đầu luôn được chờ đủ; các trang sau bị bỏ khi hết thời gian của request.
+        """
+        budget = PageBudget(max_pages, time_budget, quota_budget, getattr(self.api, 'key_pool', None))
+        params = self._build_discover_params(seed_keyword, region_code, mode)
+        seen = set()
+        budget.request_page()
+        next_page = asyncio.ensure_future(self.api.search_page(**params))
+        try:
+            while next_page is not None:
+                page, next_page = next_page, None
+                first = budget.pages_done == 0
+                try:
+                    items, page_token = await (page if first else asyncio.wait_for(page, budget.remaining_time()))
+                    if not page_token: budget.stop_reason = "last_page"
+                    elif budget.allows_next_page():
+                        budget.request_page()
+                        next_page = asyncio.ensure_future(self.api.search_page(**params, pageToken=page_token))
+                    video_ids = self._new_video_ids(items, seen)
+                    details = self.api.get_video_details(video_ids) if video_ids else asyncio.sleep(0, [])
+                    details = await (details if first else asyncio.wait_for(details, budget.remaining_time()))
+                except asyncio.TimeoutError:
+                    budget.stop_reason = "time_budget"
+                    yield budget.progress(scorer, True)
+                    return
+                with span("score"):
+                    scorer.add(details)
+                budget.page_done(len(video_ids))
+                yield budget.progress(scorer, next_page is None)
+        finally:
+            if next_page is not None: next_page.cancel()
+
+    async def full_analysis_for_keyword(self, keyword, region_code):
+        logging.info(f'full_analysis_for_keyword (async) keyword: {keyword}, region_code: {region_code}')
+        # Chỉ competition phụ thuộc vào demand; các nhánh còn lại chạy song song
+        stages = await self._run_stages({
+            'demand': ((), lambda: self._calculate_demand(keyword, region_code, 30)),
+            'supply': ((), lambda: self._calculate_supply(keyword, region_code, 30)),
+            'competition': (('demand',), lambda demand_30d: self._calculate_advanced_competition(demand_30d['video_details'])),
+            'competitors': ((), lambda: self.find_competitors(keyword, region_code, limit=5)),
+        })
+        return self._build_full_analysis_result(keyword, stages['demand'], stages['supply'], stages['competition'], stages['competitors'])
+
+    async def stream_full_analysis_for_keyword(self, keyword, region_code):
+        """
+        Như full_analysis_for_keyword nhưng trả ra (sự kiện, data) ngay khi từng bước xong:
+        "demand", "supply", "competition" (kèm opportunity_score), "competitor" cho từng đối thủ
+        (index là vị trí trong danh sách cuối cùng), cuối cùng "result" giống hệt full_analysis_for_keyword.
+        """
+        events = asyncio.Queue()
+
+        async def demand():
+            demand_30d = await self._calculate_demand(keyword, region_code, 30)
+            events.put_nowait(("demand", {"keyword": keyword, "demand_score": demand_30d['score'], "total_views": demand_30d['total_views']}))
+            return demand_30d
+
+        async def supply():
+            supply_30d = await self._calculate_supply(keyword, region_code, 30)
+            events.put_nowait(("supply", {"keyword": keyword, "supply_score": supply_30d['score']}))
+            return supply_30d
+
+        async def competition(demand_30d):
+            metrics = await self._calculate_advanced_competition(demand_30d['video_details'])
+            events.put_nowait(("competition", {
+                "keyword": keyword, "avg_views": metrics['avg_views'], "avg_engagement_rate": metrics['avg_engagement_rate'],
+                "competition_score": metrics['score'], "opportunity_score": self._opportunity_score(keyword, demand_30d, metrics),
+            }))
+            return metrics
+
+        async def attach(index, channel):
+            competitor = await self._attach_top_video(channel)
+            events.put_nowait(("competitor", {"index": index, "competitor": competitor}))
+            return competitor
+
+        async def competitors():
+            with span("competitors"):
+                channel_details = await self._competitor_channels(keyword, region_code, 5)
+                return list(await asyncio.gather(*(attach(index, channel) for index, channel in enumerate(channel_details))))
+
+        stages = asyncio.ensure_future(self._run_stages({
+            'demand': ((), demand),
+            'supply': ((), supply),
+            'competition': (('demand',), competition),
+            'competitors': ((), competitors),
+        }))
+        try:
+            async for event in drain_queue(events, stages):
+                yield event
+        finally:
+            stages.cancel()
+        result = stages.result()
+        yield "result", self._build_full_analysis_result(keyword, result['demand'], result['supply'], result['competition'], result['competitors'])
+
+    async def stream_discover_keywords_deep(self, seed_keyword, region_code, mode, max_pages, time_budget=None, quota_budget=None):
+        """
+        Bảng xếp hạng tạm thời sau mỗi trang ("ranking": tiến độ + keywords), cuối cùng "result" giống discover_keywords_deep.
+        """
+        scorer = self.keyword_scorer()
+        async for progress in self.collect_discover_pages(scorer, seed_keyword, region_code, mode, max_pages, time_budget, quota_budget):
+            if not progress["done"]:
+                yield "ranking", dict(progress, keywords=scorer.result())
+        yield "result", scorer.result()
+
+    async def _run_stages(self, stages):
+        """
+        Chạy các bước theo đồ thị phụ thuộc: stages = {tên: (các bước phụ thuộc, hàm tạo coroutine)}.
+        Mỗi bước bắt đầu ngay khi các bước nó phụ thuộc hoàn thành; các bước phải được khai báo sau bước phụ thuộc.
+        """
+        tasks = {}
+
+        async def run_stage(deps, factory):
+            inputs = [await tasks[dep] for dep in deps]
+            return await factory(*inputs)
+
+        for name, (deps, factory) in stages.items():
+            tasks[name] = asyncio.ensure_future(run_stage(deps, factory))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        return {name: task.result() for name, task in tasks.items()}
+
+    @timed("competitors")
+    async def find_competitors(self, keyword, region_code, limit=20):
+        logging.info(f'find_competitors (async) keyword limit {limit}: {keyword}, region_code: {region_code}')
+        channel_details = await self._competitor_channels(keyword, region_code, limit)
+        # Tìm video nổi bật của các kênh mới song song
+        return list(await asyncio.gather(*(self._attach_top_video(channel) for channel in channel_details)))
+
+    async def _competitor_channels(self, keyword, region_code, limit):
+        videos = await self.api.search(**self._build_competitor_params(keyword, region_code))
+        if not videos: return []
+
+        top_channel_ids = self._top_channel_ids(videos, limit)
+        if not top_channel_ids: return []
+
+        return self._order_channels(await self.api.get_channel_details(top_channel_ids), top_channel_ids)
+
+    async def _attach_top_video(self, channel):
+        top_video = self.top_video_cache.get(channel['id'])
+        if top_video is None:
+            logging.info(f"Finding top video for new channel: {channel['snippet']['title']}")
+            with span("top_video"):
+                top_video_search = await self.api.search(**self._build_top_video_params(channel['id']))
+                top_video_details = await self.api.get_video_details([top_video_search[0]['id']['videoId']]) if top_video_search else []
+            top_video = self._remember_top_video(channel['id'], top_video_search, top_video_details)
+        return self._with_top_video(channel, top_video)
+
+    @timed("demand")
+    async def _calculate_demand(self, keyword, region_code, timeframe_days, limit=50):
+        videos = await self.api.search(**self._build_demand_params(keyword, region_code, timeframe_days, limit))
+        if not videos: return {'score': 0, 'total_views': 0, 'video_details': []}
+        video_details = await self.api.get_video_details(self._video_ids(videos))
+        return self._demand_from_details(video_details)
+
+    @timed("supply")
+    async def _calculate_supply(self, keyword, region_code, timeframe_days, limit=50):
+        videos = await self.api.search(**self._build_supply_params(keyword, region_code, timeframe_days, limit))
+        return {'score': len(videos)}
+
+    @timed("competition")
+    async def _calculate_advanced_competition(self, video_details_list):
+        if not video_details_list:
+            return {'score': 1, 'avg_views': 0, 'avg_engagement_rate': 0}
+
+        unique_channel_ids = list(set(v['snippet']['channelId'] for v in video_details_list))
+        channel_details = await self.api.get_channel_details(unique_channel_ids)
+        return self._competition_from_details(video_details_list, unique_channel_ids, channel_details)
+
+    @timed("competitor_m4")
+    async def analyze_competitor_for_m4(self, channel_id, market_keywords):
+        logging.info(f'analyze_competitor_for_m4 (async) channel_id: {channel_id}, market_keywords: {market_keywords}')
+        # Thông tin kênh và danh sách video gần nhất không phụ thuộc nhau
+        channel_details_list, recent_videos_search = await asyncio.gather(
+            self.api.get_channel_details([channel_id]),
+            self.api.search(**self._build_recent_videos_params(channel_id)),
+        )
+        if not channel_details_list:
+            return {"error": "Không thể lấy thông tin kênh."}
+        analysis_result = self._build_channel_summary(channel_details_list[0])
+
+        if not recent_videos_search:
+            return {"error": "Kênh không có video nào gần đây để phân tích."}
+
+        video_details_list = await self.api.get_video_details(self._video_ids(recent_videos_search))
+        if not video_details_list:
+            return {"error": "Không thể lấy chi tiết các video của kênh."}
+
+        return self._build_competitor_analysis(analysis_result, video_details_list, market_keywords)
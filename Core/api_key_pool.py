@@ -0,0 +1,178 @@
+# Core/api_key_pool.py
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import metrics
+
+# Quota của YouTube Data API được reset lúc nửa đêm giờ Thái Bình Dương
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+# Chi phí quota (unit) của từng method mà hệ thống dùng
+QUOTA_COSTS = {"search": 100, "videos": 1, "channels": 1}
+QUOTA_REASONS = ("quotaExceeded", "dailyLimitExceeded")
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+INVALID_KEY_REASONS = ("keyInvalid", "keyExpired", "accessNotConfigured", "ipRefererBlocked")
+
+YOUTUBE_CALLS = metrics.Counter("youtube_api_calls_total", "Số lượt gọi YouTube Data API theo method và key.", ["method", "key"])
+YOUTUBE_QUOTA_UNITS = metrics.Counter("youtube_quota_units_total", "Số unit quota ước tính đã dùng theo method và key.", ["method", "key"])
+YOUTUBE_KEY_ROTATIONS = metrics.Counter("youtube_key_rotations_total", "Số lần chuyển sang key khác sau lỗi quota/rate limit/key hỏng.", ["reason"])
+
+class ApiKeyPool:
+    """
+    Pool API key dùng chung (an toàn đa luồng) cho ApiManager và AsyncYoutubeClient.
+    - Ước tính số unit quota đã dùng của từng key theo chi phí thật của từng method.
+    - Chia các request song song cho key còn khỏe, ít request đang chạy và ít quota đã dùng nhất.
+    - Key hết quota (hoặc không hợp lệ) bị tạm ngưng đến lần reset quota lúc nửa đêm giờ Pacific.
+    - Cảnh báo khi tổng quota còn lại xuống dưới ngưỡng.
+    """
+    def __init__(self, api_keys: list, daily_quota: int = None, low_watermark: float = None):
+        if not api_keys: raise ValueError("Danh sách API keys không được để trống.")
+        self.api_keys = api_keys
+        self.daily_quota = daily_quota or int(os.getenv("YOUTUBE_DAILY_QUOTA", "10000"))
+        self.low_watermark = low_watermark if low_watermark is not None else float(os.getenv("YOUTUBE_QUOTA_LOW_WATERMARK", "0.1"))
+        self._lock = threading.Lock()
+        self.quota_day = self._quota_day()
+        self._keys = [self._new_key_state() for _ in api_keys]
+        self._low_budget_warned = False
+
+    def _new_key_state(self):
+        return {"units_used": 0, "in_flight": 0, "calls": 0, "errors": 0, "parked_until": None, "park_reason": None}
+
+    def _quota_day(self):
+        return datetime.now(QUOTA_TIMEZONE).date()
+
+    def _next_reset(self):
+        return datetime.combine(self._quota_day() + timedelta(days=1), datetime.min.time(), tzinfo=QUOTA_TIMEZONE)
+
+    def _roll_day(self):
+        # Sang ngày quota mới: xóa số liệu ước tính và mở lại các key bị tạm ngưng
+        today = self._quota_day()
+        if today != self.quota_day:
+            logging.info(f"Quota YouTube đã reset cho ngày {today}, mở lại toàn bộ {len(self.api_keys)} key.")
+            self.quota_day = today
+            self._keys = [self._new_key_state() for _ in self.api_keys]
+            self._low_budget_warned = False
+
+    def _is_available(self, state, cost):
+        return state["parked_until"] is None and state["units_used"] + cost <= self.daily_quota
+
+    def acquire(self, method: str, exclude=()):
+        """
+        Chọn một key cho method (search/videos/channels) và giữ trước chi phí quota của nó.
+        Trả về index của key, hoặc None nếu không còn key nào dùng được.
+        """
+        cost = QUOTA_COSTS.get(method, 1)
+        with self._lock:
+            self._roll_day()
+            candidates = [i for i, state in enumerate(self._keys) if i not in exclude and self._is_available(state, cost)]
+            if not candidates:
+                return None
+            key_index = min(candidates, key=lambda i: (self._keys[i]["in_flight"], self._keys[i]["units_used"]))
+            state = self._keys[key_index]
+            state["units_used"] += cost
+            state["in_flight"] += 1
+            state["calls"] += 1
+            self._check_low_budget()
+        YOUTUBE_CALLS.inc(method, str(key_index))
+        YOUTUBE_QUOTA_UNITS.add(cost, method, str(key_index))
+        return key_index
+
+    def release(self, key_index: int):
+        with self._lock:
+            self._keys[key_index]["in_flight"] = max(0, self._keys[key_index]["in_flight"] - 1)
+
+    def report_error(self, key_index: int, status: int, content=None):
+        """
+        Ghi nhận lỗi HTTP của một key. Trả về True nếu nên thử lại với key khác.
+        """
+        reason = self.error_reason(content)
+        retry = self._report_error(key_index, status, reason, content)
+        if retry:
+            YOUTUBE_KEY_ROTATIONS.inc(reason or str(status))
+        return retry
+
+    def _report_error(self, key_index, status, reason, content):
+        with self._lock:
+            state = self._keys[key_index]
+            state["errors"] += 1
+            if status == 403 and reason in QUOTA_REASONS:
+                self._park(key_index, reason)
+                state["units_used"] = self.daily_quota
+                return True
+            if reason in INVALID_KEY_REASONS or (status == 400 and "API key not valid" in self._as_text(content)):
+                self._park(key_index, reason or "invalid")
+                return True
+            if status in (403, 429) and reason in RATE_LIMIT_REASONS:
+                return True
+            return False
+
+    def _park(self, key_index, reason):
+        state = self._keys[key_index]
+        if state["parked_until"] is None:
+            state["parked_until"] = self._next_reset()
+            state["park_reason"] = reason
+            logging.warning(f"Tạm ngưng API Key index {key_index} ({reason}) đến {state['parked_until'].isoformat()}.")
+        self._check_low_budget()
+
+    def _check_low_budget(self):
+        remaining = self._remaining_units()
+        if not self._low_budget_warned and remaining <= self.daily_quota * len(self.api_keys) * self.low_watermark:
+            self._low_budget_warned = True
+            logging.warning(f"Pool API key sắp cạn quota: còn khoảng {remaining} unit ({remaining // QUOTA_COSTS['search']} lượt search).")
+
+    def low_budget(self):
+        """
+        True khi tổng quota còn lại đã xuống dưới ngưỡng cảnh báo: các lượt gọi tùy chọn (ví dụ trang kết quả thêm) nên dừng.
+        """
+        with self._lock:
+            self._roll_day()
+            return self._remaining_units() <= self.daily_quota * len(self.api_keys) * self.low_watermark
+
+    def _remaining_units(self):
+        return sum(max(0, self.daily_quota - state["units_used"]) for state in self._keys if state["parked_until"] is None)
+
+    @staticmethod
+    def _as_text(content):
+        if isinstance(content, bytes):
+            return content.decode("utf-8", errors="replace")
+        return content or ""
+
+    @classmethod
+    def error_reason(cls, content):
+        """
+        Lấy reason (quotaExceeded, rateLimitExceeded, keyInvalid...) từ body lỗi của Google API.
+        """
+        if not content:
+            return None
+        try:
+            errors = json.loads(cls._as_text(content)).get("error", {}).get("errors", [])
+            return errors[0].get("reason") if errors else None
+        except (ValueError, AttributeError):
+            return None
+
+    def stats(self):
+        with self._lock:
+            self._roll_day()
+            remaining = self._remaining_units()
+            return {
+                "quota_day": self.quota_day.isoformat(),
+                "daily_quota_per_key": self.daily_quota,
+                "remaining_units": remaining,
+                "remaining_searches": remaining // QUOTA_COSTS["search"],
+                "low_budget": remaining <= self.daily_quota * len(self.api_keys) * self.low_watermark,
+                "keys": [
+                    {
+                        "index": i,
+                        "units_used": state["units_used"],
+                        "in_flight": state["in_flight"],
+                        "calls": state["calls"],
+                        "errors": state["errors"],
+                        "parked_until": state["parked_until"].isoformat() if state["parked_until"] else None,
+                        "park_reason": state["park_reason"],
+                    }
+                    for i, state in enumerate(self._keys)
+                ],
+            }
@@ -0,0 +1,160 @@
+# Core/entity_cache.py
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class EntityCache:
+    """
+    Cache LRU có giới hạn kích thước cho bản ghi video/kênh của YouTube, khóa theo ID.
+    Mỗi bản ghi có hai mốc làm mới riêng:
+    - snippet/contentDetails (ít thay đổi) sống lâu: snippet_ttl;
+    - statistics (view, like, subscriber...) sống ngắn: statistics_ttl, hết hạn thì chỉ tải lại part=statistics.
+    Bản ghi trả về được dùng chung giữa các request, không được sửa trực tiếp.
+    """
+    def __init__(self, name: str, max_entries: int = None, snippet_ttl: float = None, statistics_ttl: float = None):
+        env_name = name.upper()
+        self.name = name
+        self.max_entries = max_entries or int(os.getenv(f"{env_name}_CACHE_MAX_ENTRIES", "10000"))
+        self.snippet_ttl = snippet_ttl or float(os.getenv(f"{env_name}_CACHE_SNIPPET_TTL", "86400"))
+        self.statistics_ttl = statistics_ttl or float(os.getenv(f"{env_name}_CACHE_STATISTICS_TTL", "900"))
+        self._entries = OrderedDict()  # id -> [record, snippet_fetched_at, statistics_fetched_at]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_statistics = 0
+        self.evictions = 0
+
+    def _plan(self, ids):
+        """
+        Chia danh sách ID thành: bản ghi còn mới, ID chưa có (tải đầy đủ), ID chỉ cần làm mới statistics.
+        """
+        now = time.monotonic()
+        found, missing, stale = {}, [], []
+        with self._lock:
+            for entity_id in dict.fromkeys(ids):
+                entry = self._entries.get(entity_id)
+                if entry is None or now - entry[1] > self.snippet_ttl:
+                    missing.append(entity_id)
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(entity_id)
+                found[entity_id] = entry[0]
+                if now - entry[2] > self.statistics_ttl:
+                    stale.append(entity_id)
+                    self.stale_statistics += 1
+                else:
+                    self.hits += 1
+        return found, missing, stale
+
+    def put_many(self, records):
+        now = time.monotonic()
+        with self._lock:
+            for record in records:
+                self._entries[record['id']] = [record, now, now]
+                self._entries.move_to_end(record['id'])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def update_statistics(self, records):
+        now = time.monotonic()
+        updated = {}
+        with self._lock:
+            for record in records:
+                entry = self._entries.get(record['id'])
+                if entry is None:
+                    continue
+                entry[0] = dict(entry[0], statistics=record.get('statistics', {}))
+                entry[2] = now
+                updated[record['id']] = entry[0]
+        return updated
+
+    def _collect(self, ids, found):
+        return [found[entity_id] for entity_id in dict.fromkeys(ids) if entity_id in found]
+
+    def get_many(self, ids, fetch, fetch_statistics):
+        """
+        Lấy bản ghi theo danh sách ID (giữ thứ tự), chỉ gọi API cho các ID thiếu hoặc đã cũ.
+        fetch(ids) tải bản ghi đầy đủ, fetch_statistics(ids) chỉ tải part=statistics.
+        """
+        found, missing, stale = self._plan(ids)
+        if missing:
+            records = fetch(missing)
+            self.put_many(records)
+            found.update((record['id'], record) for record in records)
+        if stale:
+            # Lỗi khi làm mới thì vẫn trả bản ghi cũ
+            found.update(self.update_statistics(fetch_statistics(stale)))
+        return self._collect(ids, found)
+
+    async def aget_many(self, ids, fetch, fetch_statistics):
+        """
+        Giống get_many nhưng fetch/fetch_statistics là coroutine function.
+        """
+        found, missing, stale = self._plan(ids)
+
+        async def fetch_missing():
+            records = await fetch(missing) if missing else []
+            self.put_many(records)
+            found.update((record['id'], record) for record in records)
+
+        async def refresh_stale():
+            if stale:
+                found.update(self.update_statistics(await fetch_statistics(stale)))
+
+        await asyncio.gather(fetch_missing(), refresh_stale())
+        return self._collect(ids, found)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.stale_statistics
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_statistics": self.stale_statistics,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0,
+        }
+
+class TTLCache:
+    """
+    Cache LRU + TTL đơn giản cho giá trị bất kỳ (ví dụ video nổi bật của một kênh).
+    """
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "misses": self.misses}
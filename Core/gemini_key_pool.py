@@ -0,0 +1,168 @@
+# Core/gemini_key_pool.py
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import metrics
+
+# Lỗi tạm thời: key nghỉ theo backoff lũy thừa có jitter rồi được dùng lại
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+# Key không dùng được cho Gemini (sai key, chưa bật Generative Language API...): tạm ngưng lâu
+INVALID_KEY_STATUSES = (401, 403)
+INVALID_KEY_REASONS = ("API_KEY_INVALID", "API_KEY_SERVICE_BLOCKED", "SERVICE_DISABLED")
+
+GEMINI_KEY_CALLS = metrics.Counter("gemini_key_calls_total", "Số lượt gọi Gemini theo key.", ["key"])
+GEMINI_KEY_BACKOFFS = metrics.Counter("gemini_key_backoffs_total", "Số lần một key Gemini bị cho nghỉ hoặc tạm ngưng, theo lý do.", ["reason"])
+
+class GeminiKeyPool:
+    """
+    Pool API key Gemini (an toàn đa luồng) cho GeminiManager, thay cho genai.configure dùng một key toàn cục.
+    - Mỗi key có token bucket riêng: rpm lượt/phút, tối đa burst lượt liền nhau (GEMINI_KEY_RPM, GEMINI_KEY_BURST).
+    - Chia request cho key khỏe, ít request đang chạy và còn nhiều token nhất.
+    - 429/5xx/lỗi kết nối: key nghỉ theo backoff lũy thừa có jitter (GEMINI_BACKOFF_BASE, GEMINI_BACKOFF_MAX),
+      thành công thì xóa số lần lỗi liên tiếp.
+    - Key hỏng hoặc không có quyền (401/403, API_KEY_INVALID): tạm ngưng GEMINI_KEY_PARK_SECONDS giây.
+    """
+    def __init__(self, api_keys: list, rpm: float = None, burst: float = None, backoff_base: float = None, backoff_max: float = None,
+                 park_seconds: float = None):
+        if not api_keys: raise ValueError("Danh sách Gemini API keys không được để trống.")
+        self.api_keys = api_keys
+        self.rate = (rpm or float(os.getenv("GEMINI_KEY_RPM", "15"))) / 60
+        self.burst = burst or float(os.getenv("GEMINI_KEY_BURST", "3"))
+        self.backoff_base = backoff_base or float(os.getenv("GEMINI_BACKOFF_BASE", "1"))
+        self.backoff_max = backoff_max or float(os.getenv("GEMINI_BACKOFF_MAX", "60"))
+        self.park_seconds = park_seconds or float(os.getenv("GEMINI_KEY_PARK_SECONDS", "3600"))
+        self._lock = threading.Lock()
+        now = time.monotonic()
+        self._keys = [{"tokens": self.burst, "refilled_at": now, "in_flight": 0, "calls": 0, "errors": 0, "failures": 0,
+                       "ready_at": 0.0, "parked_until": 0.0, "park_reason": None} for _ in api_keys]
+
+    def _refill(self, state, now):
+        state["tokens"] = min(self.burst, state["tokens"] + (now - state["refilled_at"]) * self.rate)
+        state["refilled_at"] = now
+
+    def _ready_at(self, state, now):
+        # Thời điểm sớm nhất key dùng được: hết nghỉ/tạm ngưng và có đủ một token
+        token_at = now if state["tokens"] >= 1 else now + (1 - state["tokens"]) / self.rate
+        return max(token_at, state["ready_at"], state["parked_until"])
+
+    def try_acquire(self):
+        """
+        Giữ một lượt gọi trên key tốt nhất đang sẵn sàng. Trả về (index của key, None),
+        hoặc (None, số giây cần chờ đến khi có key sẵn sàng).
+        """
+        with self._lock:
+            now = time.monotonic()
+            for state in self._keys:
+                self._refill(state, now)
+            ready = [i for i, state in enumerate(self._keys) if self._ready_at(state, now) <= now]
+            if not ready:
+                return None, min(self._ready_at(state, now) for state in self._keys) - now
+            key_index = min(ready, key=lambda i: (self._keys[i]["in_flight"], -self._keys[i]["tokens"]))
+            state = self._keys[key_index]
+            state["tokens"] -= 1
+            state["in_flight"] += 1
+            state["calls"] += 1
+        GEMINI_KEY_CALLS.inc(str(key_index))
+        return key_index, None
+
+    async def acquire(self, timeout: float):
+        """
+        Chờ (không chặn event loop) đến khi có key sẵn sàng, tối đa timeout giây. Trả về index của key hoặc None.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            key_index, wait = self.try_acquire()
+            if key_index is not None:
+                return key_index
+            if time.monotonic() + wait > deadline:
+                return None
+            await asyncio.sleep(wait)
+
+    def acquire_blocking(self, timeout: float):
+        """
+        Như acquire nhưng chờ bằng time.sleep, cho code đồng bộ.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            key_index, wait = self.try_acquire()
+            if key_index is not None:
+                return key_index
+            if time.monotonic() + wait > deadline:
+                return None
+            time.sleep(wait)
+
+    def release(self, key_index: int):
+        with self._lock:
+            self._keys[key_index]["in_flight"] = max(0, self._keys[key_index]["in_flight"] - 1)
+
+    def report_success(self, key_index: int):
+        with self._lock:
+            self._keys[key_index]["failures"] = 0
+
+    def report_error(self, key_index: int, status: int, content=None):
+        """
+        Ghi nhận lỗi của một key (status 0: lỗi kết nối/timeout). Trả về True nếu nên thử lại (với key khác hoặc sau khi nghỉ).
+        """
+        reason = self.error_reason(content)
+        with self._lock:
+            state = self._keys[key_index]
+            state["errors"] += 1
+            now = time.monotonic()
+            if status in INVALID_KEY_STATUSES or reason in INVALID_KEY_REASONS:
+                state["parked_until"] = now + self.park_seconds
+                state["park_reason"] = reason or str(status)
+                logging.warning(f"Tạm ngưng Gemini API key index {key_index} ({state['park_reason']}) trong {self.park_seconds:g} giây.")
+                label = "invalid"
+            elif status == 0 or status in TRANSIENT_STATUSES:
+                state["failures"] += 1
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (state["failures"] - 1)) * random.uniform(0.5, 1.0)
+                state["ready_at"] = now + delay
+                logging.warning(f"Gemini API key index {key_index} lỗi {status or 'kết nối'}, nghỉ {delay:.1f} giây (lần {state['failures']}).")
+                label = str(status) if status else "connection"
+            else:
+                return False
+        GEMINI_KEY_BACKOFFS.inc(label)
+        return True
+
+    @staticmethod
+    def error_reason(content):
+        """
+        Lấy reason (API_KEY_INVALID, SERVICE_DISABLED...) từ body lỗi của Gemini REST API.
+        """
+        if not content:
+            return None
+        try:
+            text = content.decode("utf-8", errors="replace") if isinstance(content, bytes) else content
+            details = json.loads(text).get("error", {}).get("details", [])
+            return next((detail["reason"] for detail in details if "reason" in detail), None)
+        except (ValueError, AttributeError, TypeError):
+            return None
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            keys = []
+            for i, state in enumerate(self._keys):
+                self._refill(state, now)
+                keys.append({
+                    "index": i,
+                    "tokens": round(state["tokens"], 2),
+                    "in_flight": state["in_flight"],
+                    "calls": state["calls"],
+                    "errors": state["errors"],
+                    "consecutive_failures": state["failures"],
+                    "backoff_seconds": round(max(0.0, state["ready_at"] - now), 1),
+                    "parked_seconds": round(max(0.0, state["parked_until"] - now), 1),
+                    "park_reason": state["park_reason"] if state["parked_until"] > now else None,
+                })
+            return {
+                "rpm_per_key": round(self.rate * 60, 2),
+                "burst": self.burst,
+                "healthy_keys": sum(1 for key in keys if not key["parked_seconds"] and not key["backoff_seconds"]),
+                "keys": keys,
+            }
@@ -1,25 +1,44 @@
 # Core/gemini_manager.py
-import google.generativeai as genai
+import asyncio
+import json
 import logging
+import os
+import time
+from contextlib import aclosing
 
-class GeminiManager:
-    def __init__(self, api_key):
-        if not api_key:
-            raise ValueError("Gemini API key is required.")
-        self.api_key = api_key
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-flash') # Sử dụng model Flash cho tốc độ và hiệu quả
-        logging.info("Gemini Manager initialized.")
+import httpx
 
-    def get_overtake_plan(self, competitor_data, market_keywords):
-        """
-        Gửi prompt đến Gemini AI để lấy về kế hoạch vượt mặt đối thủ.
-        """
-        try:
-            logging.info(f"Generating Gemini overtake plan for channel: {competitor_data.get('channel_title')}")
-            
-            # Xây dựng một prompt chi tiết và rõ ràng
-            prompt = f"""
+import metrics
+from Core.gemini_key_pool import GeminiKeyPool
+
+GEMINI_LATENCY = metrics.Histogram("gemini_request_duration_seconds", "Thời gian gọi Gemini generate_content.", ["operation"], buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120))
+GEMINI_ERRORS = metrics.Counter("gemini_errors_total", "Số lượt gọi Gemini lỗi theo loại exception.", ["operation", "error"])
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash") # Sử dụng model Flash cho tốc độ và hiệu quả
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta"
+
+class GeminiError(Exception):
+    """
+    Lỗi khi gọi Gemini REST API: status_code là status HTTP của Gemini, 502 nếu lỗi kết nối, 504 nếu quá thời gian,
+    503 nếu không còn key nào sẵn sàng.
+    """
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+# Các trường của competitor_data đi vào prompt; đổi nội dung prompt thì tăng OVERTAKE_PROMPT_VERSION để bỏ cache cũ (plan_cache)
+OVERTAKE_PROMPT_FIELDS = ("channel_title", "subs_count", "video_count", "published_at", "upload_frequency_text", "videos_per_week",
+                          "avg_views", "engagement_text", "engagement_rate", "avg_duration_text", "content_gaps")
+OVERTAKE_PROMPT_VERSION = 1
+
+def overtake_plan_error(e):
+    return f"LỖI: Không thể kết nối hoặc xử lý yêu cầu từ Gemini AI. Chi tiết: {e}"
+
+def build_overtake_prompt(competitor_data, market_keywords):
+    """
+    Prompt kế hoạch vượt mặt đối thủ, dùng chung cho bản đồng bộ và bản stream.
+    """
+    return f"""
             Bạn là một chuyên gia chiến lược YouTube hàng đầu với 10 năm kinh nghiệm.
             Dựa trên các dữ liệu phân tích chi tiết về đối thủ cạnh tranh và thị trường dưới đây, hãy đưa ra một kế hoạch hành động TOÀN DIỆN và CỤ THỂ để một kênh YouTube mới có thể vượt mặt họ.
 
@@ -54,10 +73,188 @@ class GeminiManager:
             5.  **Lời khuyên đặc biệt:** Một lời khuyên "đắt giá" để tạo ra sự đột phá so với đối thủ này.
             """
 
-            response = self.model.generate_content(prompt)
+def _response_text(response):
+    """
+    Văn bản trong một response (hoặc một đoạn stream) của generateContent.
+    """
+    block_reason = response.get("promptFeedback", {}).get("blockReason")
+    if block_reason:
+        raise GeminiError(400, f"Gemini từ chối prompt: {block_reason}")
+    candidates = response.get("candidates") or [{}]
+    return "".join(part.get("text", "") for part in candidates[0].get("content", {}).get("parts", []))
+
+def _chunk_text(line):
+    """
+    Văn bản trong một dòng SSE của streamGenerateContent ("data: {...}"), chuỗi rỗng nếu dòng không có nội dung.
+    """
+    if not line.startswith("data:"):
+        return ""
+    return _response_text(json.loads(line[5:]))
+
+def _response_error(status, content):
+    detail = content.decode("utf-8", "replace") if isinstance(content, bytes) else str(content)
+    return GeminiError(status, f"Gemini trả về {status}: {detail[:500]}")
+
+NO_KEY_AVAILABLE = "Không còn Gemini API key nào sẵn sàng (đang bị giới hạn hoặc tạm ngưng)"
+
+class GeminiManager:
+    """
+    Gọi Gemini qua REST API (httpx), mỗi lượt gọi lấy một key từ GeminiKeyPool (không dùng genai.configure toàn cục).
+    Lỗi 429/5xx/kết nối được thử lại tối đa max_attempts lượt (GEMINI_MAX_ATTEMPTS) trong hạn timeout của request.
+    """
+    def __init__(self, api_keys, key_pool: GeminiKeyPool = None, timeout=None, base_url=None, transport=None, max_attempts=None):
+        if isinstance(api_keys, str):
+            api_keys = [api_keys]
+        if not api_keys:
+            raise ValueError("Gemini API key is required.")
+        self.api_keys = api_keys
+        self.key_pool = key_pool or GeminiKeyPool(api_keys)
+        self.model_name = GEMINI_MODEL
+        # timeout (giây) tính cho cả lượt sinh nội dung, kể cả thời gian chờ key và các lượt thử lại
+        self.timeout = timeout if timeout is not None else float(os.getenv("GEMINI_TIMEOUT", "60"))
+        self.max_attempts = max_attempts or int(os.getenv("GEMINI_MAX_ATTEMPTS", "4"))
+        self.base_url = (base_url or GEMINI_API_URL).rstrip("/")
+        self.transport = transport
+        self._client = None
+        logging.info(f"Gemini Manager initialized with {len(api_keys)} key(s).")
+
+    def _http_timeout(self):
+        return httpx.Timeout(self.timeout, connect=10.0)
+
+    def _get_client(self):
+        # Tạo lười để client được gắn với event loop đang chạy của uvicorn
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self._http_timeout(), transport=self.transport)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _request_args(self, key_index, prompt):
+        return {"headers": {"x-goog-api-key": self.api_keys[key_index]}, "json": {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}}
+
+    def get_overtake_plan(self, competitor_data, market_keywords):
+        """
+        Gửi prompt đến Gemini AI để lấy về kế hoạch vượt mặt đối thủ.
+        """
+        try:
+            logging.info(f"Generating Gemini overtake plan for channel: {competitor_data.get('channel_title')}")
+            
+            # Xây dựng một prompt chi tiết và rõ ràng
+            prompt = build_overtake_prompt(competitor_data, market_keywords)
+
+            started = time.perf_counter()
+            try:
+                text = self._generate_blocking(prompt)
+            finally:
+                GEMINI_LATENCY.observe(time.perf_counter() - started, "overtake_plan")
             logging.info("Successfully received response from Gemini.")
-            return response.text
+            return text
 
         except Exception as e:
+            GEMINI_ERRORS.inc("overtake_plan", type(e.__cause__ or e).__name__)
             logging.error(f"Error calling Gemini API: {e}", exc_info=True)
-            return f"LỖI: Không thể kết nối hoặc xử lý yêu cầu từ Gemini AI. Chi tiết: {e}"
\ No newline at end of file
+            return overtake_plan_error(e)
+
+    def _generate_blocking(self, prompt):
+        """
+        generateContent (không stream) bằng httpx đồng bộ, cùng cách chọn key và thử lại như stream_overtake_plan.
+        """
+        deadline = time.monotonic() + self.timeout
+        transport = self.transport if isinstance(self.transport, httpx.BaseTransport) else None
+        with httpx.Client(base_url=self.base_url, timeout=self._http_timeout(), transport=transport) as client:
+            for attempt in range(1, self.max_attempts + 1):
+                key_index = self.key_pool.acquire_blocking(max(0.0, deadline - time.monotonic()))
+                if key_index is None:
+                    raise GeminiError(503, NO_KEY_AVAILABLE)
+                try:
+                    response = client.post(f"/models/{self.model_name}:generateContent", **self._request_args(key_index, prompt))
+                except httpx.TransportError as e:
+                    if self.key_pool.report_error(key_index, 0) and attempt < self.max_attempts and time.monotonic() < deadline:
+                        continue
+                    raise GeminiError(504 if isinstance(e, httpx.TimeoutException) else 502, f"Lỗi kết nối tới Gemini: {e!r}") from e
+                finally:
+                    self.key_pool.release(key_index)
+                if response.status_code == 200:
+                    self.key_pool.report_success(key_index)
+                    return _response_text(response.json())
+                if self.key_pool.report_error(key_index, response.status_code, response.content) and attempt < self.max_attempts:
+                    continue
+                raise _response_error(response.status_code, response.content)
+
+    async def stream_overtake_plan(self, competitor_data, market_keywords, prompt=None):
+        """
+        Bản bất đồng bộ của get_overtake_plan: trả ra từng đoạn văn bản ngay khi Gemini sinh ra (streamGenerateContent, SSE),
+        không chiếm thread pool. Quá self.timeout giây cho cả lượt thì ném GeminiError 504.
+        prompt: prompt đã dựng sẵn bằng build_overtake_prompt (caller kiểm tra input trước khi bắt đầu stream).
+        Lỗi 429/5xx/kết nối trước đoạn văn bản đầu tiên được thử lại với key khác (hoặc chờ key hết nghỉ).
+        Đóng generator (aclose, ví dụ client ngắt kết nối) sẽ đóng luôn kết nối tới Gemini.
+        """
+        started = time.perf_counter()
+        try:
+            logging.info(f"Streaming Gemini overtake plan for channel: {competitor_data.get('channel_title')}")
+            if prompt is None:
+                prompt = build_overtake_prompt(competitor_data, market_keywords)
+            deadline = time.monotonic() + self.timeout
+            for attempt in range(1, self.max_attempts + 1):
+                key_index = await self.key_pool.acquire(max(0.0, deadline - time.monotonic()))
+                if key_index is None:
+                    raise GeminiError(503, NO_KEY_AVAILABLE)
+                streamed = False
+                try:
+                    request = self._get_client().stream(
+                        "POST", f"/models/{self.model_name}:streamGenerateContent", params={"alt": "sse"}, **self._request_args(key_index, prompt),
+                    )
+                    async with request as response:
+                        if response.status_code != 200:
+                            content = await response.aread()
+                            if self.key_pool.report_error(key_index, response.status_code, content) and attempt < self.max_attempts:
+                                continue
+                            raise _response_error(response.status_code, content)
+                        async with aclosing(response.aiter_lines()) as lines:
+                            while True:
+                                try:
+                                    line = await asyncio.wait_for(lines.__anext__(), max(0.0, deadline - time.monotonic()))
+                                except StopAsyncIteration:
+                                    break
+                                text = _chunk_text(line)
+                                if text:
+                                    streamed = True
+                                    yield text
+                    self.key_pool.report_success(key_index)
+                    logging.info("Successfully streamed response from Gemini.")
+                    return
+                except asyncio.TimeoutError as e:
+                    raise GeminiError(504, f"Gemini không trả lời xong trong {self.timeout:g} giây") from e
+                except httpx.TransportError as e:
+                    if not streamed and self.key_pool.report_error(key_index, 0) and attempt < self.max_attempts and time.monotonic() < deadline:
+                        continue
+                    if isinstance(e, httpx.TimeoutException):
+                        raise GeminiError(504, f"Gemini không trả lời xong trong {self.timeout:g} giây") from e
+                    raise GeminiError(502, f"Lỗi kết nối tới Gemini: {e!r}") from e
+                finally:
+                    self.key_pool.release(key_index)
+        except Exception as e:
+            GEMINI_ERRORS.inc("overtake_plan_stream", type(e.__cause__ or e).__name__)
+            logging.error(f"Error streaming from Gemini API: {e}")
+            raise
+        finally:
+            GEMINI_LATENCY.observe(time.perf_counter() - started, "overtake_plan_stream")
+
+    async def agenerate_overtake_plan(self, competitor_data, market_keywords):
+        """
+        Toàn bộ kế hoạch từ stream_overtake_plan; lỗi được ném ra thay vì trả về chuỗi "LỖI: ...".
+        """
+        async with aclosing(self.stream_overtake_plan(competitor_data, market_keywords)) as chunks:
+            return "".join([chunk async for chunk in chunks])
+
+    async def aget_overtake_plan(self, competitor_data, market_keywords):
+        """
+        Như get_overtake_plan (cùng chuỗi "LỖI: ..." khi thất bại) nhưng chạy trên event loop qua stream_overtake_plan.
+        """
+        try:
+            return await self.agenerate_overtake_plan(competitor_data, market_keywords)
+        except Exception as e:
+            return overtake_plan_error(e)
\ No newline at end of file
@@ -0,0 +1,102 @@
+# Core/keyword_scorer.py
+import heapq
+import re
+from collections import Counter
+from itertools import chain, filterfalse, repeat
+from operator import add, itemgetter, mul
+
+# Tách từ tiêu đề: \w của re là Unicode nên giữ nguyên chữ tiếng Việt có dấu (dạng dựng sẵn), chỉ bỏ dấu câu/ký hiệu
+TITLE_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+BANNED_KEYWORD_CHARS = frozenset('|\\/#*[]"')
+KEYWORD_CANDIDATES = 300
+MAX_KEYWORDS = 150
+# Cơ số mã hóa n-gram, cố định để mã không đổi khi từ điển lớn dần qua nhiều trang (id phải nhỏ hơn cơ số)
+TOKEN_ID_BASE = 1 << 24
+
+class _TokenIds(dict):
+    """
+    Từ -> id (bắt đầu từ 1, theo thứ tự xuất hiện); từ mới được cấp id khi tra lần đầu.
+    """
+    def __missing__(self, word):
+        token_id = self[word] = len(self) + 1
+        return token_id
+
+def _title_ngrams(ids):
+    """
+    Mã số nguyên của mọi 2-gram, rồi 3-gram, rồi 4-gram của một tiêu đề (cùng thứ tự với cách ghép chuỗi cũ).
+    n-gram (a, b, c) được mã thành (a*base + b)*base + c; id >= 1 nên mã 2/3/4-gram nằm trong các khoảng
+    [base, base^2), [base^2, base^3), [base^3, base^4) rời nhau.
+    """
+    bigrams = list(map(add, map(mul, ids, repeat(TOKEN_ID_BASE)), ids[1:]))
+    trigrams = list(map(add, map(mul, bigrams, repeat(TOKEN_ID_BASE)), ids[2:]))
+    return chain(bigrams, trigrams, map(add, map(mul, trigrams, repeat(TOKEN_ID_BASE)), ids[3:]))
+
+class KeywordScorer:
+    """
+    Chấm điểm từ khóa của discover_keywords, cộng dồn được qua nhiều trang kết quả:
+    add(video_details) cho từng trang, result() bất cứ lúc nào cho bảng xếp hạng của toàn bộ video đã thêm
+    (giống hệt chấm một lần trên danh sách đã nối).
+    Từ trong tiêu đề được mã hóa thành số nguyên và n-gram được đếm bằng mã số; chuỗi từ khóa chỉ được
+    ghép cho tối đa KEYWORD_CANDIDATES ứng viên có điểm cao nhất.
+    """
+    def __init__(self, stop_words):
+        self._is_stop_word = stop_words.__contains__
+        self._token_ids = _TokenIds()
+        self.tag_counts, self.phrase_counts = Counter(), Counter()
+        self.video_count = 0
+
+    def add(self, video_details):
+        token_id = self._token_ids.__getitem__
+        all_tags, titles = [], []
+        for video in video_details:
+            # if stop_event.is_set(): return []
+            # videos.list trả tiêu đề trong snippet.title; 'title' ở gốc bản ghi chỉ là dự phòng
+            snippet = video.get('snippet', {}); tags = snippet.get('tags', []); title = (snippet.get('title') or video.get('title') or '').lower()
+            if tags: all_tags.extend([tag.lower() for tag in tags])
+            if title:
+                ids = list(map(token_id, filterfalse(self._is_stop_word, TITLE_PUNCTUATION_RE.sub('', title).split())))
+                if len(ids) > 1: titles.append(ids)
+        self.video_count += len(video_details)
+        self.tag_counts.update(all_tags)
+        if titles: self.phrase_counts.update(chain.from_iterable(map(_title_ngrams, titles)))
+
+    def result(self):
+        if self.phrase_counts:
+            # Tag trùng với một n-gram tiêu đề dùng chung mã số; thứ tự chèn (tag trước, n-gram sau) quyết định thứ tự khi hòa điểm
+            combined_scores = {self._tag_key(tag): count * 1.5 for tag, count in self.tag_counts.items()}
+            for key, count in self.phrase_counts.items():
+                combined_scores[key] = combined_scores.get(key, 0) + count
+            tokens = [None, *self._token_ids]
+        else:
+            combined_scores = {tag: count * 1.5 for tag, count in self.tag_counts.items()}
+
+        final_keywords = []
+        # nlargest giữ thứ tự chèn khi hòa điểm, giống Counter.most_common
+        for key, score in heapq.nlargest(KEYWORD_CANDIDATES, combined_scores.items(), key=itemgetter(1)):
+            if isinstance(key, int):
+                # n-gram 2-4 từ, không chứa ký tự bị loại (regex đã xóa): chỉ cần kiểm tra độ dài trước khi ghép chuỗi
+                words = []
+                while key: key, digit = divmod(key, TOKEN_ID_BASE); words.append(tokens[digit])
+                word_count = len(words); char_count = sum(map(len, words)) + word_count - 1
+                if char_count <= 5: continue
+                keyword = ' '.join(reversed(words))
+            else:
+                keyword = key; word_count = len(keyword.split()); char_count = len(keyword)
+                if not (1 < word_count < 7 and char_count > 5 and BANNED_KEYWORD_CHARS.isdisjoint(keyword)): continue
+            final_keywords.append({"keyword": keyword, "word_count": word_count, "char_count": char_count, "score": score})
+            if len(final_keywords) >= MAX_KEYWORDS: break
+        return final_keywords
+
+    def _tag_key(self, tag):
+        """
+        Khóa của một tag: mã số n-gram nếu tag trùng chuỗi với một n-gram tiêu đề có thể có, ngược lại chính chuỗi tag.
+        """
+        if ' ' not in tag: return tag
+        words = tag.split(' ')
+        if len(words) > 4: return tag
+        key = 0
+        for word in words:
+            word_id = self._token_ids.get(word)
+            if word_id is None: return tag
+            key = key * TOKEN_ID_BASE + word_id
+        return key
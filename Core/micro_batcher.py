@@ -0,0 +1,78 @@
+# Core/micro_batcher.py
+import asyncio
+import logging
+
+class MicroBatcher:
+    """
+    Gom các lượt tra cứu theo ID (videos.list, channels.list) từ nhiều request đồng thời trong một cửa sổ ngắn.
+    Các ID được khử trùng lặp, chia thành từng lô tối đa max_batch ID (giới hạn 50 của API),
+    các lô được gọi song song và mỗi caller chỉ nhận lại bản ghi của các ID mình hỏi.
+    """
+    def __init__(self, fetch, window: float = 0.005, max_batch: int = 50):
+        self.fetch = fetch  # coroutine function: fetch(ids) -> list bản ghi có field 'id'
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}  # id -> future, chờ lô kế tiếp
+        self._in_flight = {}  # id -> future, thuộc lô đang gọi API
+        self._timer = None
+        self.requested_ids = 0
+        self.fetched_ids = 0
+        self.batches = 0
+
+    async def load_many(self, ids):
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for entity_id in dict.fromkeys(ids):
+            self.requested_ids += 1
+            future = self._in_flight.get(entity_id) or self._pending.get(entity_id)
+            if future is None:
+                future = loop.create_future()
+                self._pending[entity_id] = future
+            futures[entity_id] = future
+
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._pending and self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        # shield: một caller bị hủy không được hủy future dùng chung với caller khác
+        results = await asyncio.gather(*(asyncio.shield(future) for future in futures.values()))
+        return [record for record in results if record is not None]
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, {}
+        self._in_flight.update(pending)
+        ids = list(pending)
+        for start in range(0, len(ids), self.max_batch):
+            chunk = ids[start:start + self.max_batch]
+            self.batches += 1
+            self.fetched_ids += len(chunk)
+            asyncio.ensure_future(self._run_batch(chunk, pending))
+
+    async def _run_batch(self, chunk, pending):
+        try:
+            records = await self.fetch(chunk)
+            by_id = {record['id']: record for record in records}
+            for entity_id in chunk:
+                if not pending[entity_id].done():
+                    pending[entity_id].set_result(by_id.get(entity_id))
+        except Exception as e:
+            logging.error(f"MicroBatcher: lỗi khi tải lô {len(chunk)} ID: {e}", exc_info=True)
+            for entity_id in chunk:
+                if not pending[entity_id].done():
+                    pending[entity_id].set_exception(e)
+        finally:
+            for entity_id in chunk:
+                if self._in_flight.get(entity_id) is pending[entity_id]:
+                    del self._in_flight[entity_id]
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requested_ids": self.requested_ids,
+            "fetched_ids": self.fetched_ids,
+            "avg_batch_size": round(self.fetched_ids / self.batches, 2) if self.batches else 0,
+        }
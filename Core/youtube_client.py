@@ -0,0 +1,109 @@
+# Core/youtube_client.py
+import logging
+import httpx
+from Core.api_key_pool import ApiKeyPool
+from Core.entity_cache import EntityCache
+from Core.micro_batcher import MicroBatcher
+
+class AsyncYoutubeClient:
+    """
+    Client bất đồng bộ cho YouTube Data API v3 (search.list, videos.list, channels.list).
+    Dùng chung một httpx.AsyncClient (pool kết nối keep-alive) để không chặn event loop của FastAPI.
+    Giao diện giống ApiManager nhưng các hàm đều là coroutine.
+    """
+    BASE_URL = "https://www.googleapis.com/youtube/v3"
+
+    def __init__(self, api_keys: list, key_pool: ApiKeyPool = None, video_cache: EntityCache = None, channel_cache: EntityCache = None,
+                 timeout=10.0, connect_timeout=5.0, max_connections=100, max_keepalive_connections=20, batch_window=0.005,
+                 transport=None, base_url: str = None):
+        if not api_keys: raise ValueError("Danh sách API keys không được để trống.")
+        self.api_keys = api_keys
+        self.key_pool = key_pool or ApiKeyPool(api_keys)
+        # Cache chi tiết video/kênh dùng chung (tùy chọn); None thì luôn gọi API
+        self.video_cache, self.channel_cache = video_cache, channel_cache
+        # Gom các lượt videos.list/channels.list đồng thời thành lô tối đa 50 ID; batch_window=0 thì không chờ gom
+        self.batch_window = batch_window
+        self._batchers = {}
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        # Core.youtube_transport.YoutubeTransport (ghi/phát lại) và base_url thay thế (stub server), chỉ dùng khi test tải
+        self.transport = transport
+        self.base_url = (base_url or self.BASE_URL).rstrip("/")
+        self._client = None
+
+    def _get_client(self):
+        # Tạo lười để client được gắn với event loop đang chạy của uvicorn
+        if self._client is None or self._client.is_closed:
+            transport = self.transport.async_transport() if self.transport else None
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits, transport=transport)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _list(self, resource, params, timeout=None):
+        """
+        Gọi {resource}.list và trả về danh sách items.
+        """
+        return (await self._request(resource, params, timeout)).get("items", [])
+
+    async def _request(self, resource, params, timeout=None):
+        """
+        Gọi {resource}.list và trả về toàn bộ response ({} nếu lỗi).
+        Key được lấy từ ApiKeyPool; chỉ thử key khác khi lỗi do quota/rate limit/key hỏng.
+        """
+        tried = set()
+        while True:
+            key_index = self.key_pool.acquire(resource, exclude=tried)
+            if key_index is None:
+                logging.error("Tất cả API keys có thể đã hết quota."); return {}
+            tried.add(key_index)
+            query = dict(params, key=self.api_keys[key_index])
+            try:
+                response = await self._get_client().get(f"/{resource}", params=query, timeout=timeout if timeout is not None else self.timeout)
+            except httpx.TimeoutException as e:
+                logging.error(f"Timeout khi gọi {resource}.list: {e}"); return {}
+            except httpx.HTTPError as e:
+                logging.error(f"Lỗi kết nối khi gọi {resource}.list: {e}", exc_info=True); return {}
+            finally:
+                self.key_pool.release(key_index)
+
+            if response.status_code == 200:
+                return response.json()
+            if self.key_pool.report_error(key_index, response.status_code, response.content):
+                continue
+            logging.error(f"Lỗi API khi gọi {resource}.list: {response.status_code} {response.text}"); return {}
+
+    async def search(self, timeout=None, **kwargs):
+        return await self._list("search", kwargs, timeout)
+
+    async def search_page(self, timeout=None, **kwargs):
+        """
+        Một trang search.list: (items, nextPageToken); nextPageToken là None ở trang cuối hoặc khi lỗi.
+        """
+        response = await self._request("search", kwargs, timeout)
+        return response.get("items", []), response.get("nextPageToken")
+
+    def _batcher(self, resource, part, timeout):
+        key = (resource, part, timeout)
+        if key not in self._batchers:
+            fetch = lambda ids: self._list(resource, {"part": part, "id": ",".join(ids)}, timeout)
+            self._batchers[key] = MicroBatcher(fetch, window=self.batch_window)
+        return self._batchers[key]
+
+    async def get_video_details(self, video_ids: list, timeout=None):
+        if not video_ids: return []
+        fetch = lambda ids, part="snippet,statistics,contentDetails": self._batcher("videos", part, timeout).load_many(ids)
+        if self.video_cache is None: return await fetch(video_ids)
+        return await self.video_cache.aget_many(video_ids, fetch, lambda ids: fetch(ids, part="statistics"))
+
+    async def get_channel_details(self, channel_ids: list, timeout=None):
+        if not channel_ids: return []
+        fetch = lambda ids, part="snippet,statistics": self._batcher("channels", part, timeout).load_many(ids)
+        if self.channel_cache is None: return await fetch(channel_ids)
+        return await self.channel_cache.aget_many(channel_ids, fetch, lambda ids: fetch(ids, part="statistics"))
+
+    def batch_stats(self):
+        return {f"{resource}:{part}": batcher.stats() for (resource, part, _), batcher in self._batchers.items()}
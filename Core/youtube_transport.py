@@ -0,0 +1,210 @@
+# Core/youtube_transport.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit, parse_qsl
+
+import httpx
+import httplib2
+
+# Tham số phụ thuộc thời điểm gọi (datetime.utcnow) hoặc bí mật, không đưa vào khóa bản ghi
+IGNORED_PARAMS = ("key", "publishedAfter", "publishedBefore", "alt", "prettyPrint")
+
+QUOTA_ERROR_BODY = json.dumps({"error": {"code": 403, "message": "The request cannot be completed because you have exceeded your quota.",
+                                         "errors": [{"reason": "quotaExceeded", "domain": "youtube.quota"}]}}).encode()
+SERVER_ERROR_BODY = json.dumps({"error": {"code": 503, "message": "The service is currently unavailable.",
+                                          "errors": [{"reason": "backendError", "domain": "global"}]}}).encode()
+NOT_RECORDED_BODY = json.dumps({"error": {"code": 404, "message": "No recorded response for this request.",
+                                          "errors": [{"reason": "notRecorded", "domain": "replay"}]}}).encode()
+
+def parse_request(url: str):
+    """
+    Tách (resource, params) từ URL của YouTube Data API: .../youtube/v3/search?part=...&q=...
+    """
+    parts = urlsplit(url)
+    return parts.path.rstrip("/").rsplit("/", 1)[-1], dict(parse_qsl(parts.query, keep_blank_values=True))
+
+class RecordingStore:
+    """
+    Lưu response của search.list/videos.list/channels.list trên đĩa: <directory>/<resource>/<md5 của params>.json.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def request_key(resource: str, params: dict):
+        stable = sorted((name, str(value)) for name, value in params.items() if name not in IGNORED_PARAMS)
+        return hashlib.md5(json.dumps([resource, stable], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _path(self, resource, params):
+        return os.path.join(self.directory, resource, f"{self.request_key(resource, params)}.json")
+
+    def load(self, resource: str, params: dict):
+        try:
+            with open(self._path(resource, params), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def save(self, resource: str, params: dict, body: bytes):
+        path = self._path(resource, params)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(body)
+
+class YoutubeReplayer:
+    """
+    Phát lại response đã ghi, kèm độ trễ giả lập và lỗi chèn ngẫu nhiên (403 quotaExceeded, 503).
+    fallback(resource, params) -> bytes | None: nguồn dữ liệu khi chưa có bản ghi (ví dụ loadtest.synthetic).
+    """
+    def __init__(self, store: RecordingStore, latency_ms: float = 0, jitter_ms: float = 0,
+                 quota_error_rate: float = 0, server_error_rate: float = 0, fallback=None, seed: int = None):
+        self.store = store
+        self.latency_ms, self.jitter_ms = latency_ms, jitter_ms
+        self.quota_error_rate, self.server_error_rate = quota_error_rate, server_error_rate
+        self.fallback = fallback
+        self._random = random.Random(seed)
+        self.stats_counters = {"replayed": 0, "fallback": 0, "not_recorded": 0, "quota_errors": 0, "server_errors": 0}
+
+    def delay(self):
+        return max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+    def respond(self, resource: str, params: dict):
+        """
+        Trả về (status, body) cho một lượt gọi {resource}.list.
+        """
+        roll = self._random.random()
+        if roll < self.quota_error_rate:
+            self.stats_counters["quota_errors"] += 1
+            return 403, QUOTA_ERROR_BODY
+        if roll < self.quota_error_rate + self.server_error_rate:
+            self.stats_counters["server_errors"] += 1
+            return 503, SERVER_ERROR_BODY
+        body = self.store.load(resource, params)
+        if body is not None:
+            self.stats_counters["replayed"] += 1
+            return 200, body
+        if self.fallback is not None:
+            body = self.fallback(resource, params)
+            if body is not None:
+                self.stats_counters["fallback"] += 1
+                return 200, body
+        self.stats_counters["not_recorded"] += 1
+        logging.warning(f"YoutubeReplayer: chưa có bản ghi cho {resource}.list {RecordingStore.request_key(resource, params)}")
+        return 404, NOT_RECORDED_BODY
+
+class ReplayAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    Transport httpx cho AsyncYoutubeClient: trả response từ YoutubeReplayer, không ra mạng.
+    """
+    def __init__(self, replayer: YoutubeReplayer):
+        self.replayer = replayer
+
+    async def handle_async_request(self, request):
+        resource, params = parse_request(str(request.url))
+        await asyncio.sleep(self.replayer.delay())
+        status, body = self.replayer.respond(resource, params)
+        return httpx.Response(status, content=body, headers={"content-type": "application/json; charset=UTF-8"}, request=request)
+
+class RecordingAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    Transport httpx gọi API thật và lưu các response 200 vào RecordingStore.
+    """
+    def __init__(self, store: RecordingStore, transport: httpx.AsyncBaseTransport = None):
+        self.store = store
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        response = await self.transport.handle_async_request(request)
+        if response.status_code == 200:
+            body = await response.aread()
+            resource, params = parse_request(str(request.url))
+            self.store.save(resource, params, body)
+            return httpx.Response(200, content=body, headers=response.headers, request=request)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+class ReplayHttp:
+    """
+    Đối tượng tương thích httplib2.Http cho googleapiclient (ApiManager): trả response từ YoutubeReplayer.
+    """
+    def __init__(self, replayer: YoutubeReplayer):
+        self.replayer = replayer
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        resource, params = parse_request(uri)
+        time.sleep(self.replayer.delay())
+        status, content = self.replayer.respond(resource, params)
+        return httplib2.Response({"status": str(status), "content-type": "application/json; charset=UTF-8"}), content
+
+class RecordingHttp:
+    """
+    Bọc httplib2.Http: gọi API thật và lưu các response 200 vào RecordingStore.
+    """
+    def __init__(self, store: RecordingStore):
+        self.store = store
+        self.http = httplib2.Http()
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        response, content = self.http.request(uri, method=method, body=body, headers=headers, redirections=redirections, connection_type=connection_type)
+        if response.status == 200:
+            resource, params = parse_request(uri)
+            self.store.save(resource, params, content)
+        return response, content
+
+class YoutubeTransport:
+    """
+    Chế độ transport cho cả ApiManager (http()) và AsyncYoutubeClient (async_transport()):
+    - "record": gọi API thật, ghi response xuống đĩa;
+    - "replay": phát lại từ đĩa (không tốn quota), có độ trễ và lỗi giả lập.
+    """
+    def __init__(self, mode: str, store: RecordingStore, replayer: YoutubeReplayer = None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"YOUTUBE_TRANSPORT không hợp lệ: {mode}")
+        self.mode = mode
+        self.store = store
+        self.replayer = replayer or YoutubeReplayer(store)
+
+    def http(self):
+        return RecordingHttp(self.store) if self.mode == "record" else ReplayHttp(self.replayer)
+
+    def async_transport(self):
+        return RecordingAsyncTransport(self.store) if self.mode == "record" else ReplayAsyncTransport(self.replayer)
+
+    def stats(self):
+        return {"mode": self.mode, "directory": self.store.directory, **(self.replayer.stats_counters if self.mode == "replay" else {})}
+
+    @classmethod
+    def from_env(cls):
+        """
+        YOUTUBE_TRANSPORT=record|replay (để trống: gọi API thật như bình thường), YOUTUBE_RECORDINGS_DIR,
+        YOUTUBE_REPLAY_LATENCY_MS, YOUTUBE_REPLAY_JITTER_MS, YOUTUBE_REPLAY_QUOTA_ERROR_RATE, YOUTUBE_REPLAY_SERVER_ERROR_RATE,
+        YOUTUBE_REPLAY_SYNTHETIC=1 (sinh dữ liệu giả khi chưa có bản ghi).
+        """
+        mode = os.getenv("YOUTUBE_TRANSPORT", "")
+        if not mode:
+            return None
+        store = RecordingStore(os.getenv("YOUTUBE_RECORDINGS_DIR", "recordings"))
+        fallback = None
+        if os.getenv("YOUTUBE_REPLAY_SYNTHETIC", "0") == "1":
+            from loadtest.synthetic import SyntheticYoutube
+            fallback = SyntheticYoutube().respond
+        replayer = YoutubeReplayer(
+            store,
+            latency_ms=float(os.getenv("YOUTUBE_REPLAY_LATENCY_MS", "0")),
+            jitter_ms=float(os.getenv("YOUTUBE_REPLAY_JITTER_MS", "0")),
+            quota_error_rate=float(os.getenv("YOUTUBE_REPLAY_QUOTA_ERROR_RATE", "0")),
+            server_error_rate=float(os.getenv("YOUTUBE_REPLAY_SERVER_ERROR_RATE", "0")),
+            fallback=fallback,
+        )
+        logging.info(f"YouTube transport: {mode} ({store.directory})")
+        return cls(mode, store, replayer)
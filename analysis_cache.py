@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import time
+
+import orjson
+
+from db import getDataAnalyticsByModule, data_analytics_by_module_insert
+from manage_cache import ManageCache
+from single_flight import SingleFlight
+from timing import span
+
+# Kết quả rỗng ([] / {} / null) khi đã mã hóa JSON
+EMPTY_JSON_RESULTS = (b"[]", b"{}", b"null")
+
+def normalize_request(request_data: dict):
+    """
+    Chuẩn hóa dữ liệu request trước khi phân tích và làm khóa cache:
+    bỏ khoảng trắng thừa trong chuỗi (kể cả phần tử của list), regionCode viết hoa.
+    """
+    def normalize(value):
+        if isinstance(value, str):
+            return " ".join(value.split())
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        return value
+
+    normalized = {key: normalize(value) for key, value in request_data.items()}
+    if isinstance(normalized.get("regionCode"), str):
+        normalized["regionCode"] = normalized["regionCode"].upper()
+    return normalized
+
+def canonical_json(value):
+    """
+    JSON chuẩn của request, trùng với cách PostgreSQL in kiểu jsonb (khóa ngắn trước, cùng độ dài thì theo byte,
+    phân cách ", " và ": ") để dữ liệu cũ trong DB có thể được chuẩn hóa bằng request_data::jsonb::text.
+    """
+    if isinstance(value, dict):
+        items = sorted(value.items(), key=lambda item: (len(item[0].encode("utf-8")), item[0].encode("utf-8")))
+        return "{" + ", ".join(f"{json.dumps(key, ensure_ascii=False)}: {canonical_json(item)}" for key, item in items) + "}"
+    if isinstance(value, list):
+        return "[" + ", ".join(canonical_json(item) for item in value) + "]"
+    return json.dumps(value, ensure_ascii=False)
+
+def canonical_key(module: str, request_data: dict):
+    return hashlib.md5(f"{module}:{canonical_json(request_data)}".encode("utf-8")).hexdigest()
+
+class AnalysisCache:
+    """
+    Cache hai tầng cho kết quả phân tích, dùng chung cho mọi endpoint phân tích:
+    - tầng bộ nhớ (ManageCache) phía trước tầng PostgreSQL (youtrader.data_analytics_by_module);
+    - khóa chuẩn hóa từ request (canonical_key cho bộ nhớ, canonical_json cho DB) nên hai tầng luôn khớp nhau;
+    - stale-while-revalidate: bản ghi hết hạn (trong bộ nhớ quá ttl, trong DB quá db_ttl) được trả ngay,
+      một lượt làm mới chạy nền;
+    - làm mới sớm theo xác suất (XFetch) để các request không cùng tính lại đúng lúc hết hạn.
+    Việc tính mới được gộp qua SingleFlight nên mỗi khóa chỉ có một lượt phân tích và một lần ghi DB.
+    Kết quả luôn được giữ và trả về dạng JSON đã mã hóa (bytes), không decode/encode lại khi cache hit.
+    """
+    def __init__(self, memory: ManageCache, single_flight: SingleFlight, ttl: float, stale_ttl: float = None, beta: float = None, db_ttl: float = None):
+        self.memory = memory
+        self.single_flight = single_flight
+        self.ttl = ttl
+        # Tuổi tối đa (giây) của một lần quét trong DB trước khi cần phân tích lại
+        self.db_ttl = db_ttl if db_ttl is not None else float(os.getenv("ANALYSIS_DB_TTL", str(24 * 3600)))
+        self.stale_ttl = stale_ttl if stale_ttl is not None else float(os.getenv("ANALYSIS_CACHE_STALE_TTL", "3600"))
+        self.beta = beta if beta is not None else float(os.getenv("ANALYSIS_CACHE_BETA", "1.0"))
+        self.stats_counters = {"memory_hits": 0, "memory_stale_hits": 0, "db_hits": 0, "db_stale_hits": 0, "misses": 0, "refreshes": 0}
+        self._refreshing = set()
+
+    def _envelope(self, value, delta, ttl=None):
+        now = time.time()
+        return {"value": value, "stored_at": now, "expires_at": now + (self.ttl if ttl is None else ttl), "delta": delta}
+
+    def _should_refresh_early(self, envelope, now):
+        # XFetch: xác suất làm mới tăng dần khi gần hết hạn, tỉ lệ với thời gian tính lại (delta)
+        return now - envelope["delta"] * self.beta * math.log(1.0 - random.random()) >= envelope["expires_at"]
+
+    async def _set_memory(self, key, envelope):
+        await self.memory.set(key, envelope, int(self.ttl + self.stale_ttl))
+
+    async def get(self, module: str, request_data: dict, refresh=None, conn=None):
+        """
+        Tra cứu kết quả đã cache (bộ nhớ rồi DB), trả về JSON bytes hoặc None nếu chưa có.
+        refresh: coroutine function tính lại kết quả, dùng cho làm mới nền khi bản ghi cũ hoặc sắp hết hạn.
+        conn: RequestConnection của request (db.get_db), None thì dùng pool.
+        """
+        key = canonical_key(module, request_data)
+        with span("cache_mem"):
+            envelope = await self.memory.get(key)
+        if envelope:
+            now = time.time()
+            if now < envelope["expires_at"]:
+                self.stats_counters["memory_hits"] += 1
+                if refresh is not None and self._should_refresh_early(envelope, now):
+                    self._schedule_refresh(module, request_data, refresh)
+            else:
+                self.stats_counters["memory_stale_hits"] += 1
+                if refresh is not None:
+                    self._schedule_refresh(module, request_data, refresh)
+            return envelope["value"]
+
+        with span("cache_db"):
+            row = await getDataAnalyticsByModule(module, canonical_json(request_data), conn=conn)
+        if not row:
+            self.stats_counters["misses"] += 1
+            return None
+        value = await self._remember_row(key, row)
+        if row['age_seconds'] is not None and row['age_seconds'] > self.db_ttl:
+            # Bản quét trong DB đã cũ: vẫn trả ngay, phân tích lại ở nền
+            self.stats_counters["db_stale_hits"] += 1
+            if refresh is not None:
+                self._schedule_refresh(module, request_data, refresh)
+        else:
+            self.stats_counters["db_hits"] += 1
+        return value
+
+    async def _remember_row(self, key, row):
+        value = bytes(row['response_data'])
+        # Bộ nhớ không giữ lâu hơn thời gian còn lại của bản quét trong DB
+        remaining = self.db_ttl - (row['age_seconds'] or 0)
+        await self._set_memory(key, self._envelope(value, delta=1.0, ttl=max(0, min(self.ttl, remaining))))
+        return value
+
+    async def _load_fresh_from_db(self, module, request_data, key):
+        row = await getDataAnalyticsByModule(module, canonical_json(request_data), max_age_seconds=self.db_ttl)
+        if not row:
+            return None
+        return await self._remember_row(key, row)
+
+    async def compute(self, module: str, request_data: dict, func, userid_scan: str = 'test_user'):
+        """
+        Chạy func() để tính kết quả mới (gộp các request trùng qua SingleFlight), ghi vào DB và bộ nhớ một lần.
+        Trả về kết quả đã mã hóa JSON (bytes, orjson).
+        """
+        key = canonical_key(module, request_data)
+
+        async def leader():
+            started = time.perf_counter()
+            with span("analysis"):
+                value = await func()
+            with span("serialize"):
+                result = orjson.dumps(value)
+            delta = time.perf_counter() - started
+            with span("db_insert"):
+                await data_analytics_by_module_insert(module, userid_scan, canonical_json(request_data), result)
+            await self._set_memory(key, self._envelope(result, delta))
+            return result
+
+        return await self.single_flight.do(key, leader)
+
+    async def get_or_compute(self, module: str, request_data: dict, func, conn=None):
+        cached = await self.get(module, request_data, refresh=func, conn=conn)
+        if cached is not None:
+            return cached
+        # Trả kết nối của request về pool trước khi phân tích (có thể mất vài giây gọi YouTube)
+        if conn is not None:
+            await conn.release()
+        return await self.compute(module, request_data, func)
+
+    def _schedule_refresh(self, module, request_data, func):
+        key = canonical_key(module, request_data)
+        if key in self._refreshing or self.single_flight.is_running(key):
+            return
+        self._refreshing.add(key)
+        self.stats_counters["refreshes"] += 1
+        logging.info(f"AnalysisCache: làm mới nền cho {module} key {key}")
+        asyncio.ensure_future(self._refresh(module, request_data, func, key))
+
+    async def _refresh(self, module, request_data, func, key):
+        # Ưu tiên nạp lại từ DB (không tốn quota); chỉ phân tích lại khi DB không còn bản ghi dùng được
+        try:
+            if await self._load_fresh_from_db(module, request_data, key) is None:
+                await self.compute(module, request_data, func)
+        except Exception as e:
+            logging.warning(f"AnalysisCache: làm mới nền thất bại cho {module}: {e!r}")
+        finally:
+            self._refreshing.discard(key)
+
+    def stats(self):
+        lookups = sum(self.stats_counters[name] for name in ("memory_hits", "memory_stale_hits", "db_hits", "db_stale_hits", "misses"))
+        hits = lookups - self.stats_counters["misses"]
+        return {**self.stats_counters, "hit_ratio": round(hits / lookups, 4) if lookups else 0}
@@ -1,36 +1,52 @@
-import json
+import asyncio
 import logging
 from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.responses import Response
+import metrics
+import timing
+import random
 from pydantic import BaseModel
 import ActionLogModel
 from Core.analysis_engine_api import AnalysisEngineAPI
+from Core.analysis_engine_api_async import AsyncAnalysisEngineAPI
+from Core.youtube_client import AsyncYoutubeClient
+from Core.youtube_transport import YoutubeTransport
+from Core.api_key_pool import ApiKeyPool
+from Core.entity_cache import EntityCache, TTLCache
 from Core.database_manager import DatabaseManager
 from main_window import ApiManager  # Import ApiManager from main_window.py
 from fastapi.middleware.cors import CORSMiddleware
-from Core.gemini_manager import GeminiManager
-from fastapi_cache import FastAPICache
-from fastapi_cache.backends.inmemory import InMemoryBackend
-from fastapi_cache.decorator import cache
+from Core.gemini_manager import GeminiManager, GeminiError, build_overtake_prompt, overtake_plan_error
+from Core.gemini_key_pool import GeminiKeyPool
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-import hashlib
 import os
 from dotenv import load_dotenv
 
-import time
-import uuid
+from contextlib import aclosing
 
-from db import connect_db, close_db, fetch_now, fetch_now_timezone, data_analytics_by_module_insert, getDataAnalyticsByModule, handle_login_db, check_account_login_by_user_id, handle_update_action_log_account_db
+from db import RequestConnection, get_db, pool_stats, connect_db, close_db, handle_login_db, check_account_login_by_user_id, invalidate_session, session_cache
 from manage_cache import ManageCache
-from util import write_log
+from util import write_log, setup_logging, shutdown_logging, logging_stats
+from workload import WorkloadManager
+from single_flight import SingleFlight
+from analysis_cache import AnalysisCache, normalize_request, EMPTY_JSON_RESULTS
+from usage_counters import UsageCounters
+from plan_cache import GeminiPlanCache, plan_inputs
+from sse import EventStreamResponse, drain_queue, single_event
 
 load_dotenv()
+# Log đi qua hàng đợi, ghi file ở luồng nền (util.setup_logging)
+setup_logging()
 
 VALID_TOKEN = os.getenv("AUTHOR_BEARER_TOKEN")
+# Dùng engine bất đồng bộ (httpx) thay cho googleapiclient đồng bộ; đặt "0" để quay về engine cũ
+USE_ASYNC_ENGINE = os.getenv("YOUTUBE_ASYNC_ENGINE", "1") == "1"
+YOUTUBE_HTTP_TIMEOUT = float(os.getenv("YOUTUBE_HTTP_TIMEOUT", "10"))
 
 class TokenAuth(HTTPBearer):
     async def __call__(self, request: Request) -> HTTPAuthorizationCredentials:
         credentials = await super().__call__(request)
-        logging.debug(f"Received credentials: {credentials}")
+        logging.debug("Received credentials: %s", credentials)
         if credentials.scheme.lower() != "bearer" or credentials.credentials != VALID_TOKEN:
             raise HTTPException(status_code=401, detail="Invalid or missing token")
         return credentials
@@ -49,6 +65,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+HTTP_LATENCY = metrics.Histogram("http_request_duration_seconds", "Thời gian xử lý request theo endpoint.", ["method", "path", "status"])
+# Trả header Server-Timing (thời gian từng bước) cho client; đặt "0" để tắt
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") == "1"
+# Request chậm hơn ngưỡng (ms) được ghi log kèm các bước, lấy mẫu theo tỉ lệ SLOW_REQUEST_SAMPLE_RATE
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "3000"))
+SLOW_REQUEST_SAMPLE_RATE = float(os.getenv("SLOW_REQUEST_SAMPLE_RATE", "1.0"))
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    timings, token = timing.start_request()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        if SERVER_TIMING:
+            response.headers["Server-Timing"] = timings.server_timing()
+        return response
+    finally:
+        elapsed = timings.elapsed()
+        timing.end_request(token)
+        # Dùng path của route (không phải URL thật) để số nhãn không tăng theo tham số
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        HTTP_LATENCY.observe(elapsed, request.method, path, str(status))
+        if elapsed * 1000 >= SLOW_REQUEST_MS and random.random() < SLOW_REQUEST_SAMPLE_RATE:
+            logging.warning("Slow request %s %s %s: %.0fms [%s]", request.method, path, status, elapsed * 1000, timings.describe())
+
 class SomeClass:
     def __init__(self):
         self.api_keys = self._load_api_keys()
@@ -78,11 +121,31 @@ class SomeClass:
         logging.info(f"Đã tải {len(keys)} API key(s) hợp lệ.")
         return keys
 
-    def get_gemini_manager(self):
+    def _load_gemini_keys(self, account_dir="Account"):
+        """
+        Key Gemini: Account/studio_gemini.key và các file *gemini*.key của từng tài khoản (bỏ key trùng).
+        """
         import glob, os, logging
-        key_path = os.path.join("Account", "studio_gemini.key")
-        gemini_api_key = open(key_path, 'r').read().strip()
-        return GeminiManager(api_key=gemini_api_key)
+        keys = []
+        for file_path in sorted(glob.glob(os.path.join(account_dir, '**', '*gemini*.key'), recursive=True)):
+            try:
+                with open(file_path, 'r') as f:
+                    key = f.read().strip()
+                if key and key not in keys:
+                    keys.append(key)
+            except Exception as e:
+                logging.warning(f"❌ Không đọc được file {file_path}: {e}")
+
+        if not keys:
+            raise RuntimeError("Không tìm thấy Gemini API key hợp lệ trong thư mục /Account.")
+
+        logging.info(f"Đã tải {len(keys)} Gemini API key(s).")
+        return keys
+
+    def get_gemini_manager(self):
+        # Mỗi key có giới hạn tốc độ và theo dõi lỗi riêng; thông lượng /aiSuggestion tăng theo số key
+        self.gemini_key_pool = GeminiKeyPool(self._load_gemini_keys())
+        return GeminiManager(self.gemini_key_pool.api_keys, key_pool=self.gemini_key_pool)
 
 # Load API keys (use a placeholder or load from file as in main_window.py)
 # api_key_path = "Account/studio_gemini.key"  # Or another .key file in Account/
@@ -90,12 +153,154 @@ class SomeClass:
 #     api_keys = [f.read().strip()]
 some_class = SomeClass()
 
-api_manager = ApiManager(api_keys=some_class.api_keys)
+# Pool key dùng chung cho engine đồng bộ và bất đồng bộ để ước tính quota trên toàn bộ request
+api_key_pool = ApiKeyPool(some_class.api_keys)
+# Cache chi tiết video/kênh và video nổi bật của kênh, dùng chung cho mọi endpoint
+video_cache = EntityCache("video", max_entries=int(os.getenv("VIDEO_CACHE_MAX_ENTRIES", "20000")))
+channel_cache = EntityCache("channel", max_entries=int(os.getenv("CHANNEL_CACHE_MAX_ENTRIES", "5000")))
+top_video_cache = TTLCache(max_entries=5000, ttl=float(os.getenv("TOP_VIDEO_CACHE_TTL", "86400")))
+# Test tải: YOUTUBE_TRANSPORT=record|replay (Core/youtube_transport.py) hoặc YOUTUBE_API_ROOT_URL trỏ tới loadtest/stub_server.py
+youtube_transport = YoutubeTransport.from_env()
+YOUTUBE_API_ROOT_URL = os.getenv("YOUTUBE_API_ROOT_URL", "").rstrip("/")
+api_manager = ApiManager(api_keys=some_class.api_keys, key_pool=api_key_pool, video_cache=video_cache, channel_cache=channel_cache,
+                         transport=youtube_transport, api_endpoint=YOUTUBE_API_ROOT_URL and YOUTUBE_API_ROOT_URL + "/")
 db_manager = DatabaseManager()
-engine = AnalysisEngineAPI(api_manager, db_manager)
+engine = AnalysisEngineAPI(api_manager, db_manager, top_video_cache=top_video_cache)
+youtube_client = AsyncYoutubeClient(api_keys=some_class.api_keys, key_pool=api_key_pool, video_cache=video_cache, channel_cache=channel_cache,
+                                    timeout=YOUTUBE_HTTP_TIMEOUT, batch_window=float(os.getenv("YOUTUBE_BATCH_WINDOW_MS", "5")) / 1000,
+                                    transport=youtube_transport, base_url=YOUTUBE_API_ROOT_URL and YOUTUBE_API_ROOT_URL + "/youtube/v3")
+async_engine = AsyncAnalysisEngineAPI(youtube_client, db_manager, top_video_cache=top_video_cache)
+
+# Số lượt sinh Gemini song song cho mỗi key (ai_suggestion)
+GEMINI_CONCURRENCY_PER_KEY = int(os.getenv("GEMINI_CONCURRENCY_PER_KEY", "2"))
+gemini_keys = len(some_class.gemini_key_pool.api_keys)
+
+# (số tác vụ chạy song song, số request được xếp hàng) mặc định cho từng endpoint
+workload = WorkloadManager({
+    "discover_keywords": (4, 20),
+    "full_analysis_for_keyword": (4, 20),
+    "full_analysis_by_channel_id": (4, 20),
+    "ai_suggestion": (GEMINI_CONCURRENCY_PER_KEY * gemini_keys, 5 * gemini_keys),
+})
 
 TIME_CACHE = 5 * 60  # 5 minutes
 
+# discoverKeywords quét sâu (nhiều trang search.list) cho gói pro: số trang tối đa, thời gian (giây) và quota (unit) mỗi request
+DISCOVER_PRO_MAX_PAGES = int(os.getenv("DISCOVER_PRO_MAX_PAGES", "5"))
+DISCOVER_TIME_BUDGET = float(os.getenv("DISCOVER_TIME_BUDGET", "8"))
+DISCOVER_QUOTA_BUDGET = int(os.getenv("DISCOVER_QUOTA_BUDGET", "600"))
+
+def discover_pages(memberType, depth=None):
+    """
+    Số trang search.list của một lượt discoverKeywords: mặc định 1 trang như trước; quét sâu chỉ khi client gửi depth,
+    gói pro tối đa DISCOVER_PRO_MAX_PAGES, các gói khác 1 trang.
+    """
+    max_pages = DISCOVER_PRO_MAX_PAGES if memberType == ActionLogModel.MEMBER_TYPE_PRO else 1
+    return max(1, min(depth or 1, max_pages))
+
+# Gộp các request phân tích giống nhau đang chạy đồng thời thành một lần phân tích
+single_flight = SingleFlight()
+# Cache kết quả phân tích hai tầng (bộ nhớ + PostgreSQL) dùng chung cho mọi endpoint phân tích
+analysis_cache = AnalysisCache(some_class.ManageCache, single_flight, ttl=TIME_CACHE)
+# Cache kế hoạch Gemini (/aiSuggestion) theo nội dung input, lưu trong PostgreSQL (youtrader.gemini_plan_cache)
+plan_cache = GeminiPlanCache(single_flight)
+# Bộ đếm lượt dùng theo user (action_log), tăng nguyên tử trên DB hoặc write-behind (USAGE_WRITE_BEHIND=1)
+usage_counters = UsageCounters()
+
+# Metric đọc từ stats() sẵn có khi /metrics được gọi
+def _entity_cache_metrics(field):
+    caches = {"video": video_cache, "channel": channel_cache, "top_video": top_video_cache, "session": session_cache}
+    return [((name,), cache.stats()[field]) for name, cache in caches.items()]
+
+metrics.Callback("entity_cache_hits_total", "Số lượt trúng cache video/kênh/phiên.", ["cache"], lambda: _entity_cache_metrics("hits"), "counter")
+metrics.Callback("entity_cache_misses_total", "Số lượt trượt cache video/kênh/phiên.", ["cache"], lambda: _entity_cache_metrics("misses"), "counter")
+metrics.Callback("entity_cache_entries", "Số bản ghi đang giữ trong cache video/kênh/phiên.", ["cache"], lambda: _entity_cache_metrics("entries"))
+metrics.Callback("analysis_cache_lookups_total", "Tra cứu cache kết quả phân tích theo tầng (memory, db) và kết quả.", ["result"],
+                 lambda: [((name,), value) for name, value in analysis_cache.stats_counters.items()], "counter")
+metrics.Callback("analysis_cache_hit_ratio", "Tỉ lệ trúng cache kết quả phân tích (memory + data_analytics_by_module).", [], lambda: [((), analysis_cache.stats()["hit_ratio"])])
+metrics.Callback("gemini_plan_cache_total", "Tra cứu/ghi/dọn cache kế hoạch Gemini (gemini_plan_cache).", ["result"],
+                 lambda: [((name,), value) for name, value in plan_cache.stats_counters.items()], "counter")
+metrics.Callback("youtube_quota_remaining_units", "Quota ước tính còn lại theo key.", ["key"],
+                 lambda: [((str(key["index"]),), max(0, api_key_pool.daily_quota - key["units_used"])) for key in api_key_pool.stats()["keys"]])
+metrics.Callback("youtube_key_parked", "Key đang bị tạm ngưng (1) hay không (0).", ["key"],
+                 lambda: [((str(key["index"]),), int(key["parked_until"] is not None)) for key in api_key_pool.stats()["keys"]])
+metrics.Callback("gemini_key_available", "Key Gemini đang dùng được (1) hay đang nghỉ/tạm ngưng (0).", ["key"],
+                 lambda: [((str(key["index"]),), int(not key["backoff_seconds"] and not key["parked_seconds"])) for key in some_class.gemini_key_pool.stats()["keys"]])
+metrics.Callback("db_pool_connections", "Kết nối trong pool asyncpg theo trạng thái.", ["state"],
+                 lambda: [((state,), pool_stats()[state]) for state in ("in_use", "idle")] if pool_stats()["connected"] else [])
+metrics.Callback("db_pool_acquire_timeouts_total", "Số lần hết thời gian chờ kết nối từ pool.", [], lambda: [((), pool_stats().get("timeouts", 0))], "counter")
+metrics.Callback("db_pool_acquire_wait_avg_seconds", "Thời gian chờ trung bình để mượn kết nối.", [], lambda: [((), pool_stats().get("acquire_wait_avg_ms", 0) / 1000)])
+metrics.Callback("workload_in_flight", "Số tác vụ đang chạy theo endpoint.", ["endpoint"],
+                 lambda: [((name,), limiter["in_flight"]) for name, limiter in workload.stats()["endpoints"].items()])
+metrics.Callback("workload_queued", "Số request đang xếp hàng theo endpoint.", ["endpoint"],
+                 lambda: [((name,), limiter["queue_depth"]) for name, limiter in workload.stats()["endpoints"].items()])
+metrics.Callback("workload_rejected_total", "Số request bị từ chối vì hàng đợi đầy theo endpoint.", ["endpoint"],
+                 lambda: [((name,), limiter["rejected"]) for name, limiter in workload.stats()["endpoints"].items()], "counter")
+
+def raw_result_response(raw_result: bytes):
+    """
+    Trả {"result": ...} từ JSON đã mã hóa sẵn, không parse và không để FastAPI validate/serialize lại.
+    """
+    return Response(content=b'{"result":' + raw_result + b'}', media_type="application/json")
+
+async def run_engine(limiter_name, method_name, *args):
+    """
+    Gọi một hàm phân tích của engine trong giới hạn của endpoint.
+    Mặc định dùng engine bất đồng bộ; engine đồng bộ được chạy trên thread pool riêng.
+    """
+    if USE_ASYNC_ENGINE:
+        return await workload.run(limiter_name, getattr(async_engine, method_name), *args)
+    return await workload.run(limiter_name, getattr(engine, method_name), *args)
+
+def stream_analysis(module, requestData, limiter_name, method_name, *args, on_undelivered=None):
+    """
+    Sự kiện SSE của một lượt phân tích: kết quả từng phần từ async_engine.stream_<method_name>, cuối cùng "result"
+    (JSON giống endpoint thường). Lượt phân tích đi qua analysis_cache.compute nên vẫn được gộp (SingleFlight) và ghi cache;
+    nếu request giống hệt đang chạy thì chỉ nhận "result". Client ngắt kết nối không hủy lượt phân tích, kết quả vẫn được lưu.
+    Engine đồng bộ không có kết quả từng phần, chỉ gửi "result".
+    on_undelivered: coroutine function gọi một lần khi client không nhận được kết quả có dữ liệu
+    (phân tích lỗi, client ngắt kết nối trước khi có kết quả, hoặc kết quả rỗng), ví dụ để trả lại lượt đã tính.
+    """
+    partials = asyncio.Queue()
+
+    async def analyze():
+        if not USE_ASYNC_ENGINE:
+            return await run_engine(limiter_name, method_name, *args)
+
+        async def consume():
+            result = None
+            async for event, data in getattr(async_engine, f"stream_{method_name}")(*args):
+                if event == "result":
+                    result = data
+                else:
+                    partials.put_nowait((event, data))
+            return result
+
+        return await workload.run(limiter_name, consume)
+
+    async def events():
+        task = asyncio.ensure_future(analysis_cache.compute(module, requestData, analyze))
+        settled = on_undelivered is None
+        try:
+            try:
+                async for event in drain_queue(partials, task):
+                    yield event
+            finally:
+                # Chỉ hủy lượt chờ của request này; lượt phân tích trong SingleFlight (shield) vẫn chạy xong
+                task.cancel()
+            result = task.result()
+            if not settled:
+                settled = True
+                if result in EMPTY_JSON_RESULTS:
+                    await on_undelivered()
+            yield "result", result
+        finally:
+            # Lượt phân tích lỗi hoặc client ngắt kết nối trước khi có kết quả
+            if not settled:
+                await on_undelivered()
+
+    return events()
+
 class Login(BaseModel):
     email: str
     token: str
@@ -108,6 +313,7 @@ class DiscoverKeywords(BaseModel):
     keyword: str
     regionCode: str
     radar: str
+    depth: int | None = None  # số trang search.list muốn quét (mặc định 1), bị giới hạn theo gói của user
 
 class FullAnalysisForKeyword(BaseModel):
     userId: str
@@ -130,81 +336,141 @@ async def startup():
     logging.info("Starting FastAPI server...")
 
     await connect_db()
+    usage_counters.start()
 
 @app.on_event("shutdown")
 async def shutdown():
+    await youtube_client.aclose()
+    await some_class.GeminiManager.aclose()
+    workload.shutdown()
+    await usage_counters.stop()
     await close_db()
+    shutdown_logging()
 
 @app.get("/")
 def healthcheck():
     return {"status": "ok"}
 
-@app.post("/discoverKeywords", dependencies=[Depends(token_auth_scheme)])
-async def discoverKeywords(request: DiscoverKeywords):
-    write_log("discoverKeywords", "begin", f"Received request: {request.json()}")
+@app.get("/stats/workload", dependencies=[Depends(token_auth_scheme)])
+async def workloadStats():
+    return {"result": {**workload.stats(), "single_flight": single_flight.stats(), "analysis_cache": analysis_cache.stats(), "logging": logging_stats(), "usage_counters": usage_counters.stats()}}
+
+@app.get("/metrics", dependencies=[Depends(token_auth_scheme)])
+async def prometheusMetrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/stats/db", dependencies=[Depends(token_auth_scheme)])
+async def dbStats():
+    return {"result": pool_stats()}
+
+@app.get("/stats/quota", dependencies=[Depends(token_auth_scheme)])
+async def quotaStats():
+    return {"result": api_key_pool.stats()}
+
+@app.get("/stats/gemini", dependencies=[Depends(token_auth_scheme)])
+async def geminiStats():
+    return {"result": some_class.gemini_key_pool.stats()}
+
+@app.get("/stats/cache", dependencies=[Depends(token_auth_scheme)])
+async def cacheStats():
+    return {"result": {
+        "video": video_cache.stats(),
+        "channel": channel_cache.stats(),
+        "top_video": top_video_cache.stats(),
+        "session": session_cache.stats(),
+        "batching": youtube_client.batch_stats(),
+        "youtube_transport": youtube_transport.stats() if youtube_transport else None,
+        "gemini_plan": plan_cache.stats(),
+    }}
+
+async def load_discover_request(request: DiscoverKeywords, db: RequestConnection):
+    """
+    Phần dùng chung của /discoverKeywords và /discoverKeywords/stream: kiểm tra phiên đăng nhập, đọc bộ đếm module1,
+    chuẩn hóa request. Trả về (dataModule1, pages, requestData, analyze).
+    """
+    write_log("discoverKeywords", "begin", "Received request: %s", request)
     userId = request.userId
     if not userId:
         raise HTTPException(status_code=400, detail="userId is required")
-    
-    check_account_login_by_user_id_result = await check_account_login_by_user_id(userId)
-    if not check_account_login_by_user_id_result:
+
+    # Phiên đăng nhập được cache ngắn hạn theo userId
+    if not await check_account_login_by_user_id(userId, conn=db):
         raise HTTPException(status_code=404, detail="User not found or not logged in")
-    
-    jsonActionLog = check_account_login_by_user_id_result['action_log']
-    write_log("discoverKeywords", "call check_account_login_by_user_id_result", f"Action log for user {userId}: {jsonActionLog}")
-    if jsonActionLog == "null" or jsonActionLog == "" or jsonActionLog is None:
-        write_log("discoverKeywords", "get data db is null", f"Action log is empty for user {userId}, initializing...")
-        jsonActionLog = {
-            "module1": {
-                "countCallAPI": 0
-            }
-        }
-    else:
-        jsonActionLog = json.loads(jsonActionLog)
-    write_log("discoverKeywords", "result jsonActionLog", f"Parsed action log for user {userId}: {jsonActionLog}")
+
+    # Chỉ đọc bộ đếm của module1 (cache trong tiến trình), action_log rỗng thì bộ đếm mặc định 0
+    jsonActionLog = await usage_counters.get(userId, 'module1', conn=db)
+    if jsonActionLog is None:
+        raise HTTPException(status_code=404, detail="User not found or not logged in")
+    write_log("discoverKeywords", "usage counters", "Action log for user %s: %s", userId, jsonActionLog)
     actionLogModel = ActionLogModel.ActionLogModel(jsonActionLog)
     dataModule1 = actionLogModel.getDataModule1()
-    write_log("discoverKeywords", "load module dataModule1", f"Module1 data: {dataModule1.toString()}")
+    write_log("discoverKeywords", "load module dataModule1", "Module1 data: countCallAPI=%s, countCallAPIConfig=%s", dataModule1.countCallAPI, dataModule1.countCallAPIConfig)
     if not dataModule1:
-        write_log("discoverKeywords", True, f"Module1 data is empty for user {userId}")
+        write_log("discoverKeywords", True, "Module1 data is empty for user %s", userId)
         raise HTTPException(status_code=500, detail="Module1 data is empty")
     
+    pages = discover_pages(actionLogModel.memberType, request.depth)
+    requestData = normalize_request({
+        "keyword": request.keyword,
+        "regionCode": request.regionCode,
+        "radar": request.radar,
+        # Chỉ thêm khi quét nhiều trang để khóa cache của kết quả một trang không đổi
+        **({"depth": pages} if pages > 1 else {}),
+    })
+
+    async def analyze():
+        if pages > 1:
+            return await run_engine("discover_keywords", "discover_keywords_deep", requestData["keyword"], requestData["regionCode"], requestData["radar"],
+                                    pages, DISCOVER_TIME_BUDGET, DISCOVER_QUOTA_BUDGET)
+        return await run_engine("discover_keywords", "discover_keywords", requestData["keyword"], requestData["regionCode"], requestData["radar"])
+
+    return dataModule1, pages, requestData, analyze
+
+@app.post("/discoverKeywords", dependencies=[Depends(token_auth_scheme)])
+async def discoverKeywords(request: DiscoverKeywords, db: RequestConnection = Depends(get_db)):
+    userId = request.userId
+    dataModule1, pages, requestData, analyze = await load_discover_request(request, db)
+
     if dataModule1.allowSearchDB():
-        write_log("discoverKeywords", "allow search DB", f"Allowing search in DB for module1: {dataModule1.countCallAPI}")
-        cacheDB = await getDataAnalyticsByModule('module1', json.dumps({
-                "keyword": request.keyword,
-                "regionCode": request.regionCode,
-                "radar": request.radar
-        }))
-        if cacheDB:
-            write_log("discoverKeywords", "find data in DB", f"Cache hit in database for module1: {cacheDB['response_data']}")
-            dataModule1.increaseCountCallAPI()
-            await handle_update_action_log_account_db(userId, actionLogModel.toJson(dataModule1))
-            return {"result": json.loads(cacheDB['response_data'])}
+        write_log("discoverKeywords", "allow search DB", "Allowing search in DB for module1: %s", dataModule1.countCallAPI)
+        # Làm mới nền tốn quota YouTube như một lượt phân tích mới: chỉ chạy cho user còn được gọi API
+        cached = await analysis_cache.get('module1', requestData, refresh=analyze if dataModule1.allowSearchAPI() else None, conn=db)
+        if cached is not None:
+            write_log("discoverKeywords", "find data in cache", "Cache hit for module1: %s bytes", len(cached))
+            # Kết quả rỗng không tính lượt, giống lượt phân tích mới không có kết quả
+            if cached in EMPTY_JSON_RESULTS:
+                return raw_result_response(cached)
+            # Tăng nguyên tử và kiểm tra lại giới hạn: request đồng thời khác có thể vừa dùng hết lượt
+            if await usage_counters.consume(userId, 'module1', conn=db) is None:
+                write_log("discoverKeywords", True, "Usage limit reached concurrently for module1: %s", userId)
+                raise HTTPException(status_code=403, detail="Search in DB not allowed for module1")
+            return raw_result_response(cached)
         
         else:
-            write_log("discoverKeywords", False, f"No cache found in database for module1, proceeding with API call")
+            write_log("discoverKeywords", False, "No cache found in database for module1, proceeding with API call")
             if dataModule1.allowSearchAPI():
-                result = engine.discover_keywords(request.keyword, request.regionCode, request.radar)
-                await data_analytics_by_module_insert(
-                    'module1',
-                    'test_user',
-                    {
-                        "keyword": request.keyword,
-                        "regionCode": request.regionCode,
-                        "radar": request.radar
-                    },
-                    result
-                )
-
-                if result:
-                    dataModule1.increaseCountCallAPI()
-                    return {"result": result}
+                # Tính lượt trước khi phân tích (UPDATE ... RETURNING có kiểm tra giới hạn), không dựa vào bản đọc trước đó
+                if await usage_counters.consume(userId, 'module1', conn=db) is None:
+                    write_log("discoverKeywords", True, "API call limit reached concurrently for module1: %s", userId)
+                    raise HTTPException(status_code=429, detail="API call limit reached for module1")
+                # Không giữ kết nối DB của request trong lúc phân tích
+                await db.release()
+                try:
+                    result = await analysis_cache.compute('module1', requestData, analyze)
+                except BaseException:
+                    # Phân tích lỗi (kể cả 503 khi quá tải) hoặc request bị hủy: trả lại lượt đã tính
+                    await usage_counters.refund(userId, 'module1')
+                    raise
+
+                if result not in EMPTY_JSON_RESULTS:
+                    return raw_result_response(result)
+                # Không có kết quả thì không tính lượt
+                await usage_counters.refund(userId, 'module1')
             else:
-                write_log("discoverKeywords", True, f"API call limit reached for module1: {dataModule1.countCallAPI}")
+                write_log("discoverKeywords", True, "API call limit reached for module1: %s", dataModule1.countCallAPI)
                 raise HTTPException(status_code=429, detail="API call limit reached for module1")
     else:
-        write_log("discoverKeywords", True, f"Search in DB not allowed for module1: {dataModule1.countCallAPI}")
+        write_log("discoverKeywords", True, "Search in DB not allowed for module1: %s", dataModule1.countCallAPI)
         raise HTTPException(status_code=403, detail="Search in DB not allowed for module1")        
 
 
@@ -272,86 +538,155 @@ async def discoverKeywords(request: DiscoverKeywords):
     # await some_class.ManageCache.set(key, json.dumps(result), TIME_CACHE)
     # return {"result": result}
 
+@app.post("/discoverKeywords/stream", dependencies=[Depends(token_auth_scheme)])
+async def discoverKeywordsStream(request: DiscoverKeywords, db: RequestConnection = Depends(get_db)):
+    """
+    Như /discoverKeywords nhưng trả về SSE: "ranking" (bảng xếp hạng tạm thời sau mỗi trang khi quét sâu), cuối cùng "result".
+    """
+    userId = request.userId
+    dataModule1, pages, requestData, analyze = await load_discover_request(request, db)
+    if not dataModule1.allowSearchDB():
+        write_log("discoverKeywords", True, "Search in DB not allowed for module1: %s", dataModule1.countCallAPI)
+        raise HTTPException(status_code=403, detail="Search in DB not allowed for module1")
+
+    cached = await analysis_cache.get('module1', requestData, refresh=analyze if dataModule1.allowSearchAPI() else None, conn=db)
+    if cached is not None:
+        if cached not in EMPTY_JSON_RESULTS and await usage_counters.consume(userId, 'module1', conn=db) is None:
+            write_log("discoverKeywords", True, "Usage limit reached concurrently for module1: %s", userId)
+            raise HTTPException(status_code=403, detail="Search in DB not allowed for module1")
+        await db.release()
+        return EventStreamResponse(single_event("result", cached))
+
+    if not dataModule1.allowSearchAPI():
+        write_log("discoverKeywords", True, "API call limit reached for module1: %s", dataModule1.countCallAPI)
+        raise HTTPException(status_code=429, detail="API call limit reached for module1")
+    if await usage_counters.consume(userId, 'module1', conn=db) is None:
+        write_log("discoverKeywords", True, "API call limit reached concurrently for module1: %s", userId)
+        raise HTTPException(status_code=429, detail="API call limit reached for module1")
+    await db.release()
+
+    async def refund():
+        await usage_counters.refund(userId, 'module1')
+
+    return EventStreamResponse(stream_analysis('module1', requestData, "discover_keywords", "discover_keywords_deep",
+                                               requestData["keyword"], requestData["regionCode"], requestData["radar"],
+                                               pages, DISCOVER_TIME_BUDGET, DISCOVER_QUOTA_BUDGET, on_undelivered=refund))
+
 @app.post("/fullAnalysisForKeyword", dependencies=[Depends(token_auth_scheme)])
-async def fullAnalysisForKeyword(request: FullAnalysisForKeyword):
-    key = hashlib.md5(json.dumps('fullAnalysisForKeyword'.join(request.keyword).join(request.regionCode), sort_keys=True).encode()).hexdigest()
+async def fullAnalysisForKeyword(request: FullAnalysisForKeyword, db: RequestConnection = Depends(get_db)):
+    requestData = normalize_request({
+        "keyword": request.keyword,
+        "regionCode": request.regionCode
+    })
 
-    cached = await some_class.ManageCache.get(key)
-    if cached:
-        print("✅ From cache")
-        return {"result": json.loads(cached)}
+    async def analyze():
+        return await run_engine("full_analysis_for_keyword", "full_analysis_for_keyword", requestData["keyword"], requestData["regionCode"])
 
-    cacheDB = await getDataAnalyticsByModule('module2.1', json.dumps({
+    result = await analysis_cache.get_or_compute('module2.1', requestData, analyze, conn=db)
+    return raw_result_response(result)
+
+@app.post("/fullAnalysisForKeyword/stream", dependencies=[Depends(token_auth_scheme)])
+async def fullAnalysisForKeywordStream(request: FullAnalysisForKeyword, db: RequestConnection = Depends(get_db)):
+    """
+    Như /fullAnalysisForKeyword nhưng trả về SSE: "demand", "supply", "competition", "competitor" (từng đối thủ), cuối cùng "result".
+    """
+    requestData = normalize_request({
         "keyword": request.keyword,
         "regionCode": request.regionCode
-    }))
-
-    if cacheDB:
-        logging.info(f"Cache hit in database for key: {key}")
-        await some_class.ManageCache.set(key, cacheDB['response_data'], TIME_CACHE)
-        return {"result": json.loads(cacheDB['response_data'])}
-    
-    result = engine.full_analysis_for_keyword(request.keyword, request.regionCode)
-    await data_analytics_by_module_insert(
-        'module2.1',
-        'test_user',
-        {
-            "keyword": request.keyword,
-            "regionCode": request.regionCode
-        },
-        result
-    )
-    await some_class.ManageCache.set(key, json.dumps(result), TIME_CACHE)
-    return {"result": result}
+    })
 
-@app.post("/fullAnalysisByChannelId", dependencies=[Depends(token_auth_scheme)])
-async def fullAnalysisByChannelId(request: FullAnalysisByChannelId):
-    key = hashlib.md5(json.dumps("fullAnalysisByChannelId".join(request.channelId).join(request.marketKeywords), sort_keys=True).encode()).hexdigest()
+    async def analyze():
+        return await run_engine("full_analysis_for_keyword", "full_analysis_for_keyword", requestData["keyword"], requestData["regionCode"])
 
-    cached = await some_class.ManageCache.get(key)
-    if cached:
-        print("✅ From cache")
-        return {"result": json.loads(cached)}
+    cached = await analysis_cache.get('module2.1', requestData, refresh=analyze, conn=db)
+    await db.release()
+    if cached is not None:
+        return EventStreamResponse(single_event("result", cached))
+    return EventStreamResponse(stream_analysis('module2.1', requestData, "full_analysis_for_keyword", "full_analysis_for_keyword",
+                                               requestData["keyword"], requestData["regionCode"]))
 
-    # Nếu chưa có cache, xử lý bình thường
-    cacheDB = await getDataAnalyticsByModule('module2.2', json.dumps({
+@app.post("/fullAnalysisByChannelId", dependencies=[Depends(token_auth_scheme)])
+async def fullAnalysisByChannelId(request: FullAnalysisByChannelId, db: RequestConnection = Depends(get_db)):
+    requestData = normalize_request({
         "channelId": request.channelId,
         "marketKeywords": request.marketKeywords
-    }))
+    })
 
-    if cacheDB:
-        logging.info(f"Cache hit in database for key: {key}")
-        await some_class.ManageCache.set(key, cacheDB['response_data'], TIME_CACHE)
-        return {"result": json.loads(cacheDB['response_data'])}
-    
-    result = engine.analyze_competitor_for_m4(request.channelId, request.marketKeywords)
-    await data_analytics_by_module_insert(
-        'module2.2',
-        'test_user',
-        {
-            "channelId": request.channelId,
-            "marketKeywords": request.marketKeywords
-        },
-        result
-    )
-    await some_class.ManageCache.set(key, json.dumps(result), TIME_CACHE)
-    return {"result": result}
+    async def analyze():
+        return await run_engine("full_analysis_by_channel_id", "analyze_competitor_for_m4", requestData["channelId"], requestData["marketKeywords"])
+
+    # Nếu chưa có cache thì phân tích, kết quả được lưu vào cả bộ nhớ và DB
+    result = await analysis_cache.get_or_compute('module2.2', requestData, analyze, conn=db)
+    return raw_result_response(result)
 
 @app.post("/aiSuggestion", dependencies=[Depends(token_auth_scheme)])
-def aiSuggestion(request: AiSuggestion):
+async def aiSuggestion(request: AiSuggestion):
     GeminiManager = some_class.GeminiManager
- 
-    result = GeminiManager.get_overtake_plan(request.analysisData.get('result'), request.marketKeywords)
+    competitor_data, market_keywords = plan_inputs(request.analysisData.get('result'), request.marketKeywords)
+
+    async def generate():
+        return await workload.run("ai_suggestion", GeminiManager.agenerate_overtake_plan, competitor_data, market_keywords)
+
+    # Cùng input (kể cả từ user khác) thì trả kế hoạch đã sinh, không gọi lại Gemini
+    try:
+        result = await plan_cache.get_or_generate(GeminiManager.model_name, competitor_data, market_keywords, generate)
+    except HTTPException:
+        raise
+    except Exception as e:
+        result = overtake_plan_error(e)
     return {"result": result}
 
+@app.post("/aiSuggestion/stream", dependencies=[Depends(token_auth_scheme)])
+async def aiSuggestionStream(request: AiSuggestion):
+    """
+    Như /aiSuggestion nhưng trả về SSE: "delta" {"text"} cho từng đoạn Gemini sinh ra, cuối cùng "result" (toàn bộ kế hoạch).
+    Dùng chung giới hạn ai_suggestion với /aiSuggestion; client ngắt kết nối thì request tới Gemini bị hủy.
+    Kế hoạch đã có trong plan_cache được gửi ngay trong một "delta" và "result".
+    """
+    model = some_class.GeminiManager.model_name
+    competitor_data, market_keywords = plan_inputs(request.analysisData.get('result'), request.marketKeywords)
+    request_data = plan_cache.request_data(model, competitor_data, market_keywords)
+    plan_hash = plan_cache.key(request_data)
+    cached = await plan_cache.get(plan_hash)
+    if cached is not None:
+        return EventStreamResponse(cached_plan_events(cached))
+
+    # Kiểm tra input và tải trước khi gửi status 200: lỗi ở đây là response 4xx/503, không phải sự kiện "error"
+    try:
+        prompt = build_overtake_prompt(competitor_data, market_keywords)
+    except (TypeError, ValueError, AttributeError) as e:
+        raise HTTPException(status_code=422, detail=f"Invalid analysisData.result for AI suggestion: {e}")
+    workload.limiters["ai_suggestion"].check_capacity()
+    return EventStreamResponse(stream_ai_suggestion(competitor_data, market_keywords, plan_hash, model, request_data, prompt))
+
+async def cached_plan_events(text):
+    yield "delta", {"text": text}
+    yield "result", text
+
+async def stream_ai_suggestion(competitor_data, market_keywords, plan_hash, model, request_data, prompt):
+    chunks = []
+    async with workload.slot("ai_suggestion", checked=True):
+        try:
+            async with aclosing(some_class.GeminiManager.stream_overtake_plan(competitor_data, market_keywords, prompt)) as stream:
+                async for chunk in stream:
+                    chunks.append(chunk)
+                    yield "delta", {"text": chunk}
+        except GeminiError as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+    result = "".join(chunks)
+    if result:
+        await plan_cache.put(plan_hash, model, request_data, result)
+    yield "result", result
+
 @app.post("/login", dependencies=[Depends(token_auth_scheme)])
-async def login(request: Login):
-    logging.info(f"User {request.email} logged in with token: {request.token}")
+async def login(request: Login, db: RequestConnection = Depends(get_db)):
+    logging.info("User %s logged in", request.email)
     
-    user_id = await handle_login_db(request.email, request.token)
+    user_id = await handle_login_db(request.email, request.token, conn=db)
     return {"result": user_id}  # Return a random userId for simplicity
 
 @app.post("/logout", dependencies=[Depends(token_auth_scheme)])
 def logout(request: Logout):
-    logging.info(f"User {request.userId} logged out")
+    logging.info("User %s logged out", request.userId)
+    invalidate_session(request.userId)
     return {"result": request.userId }  # Return a random userId for simplicity
\ No newline at end of file
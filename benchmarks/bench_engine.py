@@ -0,0 +1,149 @@
+# benchmarks/bench_engine.py
+"""
+Micro-benchmark cho phần tính toán của AnalysisEngineAPI (không gọi YouTube: api được thay bằng StubApi).
+
+    python -m benchmarks.bench_engine                 # chạy và so sánh với benchmarks/baseline.json
+    python -m benchmarks.bench_engine --save          # ghi lại baseline
+    python -m benchmarks.bench_engine --filter discover --corpus recorded.json
+
+Mỗi case báo ops/sec (lấy lần tốt nhất trong --repeats lần, mỗi lần chạy tối thiểu --min-time giây)
+và bộ nhớ đỉnh (tracemalloc) của một lần chạy.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from Core.analysis_engine_api import AnalysisEngineAPI
+from benchmarks.corpus import make_corpus, load_corpus, market_keywords
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+SIZES = (50, 500, 2000, 5000)
+
+class StubApi:
+    """
+    Thay ApiManager: trả bản ghi từ corpus trong bộ nhớ, không giới hạn maxResults để đo được corpus lớn.
+    """
+    def __init__(self, videos, channels):
+        self.videos = {video["id"]: video for video in videos}
+        self.channels = {channel["id"]: channel for channel in channels}
+        self._search_items = [
+            {"kind": "youtube#searchResult", "id": {"kind": "youtube#video", "videoId": video["id"]}, "snippet": video["snippet"]}
+            for video in videos
+        ]
+
+    def search(self, **params):
+        return self._search_items
+
+    def get_video_details(self, video_ids):
+        return [self.videos[video_id] for video_id in video_ids if video_id in self.videos]
+
+    def get_channel_details(self, channel_ids):
+        return [self.channels[channel_id] for channel_id in channel_ids if channel_id in self.channels]
+
+def build_cases(sizes, corpus_path=None):
+    """
+    {tên case: hàm không tham số}. Corpus được tạo trước, ngoài phần đo.
+    """
+    cases = {}
+    corpora = {}
+    if corpus_path:
+        videos, channels = load_corpus(corpus_path)
+        corpora[f"recorded{len(videos)}"] = (videos, channels)
+    for n in sizes:
+        corpora[str(n)] = make_corpus(n)
+
+    keywords = market_keywords()
+    for label, (videos, channels) in corpora.items():
+        engine = AnalysisEngineAPI(StubApi(videos, channels), None)
+        channel_id = channels[0]["id"] if channels else ""
+        cases[f"discover_keywords[{label}]"] = lambda engine=engine: engine.discover_keywords("phở bò", "VN", "default")
+        cases[f"score_keywords_titles[{label}]"] = lambda engine=engine, videos=videos: engine._score_keywords(videos)
+        cases[f"advanced_competition[{label}]"] = lambda engine=engine, videos=videos: engine._calculate_advanced_competition(videos)
+        cases[f"competitor_m4[{label}]"] = lambda engine=engine, channel_id=channel_id: engine.analyze_competitor_for_m4(channel_id, keywords)
+    return cases
+
+def measure(func, min_time: float, repeats: int):
+    best = 0.0
+    for _ in range(repeats):
+        runs, started = 0, time.perf_counter()
+        while True:
+            func()
+            runs += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= min_time:
+                break
+        best = max(best, runs / elapsed)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"ops_per_sec": round(best, 2), "peak_kib": round(peak / 1024, 1)}
+
+def compare(results, baseline, threshold):
+    """
+    In kết quả kèm tỉ lệ so với baseline; trả về danh sách case chậm hơn ngưỡng.
+    """
+    regressions = []
+    print(f"{'case':42} {'ops/sec':>12} {'peak KiB':>10} {'vs baseline':>12}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        ratio = result["ops_per_sec"] / base["ops_per_sec"] if base and base["ops_per_sec"] else None
+        flag = ""
+        if ratio is not None and ratio < threshold:
+            regressions.append(name)
+            flag = "  <-- chậm hơn"
+        ratio_text = f"{ratio:.2f}x" if ratio is not None else "-"
+        print(f"{name:42} {result['ops_per_sec']:>12.2f} {result['peak_kib']:>10.1f} {ratio_text:>12}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark các bước tính toán của AnalysisEngineAPI")
+    parser.add_argument("--filter", default="", help="chỉ chạy case có tên chứa chuỗi này")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)), help="số video của corpus tổng hợp, phân tách bằng dấu phẩy")
+    parser.add_argument("--corpus", help="thêm corpus đã ghi (JSON {videos, channels})")
+    parser.add_argument("--min-time", type=float, default=0.3)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--save", action="store_true", help="ghi kết quả vào baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=0.8, help="báo chậm khi ops/sec < threshold * baseline")
+    args = parser.parse_args(argv)
+
+    # Engine ghi log INFO ở mỗi lượt phân tích; tắt để không đo thời gian ghi log
+    logging.disable(logging.INFO)
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    cases = {name: func for name, func in build_cases(sizes, args.corpus).items() if args.filter in name}
+    results = {name: measure(func, args.min_time, args.repeats) for name, func in cases.items()}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "created": datetime.now().isoformat(timespec="seconds"),
+                },
+                "results": {**baseline, **results},
+            }, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"Đã ghi baseline: {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} case chậm hơn baseline quá ngưỡng {args.threshold}.")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+# benchmarks/corpus.py
+"""
+Corpus video/kênh cho benchmark: sinh tổng hợp (tiếng Việt có dấu, cố định theo seed) hoặc nạp từ file đã ghi.
+Bản ghi có cùng cấu trúc với items của videos.list/channels.list/search.list.
+"""
+import json
+import random
+from datetime import datetime, timedelta
+
+# Cụm từ thường gặp trong tiêu đề/tag YouTube tiếng Việt
+PHRASES = [
+    "cách nấu phở bò", "công thức bún chả hà nội", "học tiếng anh giao tiếp", "luyện nghe tiếng anh mỗi ngày",
+    "review điện thoại", "so sánh camera", "mở hộp laptop gaming", "du lịch đà lạt", "ăn gì ở sài gòn",
+    "kinh nghiệm phượt hà giang", "làm bánh mì kẹp thịt", "trang điểm tự nhiên", "chăm sóc da mụn",
+    "tập gym tại nhà", "giảm cân nhanh", "đầu tư chứng khoán", "kiếm tiền online", "bí quyết bán hàng",
+    "nhạc trữ tình bolero", "nhạc trẻ remix", "hài tết mới nhất", "phim hoạt hình thiếu nhi",
+    "mẹo vặt cuộc sống", "sửa xe máy", "trồng rau sạch ban công", "nuôi gà thả vườn",
+]
+WORDS = sorted({word for phrase in PHRASES for word in phrase.split()}) + [
+    "ngon", "dễ", "nhất", "2024", "mới", "hay", "tuyệt", "đỉnh", "siêu", "nhanh", "chuẩn", "đơn", "giản", "thật", "sự",
+]
+DECORATIONS = ["|", "!", "?", "#shorts", "[4K]", "(full)", "- phần 1", ":", "❤️", "🔥"]
+
+def _title(rnd):
+    parts = [rnd.choice(PHRASES)]
+    parts.extend(rnd.choice(WORDS) for _ in range(rnd.randint(2, 8)))
+    if rnd.random() < 0.5:
+        parts.insert(rnd.randrange(len(parts) + 1), rnd.choice(DECORATIONS))
+    return " ".join(parts).capitalize()
+
+def _tags(rnd):
+    tags = [rnd.choice(PHRASES) for _ in range(rnd.randint(0, 6))]
+    tags.extend(" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4))) for _ in range(rnd.randint(0, 10)))
+    return tags
+
+def make_corpus(n_videos: int, n_channels: int = None, seed: int = 1):
+    """
+    Sinh n_videos video và n_channels kênh (mặc định n_videos // 10, tối thiểu 5).
+    """
+    rnd = random.Random(seed)
+    n_channels = n_channels or max(5, n_videos // 10)
+    now = datetime(2026, 9, 1)
+    videos = []
+    for i in range(n_videos):
+        video = {
+            "kind": "youtube#video",
+            "id": f"vid{i:06d}",
+            "snippet": {
+                "title": _title(rnd),
+                "tags": _tags(rnd),
+                "channelId": f"UC{rnd.randrange(n_channels):06d}",
+                "publishedAt": (now - timedelta(days=rnd.randint(0, 365), seconds=rnd.randint(0, 86399))).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            },
+            "statistics": {
+                "viewCount": str(int(rnd.paretovariate(1.2) * 1000)),
+                "likeCount": str(rnd.randint(0, 20000)),
+                "commentCount": str(rnd.randint(0, 2000)),
+            },
+            "contentDetails": {"duration": f"PT{rnd.randint(0, 2)}H{rnd.randint(0, 59)}M{rnd.randint(0, 59)}S"},
+        }
+        videos.append(video)
+    channels = [
+        {
+            "kind": "youtube#channel",
+            "id": f"UC{i:06d}",
+            "snippet": {"title": f"Kênh {rnd.choice(PHRASES).title()} {i}", "publishedAt": "2018-03-01T00:00:00Z"},
+            "statistics": {
+                "subscriberCount": str(int(rnd.paretovariate(1.1) * 500)),
+                "videoCount": str(rnd.randint(1, 3000)),
+                "viewCount": str(rnd.randint(0, 10 ** 9)),
+            },
+        }
+        for i in range(n_channels)
+    ]
+    return videos, channels
+
+def load_corpus(path: str):
+    """
+    Nạp corpus đã ghi: file JSON {"videos": [...], "channels": [...]} (items của videos.list/channels.list).
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data["videos"], data.get("channels", [])
+
+def market_keywords(n: int = 20, seed: int = 2):
+    rnd = random.Random(seed)
+    return [rnd.choice(PHRASES) if rnd.random() < 0.7 else f"{rnd.choice(WORDS)} {rnd.choice(WORDS)}" for _ in range(n)]
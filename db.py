@@ -1,5 +1,7 @@
 import uuid
+import asyncio
 import asyncpg
+import time
 import os
 from dotenv import load_dotenv
 import json
@@ -7,60 +9,180 @@ import json as pyjson
 
 from fastapi import HTTPException
 import logging
+from contextlib import asynccontextmanager
 from datetime import date
 
+from Core.entity_cache import TTLCache
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 db_pool = None  # Global pool
 
+def _optional_float(name):
+    value = os.getenv(name)
+    return float(value) if value else None
+
+# Cấu hình pool asyncpg; khi chạy nhiều worker, tổng DB_POOL_MAX_SIZE của các worker phải nhỏ hơn max_connections của PostgreSQL
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_MAX_QUERIES = int(os.getenv("DB_POOL_MAX_QUERIES", "50000"))
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_COMMAND_TIMEOUT = _optional_float("DB_COMMAND_TIMEOUT")
+# Thời gian chờ tối đa (giây) để mượn kết nối từ pool; hết thời gian thì trả 503
+DB_ACQUIRE_TIMEOUT = _optional_float("DB_ACQUIRE_TIMEOUT") or 10.0
+DB_TIMEZONE = os.getenv("DB_TIMEZONE", "Asia/Ho_Chi_Minh")
+
+pool_counters = {"acquires": 0, "acquire_wait_total": 0.0, "acquire_wait_max": 0.0, "timeouts": 0}
+
+# Cache phiên đăng nhập theo user_id (chỉ các cột cần thiết), bị xóa khi login/logout
+session_cache = TTLCache(
+    max_entries=int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "10000")),
+    ttl=float(os.getenv("SESSION_CACHE_TTL", "30")),
+)
+
 async def connect_db():
     global db_pool
+    # Múi giờ được gửi cùng gói khởi tạo phiên (server_settings), không tốn thêm round trip cho mỗi kết nối mới
     db_pool = await asyncpg.create_pool(DATABASE_URL,
-    init=init_connection)
-
-async def init_connection(conn):
-    print(">>> Đang set TIME ZONE cho kết nối PostgreSQL...")
-    await conn.execute("SET TIME ZONE 'Asia/Ho_Chi_Minh'")
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    max_queries=DB_POOL_MAX_QUERIES,
+    max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+    statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+    command_timeout=DB_COMMAND_TIMEOUT,
+    server_settings={"timezone": DB_TIMEZONE})
+    logging.info(f"PostgreSQL pool: min {DB_POOL_MIN_SIZE}, max {DB_POOL_MAX_SIZE}, timezone {DB_TIMEZONE}")
 
 async def close_db():
     await db_pool.close()
 
-async def fetch_now():
-    async with db_pool.acquire() as conn:
+async def _acquire():
+    started = time.perf_counter()
+    try:
+        conn = await db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_counters["timeouts"] += 1
+        logging.warning(f"Hết thời gian chờ kết nối PostgreSQL ({DB_ACQUIRE_TIMEOUT}s), pool đang dùng {db_pool.get_size() - db_pool.get_idle_size()}/{db_pool.get_max_size()}")
+        raise HTTPException(status_code=503, detail="Database is busy, please retry", headers={"Retry-After": "1"})
+    waited = time.perf_counter() - started
+    pool_counters["acquires"] += 1
+    pool_counters["acquire_wait_total"] += waited
+    pool_counters["acquire_wait_max"] = max(pool_counters["acquire_wait_max"], waited)
+    return conn
+
+def pool_stats():
+    if db_pool is None:
+        return {"connected": False}
+    size, idle = db_pool.get_size(), db_pool.get_idle_size()
+    acquires = pool_counters["acquires"]
+    return {
+        "connected": True,
+        "size": size,
+        "in_use": size - idle,
+        "idle": idle,
+        "min_size": db_pool.get_min_size(),
+        "max_size": db_pool.get_max_size(),
+        "acquires": acquires,
+        "acquire_wait_avg_ms": round(pool_counters["acquire_wait_total"] / acquires * 1000, 3) if acquires else 0,
+        "acquire_wait_max_ms": round(pool_counters["acquire_wait_max"] * 1000, 3),
+        "timeouts": pool_counters["timeouts"],
+    }
+
+class RequestConnection:
+    """
+    Một kết nối pool dùng chung cho mọi truy vấn của một request (xem get_db).
+    Chỉ lấy kết nối khi có truy vấn đầu tiên; release() trả kết nối sớm (ví dụ trước khi phân tích lâu),
+    truy vấn sau đó sẽ lấy lại kết nối. Các truy vấn trên cùng kết nối phải chạy tuần tự, không gather.
+    """
+    def __init__(self):
+        self._conn = None
+
+    async def get(self):
+        if self._conn is None:
+            self._conn = await _acquire()
+        return self._conn
+
+    async def release(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await db_pool.release(conn)
+
+async def get_db():
+    """
+    FastAPI dependency: Depends(get_db) cấp một RequestConnection cho request, trả kết nối về pool khi xong.
+    """
+    request_conn = RequestConnection()
+    try:
+        yield request_conn
+    finally:
+        await request_conn.release()
+
+@asynccontextmanager
+async def _connection(conn=None):
+    # conn: RequestConnection của request hiện tại; None thì mượn một kết nối pool cho riêng truy vấn này
+    if conn is not None:
+        yield await conn.get()
+    else:
+        pooled = await _acquire()
+        try:
+            yield pooled
+        finally:
+            await db_pool.release(pooled)
+
+async def fetch_now(conn=None):
+    async with _connection(conn) as conn:
         result = await conn.fetchval("SELECT LOCALTIMESTAMP")
         return result
     
-async def fetch_now_timezone():
-    async with db_pool.acquire() as conn:
+async def fetch_now_timezone(conn=None):
+    async with _connection(conn) as conn:
         result = await conn.fetchval("SHOW TIME ZONE")
         return result
     
-async def getDataAnalyticsByModule(module: str, request_data: str):
+async def getDataAnalyticsByModule(module: str, request_data: str, max_age_seconds: float = None, conn=None):
+    """
+    Tra cứu kết quả phân tích theo (module, md5(request_data)) qua unique index (migrations/001).
+    response_data được trả về dạng bytes UTF-8 (JSON đã mã hóa sẵn) để trả thẳng cho client, không parse lại.
+    age_seconds là số giây kể từ lần quét gần nhất; max_age_seconds (nếu có) bỏ qua các bản ghi cũ hơn.
+    """
     query = """
-        SELECT * FROM youtrader.data_analytics_by_module
-         WHERE module=$1 AND request_data=$2
+        SELECT id, module, request_data, lasted_scan_date, create_date,
+               convert_to(response_data, 'UTF8') AS response_data,
+               EXTRACT(EPOCH FROM LOCALTIMESTAMP - lasted_scan_date)::float8 AS age_seconds
+          FROM youtrader.data_analytics_by_module
+         WHERE module=$1 AND request_hash=md5($2)
+           AND ($3::float8 IS NULL OR lasted_scan_date >= LOCALTIMESTAMP - make_interval(secs => $3::float8))
     """
-    async with db_pool.acquire() as conn:
-        logging.info(f"Fetching data analytics for module: {module}, request_data: {request_data}")
-        result = await conn.fetchrow(query, module, request_data)
+    async with _connection(conn) as conn:
+        logging.info("Fetching data analytics for module: %s, request_data: %s", module, request_data)
+        result = await conn.fetchrow(query, module, request_data, max_age_seconds)
         return result
     
-async def data_analytics_by_module_insert(module: str, userid_scan: str, request_data: json, response_data: json):
+async def data_analytics_by_module_insert(module: str, userid_scan: str, request_data: json, response_data: json, conn=None):
+    """
+    Ghi kết quả phân tích: request đã có thì cập nhật response_data và lasted_scan_date (upsert).
+    request_data/response_data có thể là JSON đã mã hóa sẵn (str/bytes) hoặc object Python.
+    """
     query = """
         INSERT INTO youtrader.data_analytics_by_module (
             module, lasted_scan_date, userid_scan, request_data, response_data
         ) VALUES ($1, LOCALTIMESTAMP, $2, $3, $4)
+        ON CONFLICT (module, request_hash) DO UPDATE
+           SET response_data = EXCLUDED.response_data,
+               lasted_scan_date = EXCLUDED.lasted_scan_date,
+               userid_scan = EXCLUDED.userid_scan
         RETURNING id, create_date
     """
-    async with db_pool.acquire() as conn:
+    async with _connection(conn) as conn:
         try:
             row = await conn.fetchrow(
                 query,
                 module,
                 userid_scan,
-                pyjson.dumps(request_data),
-                pyjson.dumps(response_data),
+                _json_text(request_data),
+                _json_text(response_data),
             )
             return {
                 "id": str(row["id"]),
@@ -70,13 +192,70 @@ async def data_analytics_by_module_insert(module: str, userid_scan: str, request
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
-async def check_account_login_by_email(email: str):
+async def get_gemini_plan(plan_hash: str, max_age_seconds: float, conn=None):
+    """
+    Kế hoạch Gemini đã cache (migrations/004) còn trong hạn max_age_seconds, None nếu không có.
+    Mỗi lần trúng cập nhật last_hit_date (dùng cho dọn LRU) và hit_count.
+    """
+    query = """
+        UPDATE youtrader.gemini_plan_cache
+           SET last_hit_date = LOCALTIMESTAMP, hit_count = hit_count + 1
+         WHERE plan_hash = $1
+           AND create_date >= LOCALTIMESTAMP - make_interval(secs => $2::float8)
+        RETURNING response_text
+    """
+    async with _connection(conn) as conn:
+        return await conn.fetchval(query, plan_hash, max_age_seconds)
+
+async def gemini_plan_insert(plan_hash: str, model: str, request_data: str, response_text: str, conn=None):
+    """
+    Ghi kế hoạch Gemini; khóa đã có (bản cũ hết hạn) thì ghi đè và tính lại hạn từ bây giờ.
+    """
+    query = """
+        INSERT INTO youtrader.gemini_plan_cache (plan_hash, model, request_data, response_text)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (plan_hash) DO UPDATE
+           SET model = EXCLUDED.model,
+               request_data = EXCLUDED.request_data,
+               response_text = EXCLUDED.response_text,
+               create_date = LOCALTIMESTAMP,
+               last_hit_date = LOCALTIMESTAMP,
+               hit_count = 0
+    """
+    async with _connection(conn) as conn:
+        await conn.execute(query, plan_hash, model, request_data, response_text)
+
+async def prune_gemini_plans(max_age_seconds: float, max_entries: int, conn=None):
+    """
+    Xóa kế hoạch Gemini hết hạn và các bản ít được dùng gần đây nhất vượt quá max_entries. Trả về số bản ghi đã xóa.
+    """
+    query = """
+        DELETE FROM youtrader.gemini_plan_cache
+         WHERE create_date < LOCALTIMESTAMP - make_interval(secs => $1::float8)
+            OR plan_hash IN (
+                SELECT plan_hash FROM youtrader.gemini_plan_cache
+                 ORDER BY last_hit_date DESC
+                OFFSET $2
+            )
+    """
+    async with _connection(conn) as conn:
+        status = await conn.execute(query, max_age_seconds, max_entries)
+        return int(status.split()[-1])
+
+def _json_text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, str):
+        return value
+    return pyjson.dumps(value)
+
+async def check_account_login_by_email(email: str, conn=None):
     today = date.today()
     logging.info(f"Checking account login for email: {email} on date: {today}")
     query = """
-        SELECT * FROM youtrader.account_ WHERE email = $1 AND login_date = $2
+        SELECT user_id FROM youtrader.account_ WHERE email = $1 AND login_date = $2
     """
-    async with db_pool.acquire() as conn:
+    async with _connection(conn) as conn:
         try:
             row = await conn.fetchrow(
                 query,
@@ -87,27 +266,39 @@ async def check_account_login_by_email(email: str):
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
         
-async def check_account_login_by_user_id(userId: str):
-    logging.info(f"Checking account login for userId: {userId}")
+async def check_account_login_by_user_id(userId: str, conn=None):
+    """
+    Phiên đăng nhập của userId (user_id, email, login_date), None nếu không tồn tại.
+    Kết quả được cache ngắn hạn trong session_cache; user không tồn tại thì không cache.
+    """
+    row = session_cache.get(userId)
+    if row is not None:
+        return row
+    logging.info("Checking account login for userId: %s", userId)
     query = """
-        SELECT * FROM youtrader.account_ WHERE user_id = $1
+        SELECT user_id, email, login_date FROM youtrader.account_ WHERE user_id = $1
     """
-    async with db_pool.acquire() as conn:
+    async with _connection(conn) as conn:
         try:
             row = await conn.fetchrow(
                 query,
                 userId
             )
-            return row
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
+    if row is not None:
+        session_cache.set(userId, row)
+    return row
+
+def invalidate_session(userId: str):
+    session_cache.delete(userId)
         
-async def update_account_login(user_id: str, email: str, token: str):
+async def update_account_login(user_id: str, email: str, token: str, conn=None):
     query = """
         UPDATE youtrader.account_ SET user_id = $1, token = $2 WHERE email = $3 AND login_date = $4
         RETURNING user_id
     """
-    async with db_pool.acquire() as conn:
+    async with _connection(conn) as conn:
         try:
             row = await conn.fetchrow(
                 query,
@@ -123,11 +314,11 @@ async def update_account_login(user_id: str, email: str, token: str):
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
         
-async def update_action_log_account(user_id: str, action_log: str):
+async def update_action_log_account(user_id: str, action_log: str, conn=None):
     query = """
         UPDATE youtrader.account_ SET action_log = $1 WHERE user_id = $2
     """
-    async with db_pool.acquire() as conn:
+    async with _connection(conn) as conn:
         try:
             row = await conn.fetchrow(
                 query,
@@ -141,59 +332,111 @@ async def update_action_log_account(user_id: str, action_log: str):
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
-async def handle_login_db(email: str, token: str):
-    check_account_login_result = await check_account_login_by_email(email)
-    isExistAccount = bool(check_account_login_result is not None)
-    logging.info(f"Update account login for email: {email}, already logged in: {check_account_login_result}")
-    if isExistAccount:
-        logging.info(f"Account already logged in for email: {email}")
-        userId = uuid.uuid4().hex
-        update_account_login_result = await update_account_login(
-            userId,
-            email,
-            token
+# Bộ đếm lượt dùng trong action_log (jsonb, migrations/002): {"memberType": ..., "<module>": {"countCallAPI": n, "countCallAPIConfig": m}}
+USAGE_COLUMNS = """
+    user_id,
+    COALESCE(action_log ->> 'memberType', $3::text) AS member_type,
+    COALESCE((action_log #>> ARRAY[$2::text, 'countCallAPI'])::int, 0) AS count_call_api,
+    COALESCE((action_log #>> ARRAY[$2::text, 'countCallAPIConfig'])::int, $4::int) AS count_call_api_config
+"""
+
+async def get_usage_counter(user_id: str, module: str, default_member_type: str, default_limit: int, conn=None):
+    """
+    Đọc bộ đếm lượt dùng của một module (chỉ các cột cần thiết), None nếu user không tồn tại.
+    """
+    query = f"""
+        SELECT {USAGE_COLUMNS}
+          FROM youtrader.account_
+         WHERE user_id = $1
+    """
+    async with _connection(conn) as conn:
+        try:
+            return await conn.fetchrow(query, user_id, module, default_member_type, default_limit)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+async def consume_usage_counter(user_id: str, module: str, amount: int, default_member_type: str, default_limit: int, enforce_limit: bool = True, conn=None):
+    """
+    Tăng countCallAPI của module thêm amount trong một câu UPDATE ... RETURNING (nguyên tử, không mất lượt tăng
+    khi có request đồng thời). enforce_limit: chỉ tăng khi countCallAPI <= countCallAPIConfig
+    (cùng điều kiện với DataModule1Config.allowSearchDB); trả về None nếu đã hết lượt hoặc user không tồn tại.
+    """
+    query = f"""
+        UPDATE youtrader.account_
+           SET action_log = COALESCE(action_log, '{{}}'::jsonb) || jsonb_build_object(
+                   $2::text, COALESCE(action_log -> $2::text, '{{}}'::jsonb) || jsonb_build_object(
+                       'countCallAPI', COALESCE((action_log #>> ARRAY[$2::text, 'countCallAPI'])::int, 0) + $5::int))
+         WHERE user_id = $1
+           AND (NOT $6::boolean
+                OR COALESCE((action_log #>> ARRAY[$2::text, 'countCallAPI'])::int, 0)
+                   <= COALESCE((action_log #>> ARRAY[$2::text, 'countCallAPIConfig'])::int, $4::int))
+        RETURNING {USAGE_COLUMNS}
+    """
+    async with _connection(conn) as conn:
+        try:
+            return await conn.fetchrow(query, user_id, module, default_member_type, default_limit, amount, enforce_limit)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+async def handle_login_db(email: str, token: str, conn=None):
+    """
+    Đăng nhập trong một câu lệnh: upsert theo (email, login_date) (migrations/003), mỗi lần đăng nhập cấp user_id mới.
+    CTE previous đọc user_id cũ (cùng snapshot) để hủy phiên cũ trong session_cache.
+    """
+    userId = uuid.uuid4().hex
+    query = """
+        WITH previous AS (
+            SELECT user_id FROM youtrader.account_ WHERE email = $1 AND login_date = $3
         )
-        return {
-            "id": str(update_account_login_result["id"]),
-            "message": "Login record updated successfully"
-        }
-    else:
-        userId = uuid.uuid4().hex
-        query = """
-            INSERT INTO youtrader.account_ (email, token, login_date, user_id)
-            VALUES ($1, $2, $3, $4)
-            RETURNING user_id
-        """
-        async with db_pool.acquire() as conn:
-            try:
-                row = await conn.fetchrow(
-                    query,
-                    email,
-                    token,
-                    date.today(),
-                    userId
-                )
-                return {
-                    "id": str(row["user_id"]),
-                    "message": "Login record created successfully"
-                }
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=str(e))
-
-async def handle_update_action_log_account_db(userId: str, actionLog: str):
-    check_account_login_result = await check_account_login_by_user_id(userId)
-    isExistAccount = bool(check_account_login_result is not None)
-    if not isExistAccount:
+        INSERT INTO youtrader.account_ (email, token, login_date, user_id)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (email, login_date) DO UPDATE
+           SET user_id = EXCLUDED.user_id,
+               token = EXCLUDED.token
+        RETURNING user_id, (SELECT user_id FROM previous) AS previous_user_id
+    """
+    async with _connection(conn) as conn:
+        try:
+            row = await conn.fetchrow(
+                query,
+                email,
+                token,
+                date.today(),
+                userId
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    isExistAccount = row["previous_user_id"] is not None
+    logging.info(f"Update account login for email: {email}, already logged in: {isExistAccount}")
+    if isExistAccount:
+        # user_id cũ của tài khoản bị thay thế, phiên cũ không còn hợp lệ
+        invalidate_session(row["previous_user_id"])
+    return {
+        "id": str(row["user_id"]),
+        "message": "Login record updated successfully" if isExistAccount else "Login record created successfully"
+    }
+
+async def handle_update_action_log_account_db(userId: str, actionLog: str, conn=None):
+    """
+    Ghi action_log trong một câu UPDATE ... RETURNING, không cần đọc tài khoản trước.
+    """
+    query = """
+        UPDATE youtrader.account_ SET action_log = $1 WHERE user_id = $2
+        RETURNING user_id
+    """
+    async with _connection(conn) as conn:
+        try:
+            row = await conn.fetchrow(query, _json_text(actionLog), userId)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    if row is None:
         logging.info(f"###handle_update_action_log_account_db### UserId {userId} not found in account login records")
         return {
-            "id": str(check_account_login_result["user_id"]),
+            "id": str(userId),
             "message": "userId not found in account login records"
         }
-    else:
-        logging.info(f"###handle_update_action_log_account_db### UserId {userId} found in account login records")
-        update_action_log_account_result = await update_action_log_account(
-            userId,
-            actionLog
-        )
-        logging.info(f"Action log updated for userId {userId}: {update_action_log_account_result}")
-        return update_action_log_account_result
\ No newline at end of file
+    logging.info("Action log updated for userId %s", userId)
+    return {
+        "id": str(userId),
+        "message": "Login record updated successfully"
+    }
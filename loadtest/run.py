@@ -0,0 +1,178 @@
+# loadtest/run.py
+"""
+Test tải end-to-end cho api_server với YouTube giả lập (stub server hoặc YOUTUBE_TRANSPORT=replay) và Postgres cục bộ.
+
+    psql "$DATABASE_URL" -f loadtest/schema.sql
+    python -m loadtest.stub_server --synthetic --latency-ms 80 --jitter-ms 40 &
+    YOUTUBE_API_ROOT_URL=http://127.0.0.1:8765 uvicorn api_server:app --port 8000 &
+    python -m loadtest.run --base-url http://127.0.0.1:8000 --token "$AUTHOR_BEARER_TOKEN" \\
+        --database-url "$DATABASE_URL" --concurrency 20 --duration 60
+
+Mỗi worker lặp lại các kịch bản theo trọng số; cuối cùng in số request, lỗi, req/s, p50/p99 theo endpoint.
+--database-url dùng để nâng user test lên gói pro (không giới hạn lượt) trước khi chạy discoverKeywords.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import httpx
+
+from benchmarks.corpus import PHRASES
+from loadtest.synthetic import SyntheticYoutube
+
+PRO_ACTION_LOG = {"memberType": "pro", "module1": {"countCallAPI": 0, "countCallAPIConfig": 1_000_000_000}}
+REGIONS = ["VN", "US", ""]
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, name, latency, ok):
+        self.latencies.setdefault(name, []).append(latency)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    @staticmethod
+    def percentile(values, fraction):
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+    def report(self, elapsed):
+        lines = [f"{'endpoint':<28}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}"]
+        everything = []
+        for name, values in sorted(self.latencies.items()):
+            everything.extend(values)
+            lines.append(f"{name:<28}{len(values):>8}{self.errors.get(name, 0):>8}{len(values) / elapsed:>10.1f}"
+                         f"{self.percentile(values, 0.5) * 1000:>10.1f}{self.percentile(values, 0.99) * 1000:>10.1f}")
+        lines.append(f"{'total':<28}{len(everything):>8}{sum(self.errors.values()):>8}{len(everything) / elapsed:>10.1f}"
+                     f"{self.percentile(everything, 0.5) * 1000:>10.1f}{self.percentile(everything, 0.99) * 1000:>10.1f}")
+        return "\n".join(lines)
+
+class Scenario:
+    def __init__(self, client: httpx.AsyncClient, stats: Stats, users, synthetic: SyntheticYoutube, keywords, rnd: random.Random):
+        self.client, self.stats = client, stats
+        self.users, self.synthetic, self.keywords = users, synthetic, keywords
+        self.channel_ids = synthetic.channel_ids
+        self.rnd = rnd
+
+    async def call(self, name, method, path, payload=None):
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, json=payload)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        self.stats.add(name, time.perf_counter() - started, ok)
+        return response
+
+    async def discover_keywords(self):
+        await self.call("discoverKeywords", "POST", "/discoverKeywords", {
+            "userId": self.rnd.choice(self.users), "keyword": self.rnd.choice(self.keywords),
+            "regionCode": self.rnd.choice(REGIONS), "radar": self.rnd.choice(["relevance", "date", "niche"]),
+        })
+
+    async def full_analysis_for_keyword(self):
+        await self.call("fullAnalysisForKeyword", "POST", "/fullAnalysisForKeyword", {
+            "userId": self.rnd.choice(self.users), "keyword": self.rnd.choice(self.keywords), "regionCode": self.rnd.choice(REGIONS),
+        })
+
+    async def full_analysis_by_channel_id(self):
+        await self.call("fullAnalysisByChannelId", "POST", "/fullAnalysisByChannelId", {
+            "userId": self.rnd.choice(self.users), "channelId": self.rnd.choice(self.channel_ids),
+            "marketKeywords": self.rnd.sample(self.keywords, 3),
+        })
+
+    async def ai_suggestion(self):
+        # Phân tích đối thủ đủ trường của prompt, để request đi tới Gemini/plan cache thay vì lỗi dựng prompt
+        channel_id, market_keywords = self.rnd.choice(self.channel_ids), self.rnd.sample(self.keywords, 3)
+        await self.call("aiSuggestion", "POST", "/aiSuggestion", {
+            "userId": self.rnd.choice(self.users), "analysisData": {"result": self.synthetic.competitor_analysis(channel_id, market_keywords)},
+            "marketKeywords": market_keywords,
+        })
+
+    async def login_logout(self):
+        response = await self.call("login", "POST", "/login", {"email": f"loadtest-{self.rnd.randrange(10 ** 6)}@example.com", "token": "loadtest"})
+        if response is not None and response.status_code == 200:
+            await self.call("logout", "POST", "/logout", {"userId": response.json()["result"]})
+
+    async def stats_endpoints(self):
+        await self.call("stats", "GET", self.rnd.choice(["/stats/workload", "/stats/cache", "/stats/db", "/stats/quota", "/metrics"]))
+
+async def prepare_users(client, n_users, database_url):
+    """
+    Đăng nhập n_users tài khoản test; có database_url thì nâng lên gói pro để discoverKeywords không bị giới hạn lượt.
+    """
+    users = []
+    for i in range(n_users):
+        response = await client.post("/login", json={"email": f"loadtest-user-{i}@example.com", "token": "loadtest"})
+        response.raise_for_status()
+        users.append(response.json()["result"])
+    if database_url:
+        import asyncpg
+        conn = await asyncpg.connect(database_url)
+        try:
+            await conn.execute("UPDATE youtrader.account_ SET action_log = $1::jsonb WHERE user_id = ANY($2::text[])",
+                               json.dumps(PRO_ACTION_LOG), users)
+        finally:
+            await conn.close()
+    return users
+
+async def run(args):
+    weights = {
+        "discover_keywords": args.weight_discover,
+        "full_analysis_for_keyword": args.weight_keyword,
+        "full_analysis_by_channel_id": args.weight_channel,
+        "login_logout": args.weight_login,
+        "stats_endpoints": args.weight_stats,
+        "ai_suggestion": args.weight_ai if args.ai_suggestion else 0,
+    }
+    names = [name for name, weight in weights.items() if weight > 0]
+    # Cùng corpus với stub server để channelId có thật và analysisData của /aiSuggestion khớp dữ liệu YouTube giả lập
+    synthetic = SyntheticYoutube(args.synthetic_videos)
+    keywords = PHRASES[:args.keywords] if args.keywords else PHRASES
+
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, headers={"Authorization": f"Bearer {args.token}"},
+                                 timeout=args.timeout, limits=limits) as client:
+        users = await prepare_users(client, args.users, args.database_url)
+        deadline = time.perf_counter() + args.duration
+
+        async def worker(seed):
+            rnd = random.Random(seed)
+            scenario = Scenario(client, stats, users, synthetic, keywords, rnd)
+            while time.perf_counter() < deadline:
+                name = rnd.choices(names, weights=[weights[n] for n in names])[0]
+                await getattr(scenario, name)()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(args.seed + i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+    print(stats.report(elapsed))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test tải end-to-end cho api_server")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--token", required=True, help="AUTHOR_BEARER_TOKEN của api_server")
+    parser.add_argument("--database-url", default=None, help="Postgres của api_server, dùng để nâng user test lên pro")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30, help="giây")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--keywords", type=int, default=0, help="số từ khóa dùng (0 = tất cả); ít từ khóa thì tỉ lệ trúng cache cao")
+    parser.add_argument("--synthetic-videos", type=int, default=5000, help="phải khớp --synthetic-videos của stub server")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--ai-suggestion", action="store_true", help="gồm cả /aiSuggestion (gọi Gemini thật)")
+    parser.add_argument("--weight-discover", type=float, default=4)
+    parser.add_argument("--weight-keyword", type=float, default=3)
+    parser.add_argument("--weight-channel", type=float, default=2)
+    parser.add_argument("--weight-login", type=float, default=1)
+    parser.add_argument("--weight-stats", type=float, default=0.5)
+    parser.add_argument("--weight-ai", type=float, default=0.5)
+    asyncio.run(run(parser.parse_args(argv)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# loadtest/stub_server.py
+"""
+Stub server cho YouTube Data API v3: phát lại bản ghi (Core/youtube_transport.py) qua HTTP thật,
+để api_server đi đủ đường mạng (httpx/httplib2, pool kết nối) mà không tốn quota.
+
+    python -m loadtest.stub_server --port 8765 --recordings recordings --synthetic --latency-ms 80 --jitter-ms 40
+    YOUTUBE_API_ROOT_URL=http://127.0.0.1:8765 uvicorn api_server:app
+"""
+import argparse
+import asyncio
+
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+from Core.youtube_transport import RecordingStore, YoutubeReplayer
+
+def create_app(replayer: YoutubeReplayer):
+    app = FastAPI()
+
+    @app.get("/youtube/v3/{resource}")
+    async def youtubeList(resource: str, request: Request):
+        await asyncio.sleep(replayer.delay())
+        status, body = replayer.respond(resource, dict(request.query_params))
+        return Response(content=body, status_code=status, media_type="application/json; charset=UTF-8")
+
+    @app.get("/stats")
+    async def stubStats():
+        return {"result": replayer.stats_counters}
+
+    return app
+
+def main(argv=None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Stub server phát lại YouTube Data API v3")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--recordings", default="recordings", help="thư mục bản ghi (YOUTUBE_TRANSPORT=record)")
+    parser.add_argument("--synthetic", action="store_true", help="sinh dữ liệu giả khi chưa có bản ghi")
+    parser.add_argument("--synthetic-videos", type=int, default=5000)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--quota-error-rate", type=float, default=0, help="tỉ lệ trả 403 quotaExceeded")
+    parser.add_argument("--server-error-rate", type=float, default=0, help="tỉ lệ trả 503")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    fallback = None
+    if args.synthetic:
+        from loadtest.synthetic import SyntheticYoutube
+        fallback = SyntheticYoutube(args.synthetic_videos).respond
+    replayer = YoutubeReplayer(RecordingStore(args.recordings), latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                               quota_error_rate=args.quota_error_rate, server_error_rate=args.server_error_rate,
+                               fallback=fallback, seed=args.seed)
+    uvicorn.run(create_app(replayer), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
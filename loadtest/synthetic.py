@@ -0,0 +1,70 @@
+# loadtest/synthetic.py
+"""
+Dữ liệu YouTube tổng hợp cho test tải khi chưa có bản ghi: search.list/videos.list/channels.list
+trả kết quả cố định theo tham số từ corpus của benchmarks/corpus.py.
+"""
+import hashlib
+import json
+import random
+
+from benchmarks.corpus import make_corpus
+from Core.analysis_engine_api import AnalysisEngineAPI
+
+class SyntheticYoutube:
+    MAX_SEARCH_RESULTS = 500
+
+    def __init__(self, n_videos: int = 5000, seed: int = 1):
+        videos, channels = make_corpus(n_videos, seed=seed)
+        self.videos = {video["id"]: video for video in videos}
+        self.channels = {channel["id"]: channel for channel in channels}
+        self.channel_ids = [channel["id"] for channel in channels]
+        self.by_channel = {}
+        for video in videos:
+            self.by_channel.setdefault(video["snippet"]["channelId"], []).append(video)
+        for channel_videos in self.by_channel.values():
+            channel_videos.sort(key=lambda video: int(video["statistics"]["viewCount"]), reverse=True)
+        self._ordered = videos
+
+    @staticmethod
+    def _search_item(video):
+        return {"kind": "youtube#searchResult", "id": {"kind": "youtube#video", "videoId": video["id"]}, "snippet": video["snippet"]}
+
+    def _search(self, params):
+        """
+        (videos, nextPageToken); pageToken là vị trí bắt đầu, tối đa MAX_SEARCH_RESULTS kết quả như search.list thật.
+        """
+        limit, offset = int(params.get("maxResults", 5)), int(params.get("pageToken") or 0)
+        if params.get("channelId"):
+            matches = self.by_channel.get(params["channelId"], [])
+        else:
+            # Cùng q/order/regionCode luôn ra cùng thứ tự video
+            seed = hashlib.md5(json.dumps([params.get("q"), params.get("order"), params.get("regionCode")], ensure_ascii=False).encode("utf-8")).hexdigest()
+            matches = random.Random(seed).sample(self._ordered, min(self.MAX_SEARCH_RESULTS, len(self._ordered)))
+        end = min(offset + limit, len(matches), self.MAX_SEARCH_RESULTS)
+        return matches[offset:end], str(end) if end < min(len(matches), self.MAX_SEARCH_RESULTS) else None
+
+    def competitor_analysis(self, channel_id: str, market_keywords: list):
+        """
+        Kết quả phân tích đối thủ như /fullAnalysisByChannelId (đủ OVERTAKE_PROMPT_FIELDS), tính bằng chính
+        AnalysisEngineAPI trên 50 video nhiều view nhất của kênh; dùng làm analysisData cho /aiSuggestion.
+        """
+        engine = AnalysisEngineAPI(None, None)
+        videos = self.by_channel.get(channel_id, [])[:50] or self._ordered[:1]
+        return engine._build_competitor_analysis(engine._build_channel_summary(self.channels[channel_id]), videos, market_keywords)
+
+    def respond(self, resource: str, params: dict):
+        """
+        Body JSON (bytes) cho {resource}.list, None nếu resource không hỗ trợ.
+        """
+        page = {}
+        if resource == "search":
+            videos, next_page_token = self._search(params)
+            items = [self._search_item(video) for video in videos]
+            if next_page_token: page["nextPageToken"] = next_page_token
+        elif resource == "videos":
+            items = [self.videos[video_id] for video_id in params.get("id", "").split(",") if video_id in self.videos]
+        elif resource == "channels":
+            items = [self.channels[channel_id] for channel_id in params.get("id", "").split(",") if channel_id in self.channels]
+        else:
+            return None
+        return json.dumps({"kind": f"youtube#{resource}ListResponse", **page, "items": items}, ensure_ascii=False).encode("utf-8")
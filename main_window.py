@@ -1,9 +1,11 @@
-import sys, logging, os
+import sys, logging, os, threading
 from Core.gemini_manager import GeminiManager
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from Core.database_manager import DatabaseManager
 from Core.analysis_engine import AnalysisEngine
+from Core.api_key_pool import ApiKeyPool
+from Core.entity_cache import EntityCache
 
 # --- Cấu hình logging và import các module Core ---
 log_file = 'app_activity.log'
@@ -13,35 +15,57 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Lớp ApiManager tích hợp
 class ApiManager:
     YOUTUBE_API_SERVICE_NAME = "youtube"; YOUTUBE_API_VERSION = "v3"
-    def __init__(self, api_keys: list):
+    def __init__(self, api_keys: list, key_pool: ApiKeyPool = None, video_cache: EntityCache = None, channel_cache: EntityCache = None, transport=None, api_endpoint: str = None):
         if not api_keys: raise ValueError("Danh sách API keys không được để trống.")
-        self.api_keys, self.current_key_index = api_keys, 0; self.Youtube = self._build_service()
-    def _build_service(self):
-        api_key = self.api_keys[self.current_key_index]; logging.info(f"Sử dụng API Key index: {self.current_key_index}"); return build(self.YOUTUBE_API_SERVICE_NAME, self.YOUTUBE_API_VERSION, developerKey=api_key, cache_discovery=False)
-    def _rotate_key_and_retry(self):
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys); logging.warning(f"Quota có thể đã hết. Xoay vòng sang API Key index: {self.current_key_index}"); self.Youtube = self._build_service()
-        if self.current_key_index == 0: logging.error("Tất cả API keys có thể đã hết quota."); return False
-        return True
+        self.api_keys = api_keys; self.key_pool = key_pool or ApiKeyPool(api_keys)
+        # Cache chi tiết video/kênh dùng chung (tùy chọn); None thì luôn gọi API
+        self.video_cache, self.channel_cache = video_cache, channel_cache
+        # Core.youtube_transport.YoutubeTransport (ghi/phát lại) và root URL thay thế (stub server, ví dụ http://127.0.0.1:8765/), chỉ dùng khi test tải
+        self.transport, self.api_endpoint = transport, api_endpoint
+        # httplib2 không an toàn đa luồng: mỗi thread (thread pool của api_server) giữ service riêng cho từng key
+        self._local = threading.local()
+    def _service(self, key_index):
+        services = self._local.__dict__.setdefault('services', {})
+        if key_index not in services:
+            logging.info(f"Sử dụng API Key index: {key_index}"); services[key_index] = build(
+                self.YOUTUBE_API_SERVICE_NAME, self.YOUTUBE_API_VERSION, developerKey=self.api_keys[key_index], cache_discovery=False,
+                http=self.transport.http() if self.transport else None,
+                client_options={"api_endpoint": self.api_endpoint} if self.api_endpoint else None)
+        return services[key_index]
+    def _execute(self, method, make_request, error_message):
+        return self._request(method, make_request, error_message).get("items", [])
+    def _request(self, method, make_request, error_message):
+        # Trả về toàn bộ response ({} nếu lỗi). Mỗi lần thử lấy một key khỏe từ pool; chỉ thử key khác khi lỗi do quota/rate limit/key hỏng
+        tried = set()
+        while True:
+            key_index = self.key_pool.acquire(method, exclude=tried)
+            if key_index is None: logging.error("Tất cả API keys có thể đã hết quota."); return {}
+            tried.add(key_index)
+            try:
+                return make_request(self._service(key_index)).execute()
+            except HttpError as e:
+                if self.key_pool.report_error(key_index, e.resp.status, e.content): continue
+                logging.error(f"{error_message}: {e}", exc_info=True); return {}
+            finally:
+                self.key_pool.release(key_index)
     def search(self, **kwargs):
-        try:
-            request = self.Youtube.search().list(**kwargs); response = request.execute(); return response.get("items", [])
-        except HttpError as e:
-            if e.resp.status == 403 or e.resp.status == 400:
-                if self._rotate_key_and_retry(): return self.search(**kwargs)
-            logging.error(f"Lỗi API khi tìm kiếm: {e}", exc_info=True); return []
+        return self._execute("search", lambda youtube: youtube.search().list(**kwargs), "Lỗi API khi tìm kiếm")
+    def search_page(self, **kwargs):
+        # Một trang search.list: (items, nextPageToken); nextPageToken là None ở trang cuối hoặc khi lỗi
+        response = self._request("search", lambda youtube: youtube.search().list(**kwargs), "Lỗi API khi tìm kiếm")
+        return response.get("items", []), response.get("nextPageToken")
     def get_video_details(self, video_ids: list):
         if not video_ids: return []
-        try:
-            request = self.Youtube.videos().list(part="snippet,statistics,contentDetails", id=",".join(video_ids)); response = request.execute(); return response.get("items", [])
-        except HttpError as e:
-            if e.resp.status == 403:
-                if self._rotate_key_and_retry(): return self.get_video_details(video_ids)
-            logging.error(f"Lỗi API khi lấy chi tiết video: {e}", exc_info=True); return []
+        if self.video_cache is None: return self._fetch_videos(video_ids)
+        return self.video_cache.get_many(video_ids, self._fetch_videos, lambda ids: self._fetch_videos(ids, part="statistics"))
     def get_channel_details(self, channel_ids: list):
         if not channel_ids: return []
-        try:
-            request = self.Youtube.channels().list(part="snippet,statistics", id=",".join(channel_ids)); response = request.execute(); return response.get("items", [])
-        except HttpError as e:
-            if e.resp.status == 403:
-                if self._rotate_key_and_retry(): return self.get_channel_details(channel_ids)
-            logging.error(f"Lỗi API khi lấy chi tiết kênh: {e}", exc_info=True); return []
\ No newline at end of file
+        if self.channel_cache is None: return self._fetch_channels(channel_ids)
+        return self.channel_cache.get_many(channel_ids, self._fetch_channels, lambda ids: self._fetch_channels(ids, part="statistics"))
+    def _fetch_videos(self, video_ids, part="snippet,statistics,contentDetails"):
+        return [item for chunk in self._chunks(video_ids) for item in self._execute("videos", lambda youtube: youtube.videos().list(part=part, id=",".join(chunk)), "Lỗi API khi lấy chi tiết video")]
+    def _fetch_channels(self, channel_ids, part="snippet,statistics"):
+        return [item for chunk in self._chunks(channel_ids) for item in self._execute("channels", lambda youtube: youtube.channels().list(part=part, id=",".join(chunk)), "Lỗi API khi lấy chi tiết kênh")]
+    def _chunks(self, ids, size=50):
+        # videos.list/channels.list nhận tối đa 50 ID mỗi lần gọi
+        return [ids[i:i + size] for i in range(0, len(ids), size)]
\ No newline at end of file
@@ -4,6 +4,10 @@ from fastapi_cache.backends.inmemory import InMemoryBackend
 from fastapi_cache.decorator import cache
 import logging
 
+import metrics
+
+CACHE_LOOKUPS = metrics.Counter("manage_cache_lookups_total", "Số lượt tra cứu ManageCache (bộ nhớ) theo kết quả.", ["result"])
+
 class ManageCache:
     def __init__(self):
         logging.basicConfig(level=logging.INFO)
@@ -16,11 +20,13 @@ class ManageCache:
         self.cache = FastAPICache.get_backend()
     
     async def get(self, key):
-        logging.info(f"Fetching from cache with key: {key}")
-        return await self.cache.get(key)
+        logging.debug("Fetching from cache with key: %s", key)
+        value = await self.cache.get(key)
+        CACHE_LOOKUPS.inc("hit" if value is not None else "miss")
+        return value
     
     async def set(self, key, value, expireVal=60):
-        logging.info(f"Setting cache with key: {key}, expire: {expireVal} seconds")
+        logging.debug("Setting cache with key: %s, expire: %s seconds", key, expireVal)
         await self.cache.set(key, value, expire=expireVal)
     
     def clear(self):
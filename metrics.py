@@ -0,0 +1,159 @@
+import bisect
+import logging
+import math
+import threading
+
+# Định dạng text exposition 0.0.4 của Prometheus
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+class _Shards:
+    """
+    Mỗi luồng ghi vào dict riêng của nó (threading.local) nên đường nóng không cần khóa;
+    khóa chỉ dùng khi một luồng ghi lần đầu và khi /metrics gộp số liệu các luồng.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def mine(self):
+        values = getattr(self._local, "values", None)
+        if values is None:
+            values = {}
+            with self._lock:
+                self._all.append(values)
+            self._local.values = values
+        return values
+
+    def all(self):
+        with self._lock:
+            return list(self._all)
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """
+    Bộ đếm tăng dần theo nhãn: inc("GET", "/path") hoặc add(5, "search", "0").
+    """
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._shards = _Shards()
+        _register(self)
+
+    def inc(self, *labelvalues):
+        values = self._shards.mine()
+        values[labelvalues] = values.get(labelvalues, 0) + 1
+
+    def add(self, amount, *labelvalues):
+        values = self._shards.mine()
+        values[labelvalues] = values.get(labelvalues, 0) + amount
+
+    def collect(self):
+        totals = {}
+        for shard in self._shards.all():
+            for labelvalues, value in list(shard.items()):
+                totals[labelvalues] = totals.get(labelvalues, 0) + value
+        return [f"{self.name}{_labels(self.labelnames, labelvalues)} {_format_value(value)}" for labelvalues, value in sorted(totals.items())]
+
+class Histogram:
+    """
+    Histogram theo nhãn với các bucket cố định: observe(0.12, "POST", "/discoverKeywords").
+    """
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._shards = _Shards()
+        _register(self)
+
+    def observe(self, value, *labelvalues):
+        values = self._shards.mine()
+        state = values.get(labelvalues)
+        if state is None:
+            # [số mẫu theo bucket (không cộng dồn, phần tử cuối là +Inf), tổng, số mẫu]
+            state = values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def collect(self):
+        merged = {}
+        for shard in self._shards.all():
+            for labelvalues, (counts, total, count) in list(shard.items()):
+                target = merged.setdefault(labelvalues, [[0] * (len(self.buckets) + 1), 0.0, 0])
+                target[0] = [a + b for a, b in zip(target[0], counts)]
+                target[1] += total
+                target[2] += count
+        lines = []
+        for labelvalues, (counts, total, count) in sorted(merged.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, [('le', _format_value(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {count}")
+        return lines
+
+class Callback:
+    """
+    Metric đọc tại thời điểm /metrics được gọi (không tốn gì trên đường nóng), dùng cho các stats() sẵn có.
+    func() trả về list (labelvalues, value); metric_type là "gauge" hoặc "counter".
+    """
+    def __init__(self, name: str, documentation: str, labelnames, func, metric_type: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self.type_name = metric_type
+        _register(self)
+
+    def collect(self):
+        return [f"{self.name}{_labels(self.labelnames, labelvalues)} {_format_value(value)}" for labelvalues, value in self.func()]
+
+def render():
+    """
+    Toàn bộ metric đã đăng ký theo định dạng text của Prometheus.
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        try:
+            samples = metric.collect()
+        except Exception as e:
+            logging.warning(f"metrics: không thu thập được {metric.name}: {e!r}")
+            continue
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type_name}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
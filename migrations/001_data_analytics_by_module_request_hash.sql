@@ -0,0 +1,77 @@
+-- Chuẩn hóa, khử trùng lặp và đánh chỉ mục youtrader.data_analytics_by_module theo hash của request.
+-- Giả định request_data/response_data đang là kiểu text (db.py ghi bằng json.dumps).
+-- Chạy một lần: psql "$DATABASE_URL" -f migrations/001_data_analytics_by_module_request_hash.sql
+
+BEGIN;
+
+-- 1. Request cũ ở dạng mà code mới tra cứu: áp dụng analysis_cache.normalize_request (gộp khoảng trắng thừa
+--    trong chuỗi và phần tử chuỗi của list, regionCode viết hoa) rồi in theo JSON chuẩn của canonical_json
+--    (cùng định dạng với jsonb::text: khóa ngắn trước, phân cách ", " và ": ").
+CREATE FUNCTION pg_temp.normalize_request_text(value text) RETURNS text
+    LANGUAGE sql IMMUTABLE
+    AS $$ SELECT btrim(regexp_replace(value, '\s+', ' ', 'g'), ' ') $$;
+
+CREATE TEMP TABLE normalized_request ON COMMIT DROP AS
+SELECT t.id,
+       t.module,
+       coalesce((
+           SELECT jsonb_object_agg(e.key, CASE
+                      WHEN jsonb_typeof(e.value) = 'string' AND e.key = 'regionCode'
+                          THEN to_jsonb(upper(pg_temp.normalize_request_text(e.value #>> '{}')))
+                      WHEN jsonb_typeof(e.value) = 'string'
+                          THEN to_jsonb(pg_temp.normalize_request_text(e.value #>> '{}'))
+                      WHEN jsonb_typeof(e.value) = 'array'
+                          THEN (SELECT coalesce(jsonb_agg(CASE WHEN jsonb_typeof(a.value) = 'string'
+                                                               THEN to_jsonb(pg_temp.normalize_request_text(a.value #>> '{}'))
+                                                               ELSE a.value END ORDER BY a.ord), '[]'::jsonb)
+                                  FROM jsonb_array_elements(e.value) WITH ORDINALITY AS a(value, ord))
+                      ELSE e.value END)
+             FROM jsonb_each(t.request_data::jsonb) AS e
+       ), '{}'::jsonb)::text AS request_data
+  FROM youtrader.data_analytics_by_module t
+ WHERE t.request_data IS NOT NULL
+   AND jsonb_typeof(t.request_data::jsonb) = 'object';
+
+-- 2. Các request chỉ khác nhau về khoảng trắng/chữ hoa trở thành một: chỉ giữ bản quét gần nhất
+--    (xóa trước khi UPDATE để không vướng chỉ mục unique nếu migration đã từng chạy)
+DELETE FROM youtrader.data_analytics_by_module d
+ USING (
+    SELECT n.id,
+           row_number() OVER (
+               PARTITION BY n.module, n.request_data
+               ORDER BY t.lasted_scan_date DESC NULLS LAST, t.create_date DESC NULLS LAST, t.id DESC
+           ) AS rn
+      FROM normalized_request n
+      JOIN youtrader.data_analytics_by_module t ON t.id = n.id
+ ) ranked
+ WHERE d.id = ranked.id
+   AND ranked.rn > 1;
+
+UPDATE youtrader.data_analytics_by_module d
+   SET request_data = n.request_data
+  FROM normalized_request n
+ WHERE d.id = n.id
+   AND d.request_data <> n.request_data;
+
+-- 3. Hash của request được lưu sẵn, luôn khớp với request_data
+ALTER TABLE youtrader.data_analytics_by_module
+    ADD COLUMN IF NOT EXISTS request_hash text GENERATED ALWAYS AS (md5(request_data)) STORED;
+
+-- 4. Khử nốt bản ghi trùng còn lại (request_data không phải object JSON), giữ bản quét gần nhất
+DELETE FROM youtrader.data_analytics_by_module d
+ USING (
+    SELECT id,
+           row_number() OVER (
+               PARTITION BY module, request_hash
+               ORDER BY lasted_scan_date DESC NULLS LAST, create_date DESC NULLS LAST, id DESC
+           ) AS rn
+      FROM youtrader.data_analytics_by_module
+ ) ranked
+ WHERE d.id = ranked.id
+   AND ranked.rn > 1;
+
+-- 5. Mỗi module chỉ có một bản ghi cho một request; dùng cho tra cứu và INSERT ... ON CONFLICT
+CREATE UNIQUE INDEX IF NOT EXISTS data_analytics_by_module_module_request_hash_uq
+    ON youtrader.data_analytics_by_module (module, request_hash);
+
+COMMIT;
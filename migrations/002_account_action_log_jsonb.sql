@@ -0,0 +1,20 @@
+-- Chuyển youtrader.account_.action_log sang jsonb để bộ đếm lượt dùng được tăng nguyên tử
+-- bằng một câu UPDATE ... RETURNING (db.consume_usage_counter) thay cho đọc - sửa - ghi cả chuỗi JSON.
+-- Giả định action_log đang là kiểu text (ActionLogModel.toJson ghi bằng json.dumps).
+-- Chạy một lần: psql "$DATABASE_URL" -f migrations/002_account_action_log_jsonb.sql
+
+BEGIN;
+
+-- 1. Chuỗi rỗng và 'null' trở thành NULL (bộ đếm mặc định 0)
+ALTER TABLE youtrader.account_
+    ALTER COLUMN action_log TYPE jsonb
+    USING CASE
+        WHEN action_log IS NULL OR btrim(action_log) IN ('', 'null') THEN NULL
+        ELSE action_log::jsonb
+    END;
+
+-- 2. Tra cứu và cập nhật bộ đếm theo user_id
+CREATE INDEX IF NOT EXISTS account__user_id_idx
+    ON youtrader.account_ (user_id);
+
+COMMIT;
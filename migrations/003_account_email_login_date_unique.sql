@@ -0,0 +1,18 @@
+-- Mỗi email chỉ có một bản ghi đăng nhập cho một ngày, để db.handle_login_db dùng
+-- INSERT ... ON CONFLICT (email, login_date) thay cho SELECT rồi UPDATE/INSERT.
+-- Chạy một lần: psql "$DATABASE_URL" -f migrations/003_account_email_login_date_unique.sql
+
+BEGIN;
+
+-- 1. Xóa bản ghi trùng (email, login_date), giữ bản ghi được ghi sau cùng
+DELETE FROM youtrader.account_ a
+ USING youtrader.account_ b
+ WHERE a.email = b.email
+   AND a.login_date = b.login_date
+   AND a.ctid < b.ctid;
+
+-- 2. Khóa cho upsert đăng nhập
+CREATE UNIQUE INDEX IF NOT EXISTS account__email_login_date_uq
+    ON youtrader.account_ (email, login_date);
+
+COMMIT;
@@ -0,0 +1,21 @@
+-- Cache kế hoạch Gemini (/aiSuggestion) theo nội dung, dùng bởi plan_cache.GeminiPlanCache.
+-- plan_hash = sha256 của model và input đã chuẩn hóa của prompt; hết hạn theo create_date, LRU theo last_hit_date.
+-- Chạy một lần: psql "$DATABASE_URL" -f migrations/004_gemini_plan_cache.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS youtrader.gemini_plan_cache (
+    plan_hash      text PRIMARY KEY,
+    model          text NOT NULL,
+    request_data   text,
+    response_text  text NOT NULL,
+    create_date    timestamp NOT NULL DEFAULT LOCALTIMESTAMP,
+    last_hit_date  timestamp NOT NULL DEFAULT LOCALTIMESTAMP,
+    hit_count      integer NOT NULL DEFAULT 0
+);
+
+-- Dọn theo LRU (ORDER BY last_hit_date DESC OFFSET max_entries)
+CREATE INDEX IF NOT EXISTS gemini_plan_cache_last_hit_date_idx
+    ON youtrader.gemini_plan_cache (last_hit_date);
+
+COMMIT;
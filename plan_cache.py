@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+from analysis_cache import canonical_json, normalize_request
+from Core.gemini_manager import OVERTAKE_PROMPT_FIELDS, OVERTAKE_PROMPT_VERSION
+from db import get_gemini_plan, gemini_plan_insert, prune_gemini_plans
+from single_flight import SingleFlight
+from timing import span
+
+def plan_inputs(competitor_data, market_keywords):
+    """
+    Phần input thực sự đi vào prompt (OVERTAKE_PROMPT_FIELDS và market_keywords), đã chuẩn hóa như normalize_request.
+    Prompt được dựng từ chính input này nên hai request cùng input luôn cho cùng prompt.
+    """
+    competitor_data = competitor_data or {}
+    competitor = normalize_request({field: competitor_data[field] for field in OVERTAKE_PROMPT_FIELDS if field in competitor_data})
+    return competitor, normalize_request({"marketKeywords": list(market_keywords or [])})["marketKeywords"]
+
+class GeminiPlanCache:
+    """
+    Cache kế hoạch Gemini theo nội dung, lưu trong PostgreSQL (youtrader.gemini_plan_cache, migrations/004):
+    - khóa là sha256 của model, phiên bản prompt và input đã chuẩn hóa (plan_inputs), không phụ thuộc user;
+    - hết hạn sau ttl giây kể từ lúc sinh (GEMINI_PLAN_CACHE_TTL);
+    - giữ tối đa max_entries bản ghi (GEMINI_PLAN_CACHE_MAX_ENTRIES), dọn theo LRU (last_hit_date) sau mỗi prune_every lần ghi.
+    Các lượt sinh cùng khóa đang chạy được gộp qua SingleFlight. Lỗi DB chỉ làm mất cache, không làm hỏng request.
+    """
+    def __init__(self, single_flight: SingleFlight, ttl: float = None, max_entries: int = None, prune_every: int = None):
+        self.single_flight = single_flight
+        self.ttl = ttl if ttl is not None else float(os.getenv("GEMINI_PLAN_CACHE_TTL", str(24 * 3600)))
+        self.max_entries = max_entries or int(os.getenv("GEMINI_PLAN_CACHE_MAX_ENTRIES", "10000"))
+        self.prune_every = prune_every or int(os.getenv("GEMINI_PLAN_CACHE_PRUNE_EVERY", "100"))
+        self.stats_counters = {"hits": 0, "misses": 0, "stores": 0, "errors": 0, "pruned": 0}
+        self._writes_since_prune = 0
+        self._pruning = False
+
+    @staticmethod
+    def request_data(model: str, competitor: dict, market_keywords: list):
+        return canonical_json({"model": model, "version": OVERTAKE_PROMPT_VERSION, "competitor": competitor, "marketKeywords": market_keywords})
+
+    @staticmethod
+    def key(request_data: str):
+        return hashlib.sha256(request_data.encode("utf-8")).hexdigest()
+
+    async def get(self, plan_hash: str):
+        """
+        Kế hoạch đã cache (str) hoặc None.
+        """
+        try:
+            with span("plan_cache"):
+                text = await get_gemini_plan(plan_hash, self.ttl)
+        except Exception as e:
+            self.stats_counters["errors"] += 1
+            logging.warning(f"GeminiPlanCache: không đọc được cache: {e!r}")
+            return None
+        self.stats_counters["hits" if text is not None else "misses"] += 1
+        return text
+
+    async def put(self, plan_hash: str, model: str, request_data: str, text: str):
+        try:
+            await gemini_plan_insert(plan_hash, model, request_data, text)
+        except Exception as e:
+            self.stats_counters["errors"] += 1
+            logging.warning(f"GeminiPlanCache: không ghi được cache: {e!r}")
+            return
+        self.stats_counters["stores"] += 1
+        self._writes_since_prune += 1
+        if self._writes_since_prune >= self.prune_every and not self._pruning:
+            self._writes_since_prune = 0
+            self._pruning = True
+            asyncio.ensure_future(self._prune())
+
+    async def _prune(self):
+        try:
+            deleted = await prune_gemini_plans(self.ttl, self.max_entries)
+            self.stats_counters["pruned"] += deleted
+            if deleted:
+                logging.info(f"GeminiPlanCache: đã xóa {deleted} kế hoạch hết hạn hoặc ít dùng")
+        except Exception as e:
+            logging.warning(f"GeminiPlanCache: dọn cache thất bại: {e!r}")
+        finally:
+            self._pruning = False
+
+    async def get_or_generate(self, model: str, competitor: dict, market_keywords: list, generate):
+        """
+        Kế hoạch cho input đã chuẩn hóa: lấy từ cache, nếu chưa có thì chạy generate() (coroutine function trả về str,
+        ném lỗi khi thất bại) và lưu lại. Lỗi và kết quả rỗng của generate không được cache.
+        """
+        request_data = self.request_data(model, competitor, market_keywords)
+        plan_hash = self.key(request_data)
+        cached = await self.get(plan_hash)
+        if cached is not None:
+            return cached
+
+        async def leader():
+            text = await generate()
+            # Gemini có thể trả candidate rỗng (không có blockReason): trả về cho caller nhưng không cache
+            if text:
+                await self.put(plan_hash, model, request_data, text)
+            return text
+
+        return await self.single_flight.do(f"gemini_plan:{plan_hash}", leader)
+
+    def stats(self):
+        lookups = self.stats_counters["hits"] + self.stats_counters["misses"]
+        return {**self.stats_counters, "hit_ratio": round(self.stats_counters["hits"] / lookups, 4) if lookups else 0}
@@ -0,0 +1,37 @@
+import asyncio
+import logging
+
+class SingleFlight:
+    """
+    Gộp các request giống nhau đang chạy đồng thời: request đầu tiên (leader) chạy hàm,
+    các request đến sau (follower) cùng khóa chỉ chờ kết quả của leader.
+    Công việc chạy trong task riêng nên client của leader ngắt kết nối cũng không hủy kết quả của follower.
+    """
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: str, func, *args):
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(func(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.followers += 1
+            logging.info(f"SingleFlight: chờ kết quả request đang chạy cho key {key}")
+        return await asyncio.shield(task)
+
+    def is_running(self, key: str):
+        return key in self._calls
+
+    def _finish(self, key, task):
+        self._calls.pop(key, None)
+        # Đánh dấu lỗi đã được xử lý khi mọi request chờ đều đã ngắt kết nối
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"SingleFlight: request cho key {key} lỗi: {task.exception()!r}")
+
+    def stats(self):
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "followers": self.followers}
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import os
+
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+# Comment giữ kết nối, để proxy (Railway/nginx) không cắt stream khi một bước phân tích chạy lâu
+SSE_PING_INTERVAL = float(os.getenv("SSE_PING_INTERVAL", "15"))
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def format_event(event: str, data):
+    """
+    Một sự kiện SSE; data là object Python hoặc JSON đã mã hóa sẵn (bytes, ví dụ kết quả từ AnalysisCache).
+    """
+    payload = data if isinstance(data, bytes) else orjson.dumps(data)
+    return b"event: " + event.encode() + b"\n" + b"".join(b"data: " + line + b"\n" for line in payload.split(b"\n")) + b"\n"
+
+async def drain_queue(queue: asyncio.Queue, task: asyncio.Future):
+    """
+    Trả ra các phần tử của queue cho đến khi task xong (kể cả phần còn lại trong queue), rồi ném lỗi của task nếu có.
+    """
+    getter = None
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield getter.result()
+                continue
+            getter.cancel()
+            while not queue.empty():
+                yield queue.get_nowait()
+            task.result()
+            return
+    finally:
+        if getter is not None and not getter.done():
+            getter.cancel()
+
+async def single_event(event: str, data):
+    yield event, data
+
+async def event_stream(events, ping_interval: float = None):
+    """
+    Chuyển async iterator (tên sự kiện, data) thành luồng byte SSE, chèn ": ping" khi chờ lâu.
+    Lỗi giữa chừng được gửi thành sự kiện "error" (status HTTP đã gửi đi từ trước).
+    """
+    ping_interval = ping_interval if ping_interval is not None else SSE_PING_INTERVAL
+    iterator = events.__aiter__()
+    pending = None
+    try:
+        while True:
+            pending = asyncio.ensure_future(iterator.__anext__())
+            while not (await asyncio.wait({pending}, timeout=ping_interval))[0]:
+                yield b": ping\n\n"
+            try:
+                event, data = pending.result()
+            except StopAsyncIteration:
+                return
+            pending = None
+            yield format_event(event, data)
+    except HTTPException as e:
+        yield format_event("error", {"status_code": e.status_code, "detail": e.detail})
+    except Exception as e:
+        logging.error(f"SSE: lỗi khi phát sự kiện: {e!r}", exc_info=True)
+        yield format_event("error", {"status_code": 500, "detail": "Internal server error"})
+    finally:
+        # Client ngắt kết nối: hủy bước đang chờ rồi đóng iterator để các task con được dọn
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except BaseException:
+                pass
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+def EventStreamResponse(events):
+    return StreamingResponse(event_stream(events), media_type="text/event-stream", headers=SSE_HEADERS)
@@ -0,0 +1,98 @@
+import contextvars
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+
+# Bộ ghi span của request hiện tại; các task con (gather/ensure_future) và thread pool (workload) thừa hưởng qua contextvars
+_current = contextvars.ContextVar("request_timings", default=None)
+
+class RequestTimings:
+    """
+    Danh sách span (tên, thời gian) của một request, dùng cho header Server-Timing và log request chậm.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []  # list.append an toàn giữa các luồng
+
+    def add(self, name: str, duration: float):
+        self.spans.append((name, duration))
+
+    def summary(self):
+        """
+        Gộp các span cùng tên: {tên: (tổng thời gian, số lần)}, giữ thứ tự xuất hiện đầu tiên.
+        Span chạy song song (ví dụ top_video của nhiều kênh) nên tổng có thể lớn hơn thời gian thực.
+        """
+        totals = {}
+        for name, duration in list(self.spans):
+            total, count = totals.get(name, (0.0, 0))
+            totals[name] = (total + duration, count + 1)
+        return totals
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self, total: float = None):
+        entries = []
+        for name, (duration, count) in self.summary().items():
+            entry = f"{name};dur={duration * 1000:.1f}"
+            if count > 1:
+                entry += f';desc="x{count}"'
+            entries.append(entry)
+        entries.append(f"total;dur={(self.elapsed() if total is None else total) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def describe(self):
+        return ", ".join(
+            f"{name}={duration * 1000:.0f}ms" + (f" (x{count})" if count > 1 else "")
+            for name, (duration, count) in self.summary().items()
+        )
+
+def start_request():
+    """
+    Bắt đầu ghi span cho request hiện tại; trả về (RequestTimings, token) để reset khi xong.
+    """
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+def end_request(token):
+    _current.reset(token)
+
+def record(name: str, duration: float):
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, duration)
+
+@contextmanager
+def span(name: str):
+    """
+    with span("demand"): ... ghi thời gian của khối lệnh vào request hiện tại (không có request thì bỏ qua).
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+def timed(name: str):
+    """
+    Decorator ghi span cho cả hàm đồng bộ và coroutine function.
+    """
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
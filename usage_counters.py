@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import time
+
+from ActionLogModel import MEMBER_TYPE_NORMAL, DEFAULT_COUNT_CALL_API_CONFIG
+from db import get_usage_counter, consume_usage_counter
+
+class UsageCounters:
+    """
+    Bộ đếm lượt dùng theo user/module (action_log.<module>.countCallAPI) có cache trong tiến trình.
+    - get(): đọc từ bộ nhớ (tối đa ttl giây), hết hạn mới hỏi DB (chỉ các cột bộ đếm).
+    - consume(): mặc định tăng nguyên tử trên DB bằng một câu UPDATE ... RETURNING có kiểm tra giới hạn.
+    - write_behind: giới hạn được kiểm tra và tăng ngay trong bộ nhớ, số lượt tăng được gộp và ghi DB định kỳ
+      (flush_interval). Nhanh hơn nhưng giới hạn chỉ chính xác trong một tiến trình và có thể mất lượt chưa
+      ghi nếu tiến trình chết đột ngột.
+    """
+    def __init__(self, ttl: float = None, write_behind: bool = None, flush_interval: float = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv("USAGE_CACHE_TTL", "30"))
+        self.write_behind = write_behind if write_behind is not None else os.getenv("USAGE_WRITE_BEHIND", "0") == "1"
+        self.flush_interval = flush_interval if flush_interval is not None else float(os.getenv("USAGE_FLUSH_INTERVAL", "2"))
+        self._entries = {}  # (user_id, module) -> {"member_type", "count", "limit", "loaded_at"}
+        self._pending = {}  # (user_id, module) -> số lượt đã tăng trong bộ nhớ, chưa ghi DB
+        self._flushing = set()
+        self._flusher = None
+        self.stats_counters = {"hits": 0, "loads": 0, "consumed": 0, "refunded": 0, "rejected": 0, "flushes": 0, "flush_errors": 0}
+
+    def _remember(self, key, row):
+        entry = {
+            "member_type": row["member_type"],
+            "count": row["count_call_api"] + self._pending.get(key, 0),
+            "limit": row["count_call_api_config"],
+            "loaded_at": time.monotonic(),
+        }
+        self._entries[key] = entry
+        return entry
+
+    @staticmethod
+    def _as_action_log(module, entry):
+        # Cùng cấu trúc với action_log để dùng lại ActionLogModel/DataModule1Config
+        return {"memberType": entry["member_type"], module: {"countCallAPI": entry["count"], "countCallAPIConfig": entry["limit"]}}
+
+    async def _load(self, user_id, module, conn=None):
+        key = (user_id, module)
+        entry = self._entries.get(key)
+        # Còn lượt chưa ghi DB thì không đọc lại, tránh mất số lượt đang chờ
+        if entry is not None and (time.monotonic() - entry["loaded_at"] < self.ttl or key in self._pending or key in self._flushing):
+            self.stats_counters["hits"] += 1
+            return entry
+        self.stats_counters["loads"] += 1
+        row = await get_usage_counter(user_id, module, MEMBER_TYPE_NORMAL, DEFAULT_COUNT_CALL_API_CONFIG, conn=conn)
+        if row is None:
+            self._entries.pop(key, None)
+            return None
+        return self._remember(key, row)
+
+    async def get(self, user_id: str, module: str = "module1", conn=None):
+        """
+        Trả về action_log của user cho module ({"memberType": ..., module: {...}}), None nếu user không tồn tại.
+        """
+        entry = await self._load(user_id, module, conn)
+        return self._as_action_log(module, entry) if entry is not None else None
+
+    async def consume(self, user_id: str, module: str = "module1", conn=None):
+        """
+        Dùng một lượt: trả về action_log sau khi tăng, hoặc None nếu đã hết lượt (hoặc user không tồn tại).
+        """
+        key = (user_id, module)
+        if self.write_behind:
+            entry = await self._load(user_id, module, conn)
+            # Không có await giữa kiểm tra và tăng nên an toàn với các request đồng thời trong cùng event loop
+            if entry is None or entry["count"] > entry["limit"]:
+                self.stats_counters["rejected"] += 1
+                return None
+            entry["count"] += 1
+            self._pending[key] = self._pending.get(key, 0) + 1
+            self.stats_counters["consumed"] += 1
+            return self._as_action_log(module, entry)
+
+        row = await consume_usage_counter(user_id, module, 1, MEMBER_TYPE_NORMAL, DEFAULT_COUNT_CALL_API_CONFIG, conn=conn)
+        if row is None:
+            self._entries.pop(key, None)
+            self.stats_counters["rejected"] += 1
+            return None
+        self.stats_counters["consumed"] += 1
+        return self._as_action_log(module, self._remember(key, row))
+
+    async def refund(self, user_id: str, module: str = "module1", conn=None):
+        """
+        Trả lại một lượt đã consume (ví dụ phân tích không có kết quả), cùng cách ghi với consume.
+        """
+        key = (user_id, module)
+        if self.write_behind:
+            entry = await self._load(user_id, module, conn)
+            if entry is not None:
+                entry["count"] -= 1
+                self._pending[key] = self._pending.get(key, 0) - 1
+                self.stats_counters["refunded"] += 1
+            return
+        row = await consume_usage_counter(user_id, module, -1, MEMBER_TYPE_NORMAL, DEFAULT_COUNT_CALL_API_CONFIG, enforce_limit=False, conn=conn)
+        if row is not None:
+            self.stats_counters["refunded"] += 1
+            self._remember(key, row)
+
+    async def flush(self):
+        """
+        Ghi các lượt tăng đang chờ xuống DB, mỗi (user, module) một câu UPDATE.
+        """
+        pending, self._pending = self._pending, {}
+        # Đánh dấu mọi khóa trước lần await đầu tiên: khóa chờ tới lượt cũng không được _load đọc lại từ DB
+        self._flushing.update(pending)
+        try:
+            for key, amount in pending.items():
+                user_id, module = key
+                try:
+                    row = await consume_usage_counter(user_id, module, amount, MEMBER_TYPE_NORMAL, DEFAULT_COUNT_CALL_API_CONFIG, enforce_limit=False)
+                    if row is not None:
+                        self._remember(key, row)
+                    self.stats_counters["flushes"] += 1
+                except Exception as e:
+                    self._pending[key] = self._pending.get(key, 0) + amount
+                    self.stats_counters["flush_errors"] += 1
+                    logging.warning(f"UsageCounters: ghi bộ đếm cho user {user_id} thất bại, thử lại lần sau: {e!r}")
+                finally:
+                    self._flushing.discard(key)
+        finally:
+            # Bị hủy giữa chừng (stop): các khóa chưa tới lượt quay lại hàng chờ
+            for key in pending:
+                if key in self._flushing:
+                    self._flushing.discard(key)
+                    self._pending[key] = self._pending.get(key, 0) + pending[key]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self.write_behind and self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            **self.stats_counters,
+            "write_behind": self.write_behind,
+            "entries": len(self._entries),
+            "pending_users": len(self._pending),
+            "pending_calls": sum(self._pending.values()),
+        }
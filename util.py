@@ -1,14 +1,183 @@
 import time
 import json
 import logging
+import logging.handlers
+import os
+import queue
+import threading
 from datetime import date
 
-def write_log(method: str, actionType: str, message: str):
-    log_message = f"[{method}][{actionType}] ==> {
-        json.dumps({
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "result": message
-        })}"
-    with open("api_server.log", "a") as log_file:
-        log_file.write(log_message + "\n") 
-    logging.info(log_message)
\ No newline at end of file
+# Logger riêng cho nhật ký hành động của API (api_server.log), vẫn lan truyền lên root như logging.info cũ
+action_logger = logging.getLogger("api_server.actions")
+
+LOG_FILE = os.getenv("LOG_FILE", "api_server.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "256"))
+# Nội dung log dài hơn ngưỡng này (payload, action log...) bị cắt bớt
+LOG_MAX_MESSAGE_CHARS = int(os.getenv("LOG_MAX_MESSAGE_CHARS", "2000"))
+
+def write_log(method: str, actionType: str, message: str, *args):
+    """
+    Ghi một dòng nhật ký hành động. message có thể là chuỗi định dạng kiểu logging ("... %s", arg):
+    args chỉ được định dạng ở luồng ghi log nền, và chỉ khi mức INFO đang bật.
+    """
+    if not action_logger.isEnabledFor(logging.INFO):
+        return
+    action_logger.info(message, *args, extra={"action_method": method, "action_type": actionType})
+
+def truncate_message(message: str, limit: int = None):
+    limit = LOG_MAX_MESSAGE_CHARS if limit is None else limit
+    if limit <= 0 or len(message) <= limit:
+        return message
+    return f"{message[:limit]}... (+{len(message) - limit} ký tự)"
+
+class ActionLogFormatter(logging.Formatter):
+    """
+    Định dạng dòng log giống write_log cũ: [method][actionType] ==> {"timestamp": ..., "result": ...}
+    """
+    def format(self, record):
+        return f"[{getattr(record, 'action_method', record.name)}][{getattr(record, 'action_type', record.levelname)}] ==> " + json.dumps({
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created)),
+            "result": record.getMessage(),
+        })
+
+class BatchedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler không flush sau từng dòng; luồng ghi log gọi flush_batch() sau mỗi lô.
+    """
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Phía request chỉ đẩy record vào hàng đợi: không định dạng, không I/O.
+    Hàng đợi đầy thì bỏ record thay vì chặn request.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Việc định dạng (getMessage, cắt payload) được dời sang luồng ghi log
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogWriter(threading.Thread):
+    """
+    Luồng nền lấy record từ hàng đợi theo lô (tối đa batch_size), định dạng, cắt bớt payload lớn
+    rồi ghi cho các handler; file chỉ flush một lần mỗi lô.
+    """
+    _STOP = object()
+
+    def __init__(self, log_queue, handlers, batch_size: int = LOG_BATCH_SIZE):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = log_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.written = 0
+        self.batches = 0
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = False
+            for record in batch:
+                if record is self._STOP:
+                    stopping = True
+                    continue
+                self._handle(record)
+            self._flush()
+            if stopping:
+                return
+
+    def _handle(self, record):
+        try:
+            record.msg = truncate_message(record.getMessage())
+            record.args = None
+        except Exception:
+            record.msg, record.args = f"Không định dạng được log: {record.msg!r}", None
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        self.written += 1
+
+    def _flush(self):
+        self.batches += 1
+        for handler in self.handlers:
+            try:
+                handler.flush_batch() if isinstance(handler, BatchedRotatingFileHandler) else handler.flush()
+            except Exception:
+                pass
+
+    def stop(self):
+        self.queue.put(self._STOP)
+        self.join(timeout=5)
+
+_queue_handler = None
+_writer = None
+
+def setup_logging():
+    """
+    Chuyển toàn bộ logging sang pipeline hàng đợi: root logger chỉ còn NonBlockingQueueHandler,
+    các handler hiện có của root (console, app_activity.log) và file api_server.log (xoay vòng theo dung lượng)
+    được ghi bởi LogWriter ở luồng nền. Gọi nhiều lần chỉ cấu hình một lần.
+    """
+    global _queue_handler, _writer
+    if _writer is not None:
+        return
+    root = logging.getLogger()
+    if root.level == logging.NOTSET or root.level > logging.INFO:
+        root.setLevel(logging.INFO)
+
+    action_file_handler = BatchedRotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8", delay=True)
+    action_file_handler.setFormatter(ActionLogFormatter())
+    action_file_handler.addFilter(logging.Filter(action_logger.name))
+
+    handlers = list(root.handlers) + [action_file_handler]
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _queue_handler = NonBlockingQueueHandler(log_queue)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+
+    _writer = LogWriter(log_queue, handlers)
+    _writer.start()
+
+def shutdown_logging():
+    """
+    Ghi nốt các record còn trong hàng đợi và đóng file log.
+    """
+    global _queue_handler, _writer
+    if _writer is None:
+        return
+    _writer.stop()
+    for handler in _writer.handlers:
+        handler.close()
+    logging.getLogger().removeHandler(_queue_handler)
+    _queue_handler, _writer = None, None
+
+def logging_stats():
+    if _writer is None:
+        return {"enabled": False}
+    return {
+        "enabled": True,
+        "queued": _queue_handler.queue.qsize(),
+        "dropped": _queue_handler.dropped,
+        "written": _writer.written,
+        "batches": _writer.batches,
+    }
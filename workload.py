@@ -0,0 +1,125 @@
+import asyncio
+import contextvars
+import inspect
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+
+import timing
+
+class EndpointLimiter:
+    """
+    Giới hạn số tác vụ chạy song song của một endpoint, kèm hàng đợi có giới hạn.
+    Khi hàng đợi đầy thì trả 503 ngay thay vì để request treo.
+    """
+    def __init__(self, name: str, executor: ThreadPoolExecutor, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def check_capacity(self):
+        """
+        Trả 503 ngay nếu endpoint đang chạy đủ số tác vụ và hàng đợi đã đầy.
+        """
+        if self.in_flight >= self.max_concurrency and self.queued >= self.max_queue:
+            self.rejected += 1
+            logging.warning(f"[{self.name}] Hàng đợi đầy ({self.queued}/{self.max_queue}), từ chối request.")
+            raise HTTPException(status_code=503, detail=f"Server is busy ({self.name}), please retry later", headers={"Retry-After": "5"})
+
+    @asynccontextmanager
+    async def slot(self, checked: bool = False):
+        """
+        Giữ một chỗ chạy của endpoint trong suốt khối lệnh (chờ trong hàng đợi nếu cần),
+        cho tác vụ không gói được thành một lời gọi hàm, ví dụ một luồng stream.
+        checked: caller đã gọi check_capacity (ví dụ trước khi trả response stream) nên không kiểm tra lại.
+        """
+        if not checked:
+            self.check_capacity()
+        enqueued_at = time.perf_counter()
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        wait = time.perf_counter() - enqueued_at
+        timing.record("queue", wait)
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    async def run(self, func, *args):
+        """
+        Chạy func trong giới hạn của endpoint: coroutine function thì await trên event loop,
+        hàm đồng bộ thì đẩy sang thread pool riêng để không chặn event loop.
+        """
+        async with self.slot():
+            if inspect.iscoroutinefunction(func):
+                return await func(*args)
+            # Chép context để span (timing) ghi từ thread pool vẫn thuộc request hiện tại
+            context = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, func, *args)
+
+    def stats(self):
+        started = self.completed + self.in_flight
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / started * 1000, 2) if started else 0,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+        }
+
+class WorkloadManager:
+    """
+    Thread pool riêng cho các tác vụ phân tích đồng bộ (engine) và các limiter theo endpoint.
+    Cấu hình qua biến môi trường: ENGINE_THREAD_POOL_SIZE, LIMIT_<ENDPOINT>, QUEUE_<ENDPOINT>.
+    """
+    def __init__(self, limits: dict, pool_size: int = None):
+        self.pool_size = pool_size or int(os.getenv("ENGINE_THREAD_POOL_SIZE", "8"))
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="engine")
+        self.limiters = {}
+        for name, (max_concurrency, max_queue) in limits.items():
+            env_name = name.upper()
+            self.limiters[name] = EndpointLimiter(
+                name,
+                self.executor,
+                int(os.getenv(f"LIMIT_{env_name}", max_concurrency)),
+                int(os.getenv(f"QUEUE_{env_name}", max_queue)),
+            )
+        logging.info(f"WorkloadManager: thread pool {self.pool_size} workers, limiters: {list(self.limiters)}")
+
+    async def run(self, name: str, func, *args):
+        return await self.limiters[name].run(func, *args)
+
+    def slot(self, name: str, checked: bool = False):
+        return self.limiters[name].slot(checked)
+
+    def stats(self):
+        return {
+            "thread_pool_size": self.pool_size,
+            "endpoints": {name: limiter.stats() for name, limiter in self.limiters.items()},
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)